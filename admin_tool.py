@@ -1,4 +1,5 @@
 import requests
+import time
 import urllib3
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -6,9 +7,21 @@ SERVER_URL = "https://127.0.0.1:8443"
 session = requests.Session()
 session.verify = False
 
+def fetch_devices():
+    # Page through /api/fleet/devices, asking only for the columns we print
+    devices, cursor = {}, None
+    while True:
+        params = {"fields": "status,version", "limit": 1000}
+        if cursor: params["cursor"] = cursor
+        page = session.get(f"{SERVER_URL}/api/fleet/devices", params=params).json()
+        for d in page["items"]:
+            devices[d["device_id"]] = d
+        cursor = page.get("next_cursor")
+        if not cursor: return devices
+
 def main():
     try:
-        devices = session.get(f"{SERVER_URL}/api/devices").json()
+        devices = fetch_devices()
     except:
         print("❌ Cannot connect to server."); return
 
@@ -19,7 +32,8 @@ def main():
         icon = "🟢" if d['status'] == "Stable" else "🔴"
         print(f"{i+1}. {did:<11} {icon} {d['status']:<12} v{d.get('version','?')}")
     
-    sel = input("\nSelect device # to update: ")
+    sel = input("\nSelect device # to update (or 'r' for a fleet rollout): ")
+    if sel.lower() == 'r': return start_rollout()
     if not sel.isdigit(): return
 
     try: target = d_list[int(sel)-1][0]
@@ -33,5 +47,26 @@ def main():
     elif res.get('status') == 'initiated': print(f"✅ SUCCESS: Update to v{res.get('target_ver')} initiated")
     else: print(f"⚠️ Response: {res}")
 
+def start_rollout():
+    pct = input("Percentage of fleet to include [100]: ").strip() or "100"
+    wave = input("Devices per wave [50]: ").strip() or "50"
+    body = {
+        "selector": {"type": "percentage", "value": float(pct)},
+        "wave_size": int(wave),
+    }
+    ro = session.post(f"{SERVER_URL}/admin/rollouts", json=body).json()
+    print(f"\n🚀 Rollout #{ro['id']} → v{ro['target_version']} for {ro['devices_total']} devices")
+
+    # Follow progress until the rollout stops
+    while True:
+        ro = session.get(f"{SERVER_URL}/admin/rollouts/{ro['id']}").json()
+        print(f"   Wave {ro['wave']}/{ro['waves_total']} | ✅ {ro['succeeded']} ⚠️ {ro['failed']} "
+              f"🛡️ {ro['blocked']} ⏭️ {ro['skipped']} | In-flight: {ro['in_flight']} | "
+              f"{ro['throughput_devices_per_min']} dev/min")
+        if ro['status'] != 'running':
+            print(f"\n{ro['status'].upper()}" + (f": {ro['reason']}" if ro.get('reason') else ""))
+            return
+        time.sleep(2)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
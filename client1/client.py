@@ -1,10 +1,18 @@
+import base64
 import json
+import os
 import time
+import hashlib
+import struct
+import zlib
 import requests
+from collections import deque
 import urllib3
 import sys
 from threading import Thread
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
 
 # -------------------------------------------------------
 # REQUIREMENT: Real Hardware Data
@@ -44,6 +52,12 @@ except KeyError as e:
     print("   Please update your config.json file.")
     sys.exit(1)
 
+# --- OPTIONAL BATCHING SETTINGS ---
+# batch_size > 1 buffers samples and sends them to /telemetry/batch once the
+# buffer is full or the oldest sample is older than batch_max_age seconds.
+BATCH_SIZE = cfg.get("batch_size", 1)
+BATCH_MAX_AGE = cfg.get("batch_max_age", INT * BATCH_SIZE)
+
 # --- TELEMETRY LOGIC ---
 def generate_telemetry():
     """
@@ -111,6 +125,20 @@ def generate_telemetry():
         "ota_port": OTA_PORT
     }
 
+def flush_batch(session, buffer):
+    """Sends buffered samples in one request; keeps them on connection failure."""
+    batch = list(buffer)
+    resp = session.post(f"{URL}/telemetry/batch", json=batch, timeout=10)
+    if resp.status_code == 200:
+        buffer.clear()
+        result = resp.json()
+        print(f"   🟢 [Batch] Sent {len(batch)} samples | Accepted: {result['accepted']} | Failed: {result['failed']}")
+        if any(r["status"] == "rejected" for r in result["results"]):
+            print(f"   ❌ Access Denied: Device ID '{ID}' is not whitelisted.")
+    else:
+        buffer.clear()
+        print(f"   ⚠️ Server Error: {resp.status_code} (dropped {len(batch)} samples)")
+
 def send_loop(): 
     session = requests.Session()
     session.verify = False 
@@ -119,19 +147,30 @@ def send_loop():
     print(f"   → Server: {URL}")
     print(f"   → Listening on Port: {OTA_PORT}")
     print(f"   → Mode:   ✅ REAL + SMART FALLBACK DATA")
+    if BATCH_SIZE > 1:
+        print(f"   → Batching: {BATCH_SIZE} samples / {BATCH_MAX_AGE}s")
+
+    # Bounded so an unreachable server cannot exhaust device memory
+    buffer = deque(maxlen=BATCH_SIZE * 10)
     
     while True:
         try:
             data = generate_telemetry()
-            
-            resp = session.post(f"{URL}/telemetry", json=data, timeout=5)
-            
-            if resp.status_code == 200:
-                print(f"   🟢 [Sent] CPU: {data['cpu']}% | Mem: {data['mem']}% | Temp: {data['temp']}°C")
-            elif resp.status_code == 403:
-                print(f"   ❌ Access Denied: Device ID '{ID}' is not whitelisted.")
+
+            if BATCH_SIZE > 1:
+                buffer.append(data)
+                oldest_age = time.time() - buffer[0]["timestamp"]
+                if len(buffer) >= BATCH_SIZE or oldest_age >= BATCH_MAX_AGE:
+                    flush_batch(session, buffer)
             else:
-                print(f"   ⚠️ Server Error: {resp.status_code}")
+                resp = session.post(f"{URL}/telemetry", json=data, timeout=5)
+                
+                if resp.status_code == 200:
+                    print(f"   🟢 [Sent] CPU: {data['cpu']}% | Mem: {data['mem']}% | Temp: {data['temp']}°C")
+                elif resp.status_code == 403:
+                    print(f"   ❌ Access Denied: Device ID '{ID}' is not whitelisted.")
+                else:
+                    print(f"   ⚠️ Server Error: {resp.status_code}")
                 
         except requests.exceptions.ConnectionError:
             print(f"   ❌ Connection Failed: Could not reach {URL}")
@@ -147,28 +186,252 @@ def send_loop():
 class OTAHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         if self.path == "/ota-trigger":
+            # The server tells us which version it is rolling out
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                target = json.loads(self.rfile.read(length) or b"{}").get("target_version")
+            except (ValueError, AttributeError):
+                target = None
             self.send_response(200)
             self.end_headers()
             print(f"\n⚡ [OTA] Trigger received! Starting firmware download...")
-            Thread(target=perform_update).start()
+            Thread(target=perform_update, args=(target,)).start()
             
     def log_message(self, format, *args): return
 
-def perform_update():
+# --- DELTA PATCHING ---
+# Mirrors the server's patch format (server/app/delta.py). The patch is
+# decompressed and applied as it streams in: COPY ops read the installed
+# image with seeks and every output byte goes straight to a ".part" file,
+# so memory use stays constant whatever the image or patch size (like the
+# full download below).
+PATCH_IO = 64 * 1024
+
+class PatchStream:
+    """Decompressed patch bytes, pulled on demand from the streamed response body."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._z = zlib.decompressobj()
+        self._buf = bytearray()
+
+    def read(self, n):
+        while len(self._buf) < n:
+            data = self._z.unconsumed_tail or next(self._chunks, None)
+            if data is None:
+                self._buf += self._z.flush()
+                break
+            self._buf += self._z.decompress(data, PATCH_IO)  # bounded: patches compress well
+        out = bytes(self._buf[:n])
+        del self._buf[:n]
+        return out
+
+    def exact(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise ValueError("Truncated delta patch")
+        return data
+
+def apply_delta_stream(old_path, chunks, out):
+    """Writes the patched image to `out`; raises ValueError if the patch doesn't match."""
+    patch = PatchStream(chunks)
+    header = patch.exact(77)
+    if header[:5] != b"IOTD1":
+        raise ValueError("Not a delta patch")
+    old_hash, new_hash = header[5:37], header[37:69]
+    (size,) = struct.unpack(">Q", header[69:77])
+    h = hashlib.sha256()
+    written = 0
+    with open(old_path, "rb") as old:
+        base = hashlib.sha256()
+        for data in iter(lambda: old.read(PATCH_IO), b""):
+            base.update(data)
+        if base.digest() != old_hash:
+            raise ValueError("Installed image does not match patch base")
+        while True:
+            op = patch.read(1)
+            if not op:
+                break
+            if op == b"C":
+                off, length = struct.unpack(">QI", patch.exact(12))
+                old.seek(off)
+                read = old.read
+            elif op == b"I":
+                (length,) = struct.unpack(">I", patch.exact(4))
+                read = patch.exact
+            else:
+                raise ValueError("Corrupt delta patch")
+            while length:
+                data = read(min(length, PATCH_IO))
+                if not data:
+                    raise ValueError("Delta copies past the end of the installed image")
+                out.write(data)
+                h.update(data)
+                written += len(data)
+                length -= len(data)
+    if written != size or h.digest() != new_hash:
+        raise ValueError("Patched image hash mismatch")
+    return h.hexdigest()
+
+def try_delta_update(manifest, dest="firmware_update.bin"):
+    """Patches the installed image to the manifest's version; False to fall back to a full download."""
+    target = manifest["version"]
+    if not os.path.exists(dest):
+        return False
+    part = f"{dest}.{manifest['sha256'][:16]}.delta.part"
+    received = 0
+    try:
+        with requests.get(f"{URL}/firmware/delta", params={"from": VER, "to": target}, stream=True,
+                          verify=False, timeout=10) as r:
+            if r.status_code != 200:
+                return False
+            def body():
+                nonlocal received
+                for data in r.iter_content(PATCH_IO):
+                    received += len(data)
+                    yield data
+            with open(part, "wb") as out:
+                digest = apply_delta_stream(dest, body(), out)
+                out.flush()
+                os.fsync(out.fileno())
+    except (requests.RequestException, OSError, ValueError, zlib.error) as e:
+        print(f"   ⚠️ Delta rejected ({e}), falling back to full image")
+        if os.path.exists(part):
+            os.remove(part)
+        return False
+    if digest != manifest["sha256"]:
+        print("   ⚠️ Patched image does not match the signed manifest, falling back to full image")
+        os.remove(part)
+        return False
+    os.replace(part, dest)
+    print(f"   🧩 Applied delta v{VER} → v{target} ({received} bytes instead of {manifest['size']})")
+    return True
+
+# --- SIGNED MANIFESTS ---
+# Every firmware version has a manifest (size, SHA-256, per-chunk hashes)
+# signed with the server's Ed25519 key. The public key is pinned in
+# firmware_signing_key.pub; if the file is missing it is fetched once from
+# the server and stored (trust on first use).
+PUBKEY_FILE = "firmware_signing_key.pub"
+
+def load_signing_pubkey():
+    try:
+        with open(PUBKEY_FILE, "rb") as f:
+            pem = f.read()
+    except FileNotFoundError:
+        r = requests.get(f"{URL}/firmware/signing-key", verify=False, timeout=10)
+        r.raise_for_status()
+        pem = r.content
+        with open(PUBKEY_FILE, "wb") as f:
+            f.write(pem)
+        print(f"   🔑 Pinned server signing key in {PUBKEY_FILE}")
+    return serialization.load_pem_public_key(pem)
+
+def fetch_manifest(version):
+    """Downloads a version's manifest and checks its signature; None if invalid."""
+    r = requests.get(f"{URL}/firmware/{version}/manifest", verify=False, timeout=10)
+    if r.status_code != 200:
+        print(f"❌ [OTA] Manifest for v{version} unavailable: Status {r.status_code}")
+        return None
+    manifest = r.json()
+    body = {k: v for k, v in manifest.items() if k != "signature"}
+    try:
+        load_signing_pubkey().verify(base64.b64decode(manifest.get("signature", "")),
+                                     json.dumps(body, sort_keys=True, separators=(",", ":")).encode())
+    except (InvalidSignature, ValueError):
+        print(f"❌ [OTA] Manifest signature for v{version} is INVALID")
+        return None
+    print(f"   🔏 Manifest signature verified (v{manifest['version']}, sha256 {manifest['sha256'][:12]}…)")
+    return manifest
+
+# --- RESUMABLE DOWNLOAD ---
+# The image is streamed to a ".part" file and every manifest chunk is
+# hash-checked as soon as it is complete, so memory use does not depend on
+# the firmware size and corruption is caught mid-stream. After an
+# interruption the verified prefix of the ".part" file is kept and the rest
+# is requested with a Range header; the finished file is checked against
+# the manifest digest and renamed over the old one atomically.
+DOWNLOAD_RETRIES = 5
+
+def _verified_prefix(part, manifest, h):
+    """Length of the leading whole chunks of `part` that match the manifest (feeds h)."""
+    size = manifest["chunk_size"]
+    good = 0
+    if not os.path.exists(part):
+        return 0
+    with open(part, "rb") as f:
+        for expected in manifest["chunks"]:
+            chunk = f.read(size)
+            if not chunk or hashlib.sha256(chunk).hexdigest() != expected:
+                break
+            if len(chunk) < size and good + len(chunk) != manifest["size"]:
+                break  # trailing partial chunk: fetch it again
+            h.update(chunk)
+            good += len(chunk)
+    with open(part, "r+b") as f:
+        f.truncate(good)
+    return good
+
+def download_firmware(version, dest, manifest):
+    part = f"{dest}.{manifest['sha256'][:16]}.part"
+    size, chunk_size, chunks = manifest["size"], manifest["chunk_size"], manifest["chunks"]
+    for attempt in range(DOWNLOAD_RETRIES):
+        h = hashlib.sha256()
+        offset = _verified_prefix(part, manifest, h)
+        index = offset // chunk_size
+        headers = {}
+        if offset:
+            # Content-addressed: the ETag is the image digest we expect
+            headers = {"Range": f"bytes={offset}-", "If-Range": f'"{manifest["sha256"]}"'}
+            print(f"   ↪ Resuming download at byte {offset}")
+        try:
+            with requests.get(f"{URL}/firmware/{version}", headers=headers, stream=True,
+                              verify=False, timeout=10) as r:
+                if r.status_code == 200 and offset:
+                    h, offset, index = hashlib.sha256(), 0, 0
+                    open(part, "wb").close()
+                elif r.status_code not in (200, 206):
+                    print(f"❌ [OTA] Download failed: Status {r.status_code}")
+                    return False
+                buf = bytearray()
+                with open(part, "ab") as f:
+                    for data in r.iter_content(chunk_size):
+                        buf += data
+                        while len(buf) >= chunk_size or (buf and offset + len(buf) == size):
+                            chunk = bytes(buf[:chunk_size])
+                            del buf[:chunk_size]
+                            if index >= len(chunks) or hashlib.sha256(chunk).hexdigest() != chunks[index]:
+                                raise ValueError(f"chunk {index} failed hash check")
+                            f.write(chunk)
+                            h.update(chunk)
+                            offset += len(chunk)
+                            index += 1
+                    f.flush()
+                    os.fsync(f.fileno())
+        except (requests.RequestException, OSError, ValueError) as e:
+            print(f"   ⚠️ Download interrupted ({e}), retrying ({attempt + 1}/{DOWNLOAD_RETRIES})")
+            time.sleep(min(2 ** attempt, 10))
+            continue
+
+        if offset != size or h.hexdigest() != manifest["sha256"]:
+            print("   ⚠️ Downloaded image does not match the manifest, retrying")
+            continue
+        os.replace(part, dest)
+        return True
+    print(f"❌ [OTA] Download failed after {DOWNLOAD_RETRIES} attempts")
+    return False
+
+def perform_update(target=None):
     global VER
     try:
-        print(f"   Downloading firmware from {URL}...")
-        r = requests.get(f"{URL}/firmware/latest.bin", verify=False, timeout=10)
-        
-        if r.status_code == 200:
-            with open("firmware_update.bin", "wb") as f:
-                f.write(r.content)
-            print("   Verifying signature...")
-            time.sleep(2)
-            VER = "2.1.5"
-            print(f"✅ [OTA] SUCCESS: Firmware updated to v{VER}")
-        else:
-            print(f"❌ [OTA] Download failed: Status {r.status_code}")
+        manifest = fetch_manifest(target or "latest")
+        if manifest is None:
+            return
+        if not try_delta_update(manifest):
+            print(f"   Downloading firmware v{manifest['version']} ({manifest['size']} bytes) from {URL}...")
+            if not download_firmware(manifest["version"], "firmware_update.bin", manifest):
+                return
+        VER = manifest["version"]
+        print(f"✅ [OTA] SUCCESS: Firmware updated to v{VER}")
     except Exception as e:
         print(f"❌ [OTA] Update failed: {e}")
 
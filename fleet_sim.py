@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import httpx
+
+# --- FLEET SIMULATOR ---
+# Thousands of virtual devices in one process, for load tests and capacity
+# planning. Each device sends telemetry like client-dummy.py (normal or
+# high-load profile) through one shared connection pool, and answers OTA
+# triggers from the server: it downloads the target image and reports the
+# new version once "installed".
+#
+# OTA listeners: "single" mode runs one listener on --ota-port for every
+# device (the server names the device in the trigger body); "range" mode
+# gives device i its own port, --ota-port + i.
+#
+# The server only accepts whitelisted devices: leave "allowed_devices" in
+# server/config/devices.json empty, or list the simulated ids.
+
+RESERVOIR = 100_000  # latency samples kept for the final percentiles
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Simulate a fleet of IoT devices against the OTA server")
+    p.add_argument("--url", default="https://127.0.0.1:8443", help="server URL")
+    p.add_argument("--devices", type=int, default=1000, help="number of virtual devices")
+    p.add_argument("--interval", type=float, default=5.0, help="seconds between samples per device")
+    p.add_argument("--duration", type=float, default=60.0, help="seconds to run (0 = until Ctrl+C)")
+    p.add_argument("--high-load", type=float, default=0.05,
+                   help="fraction of devices with the high-load profile (like iot-002)")
+    p.add_argument("--prefix", default="sim-", help="device id prefix")
+    p.add_argument("--version", default="1.0.0", help="firmware version the devices start on")
+    p.add_argument("--connections", type=int, default=100, help="size of the shared connection pool")
+    p.add_argument("--ota-mode", choices=("single", "range", "off"), default="single")
+    p.add_argument("--ota-port", type=int, default=9000, help="listener port (first port in range mode)")
+    p.add_argument("--install-time", type=float, default=2.0, help="simulated install time after download")
+    p.add_argument("--report", type=float, default=5.0, help="seconds between progress lines")
+    p.add_argument("--json", metavar="PATH", help="also write the final report as JSON")
+    return p.parse_args()
+
+
+class Device:
+    __slots__ = ("id", "version", "high_load", "ota_port", "updating")
+
+    def __init__(self, device_id, version, high_load, ota_port):
+        self.id = device_id
+        self.version = version
+        self.high_load = high_load
+        self.ota_port = ota_port
+        self.updating = False
+
+    def telemetry(self):
+        # Same ranges as client-dummy.py
+        hl = self.high_load
+        return {
+            "device_id": self.id,
+            "version": self.version,
+            "cpu": round(random.uniform(86, 99) if hl else random.uniform(20, 60), 1),
+            "mem": round(random.uniform(80, 95) if hl else random.uniform(30, 50), 1),
+            "temp": round(random.uniform(35, 75), 1),
+            "timestamp": int(time.time()),
+            "ota_port": self.ota_port,
+        }
+
+
+# --- STATISTICS ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sent = 0
+        self.ok = 0
+        self.errors = {}            # "HTTP 403" / exception name -> count
+        self.window = []            # latencies (s) since the last progress line
+        self.samples = []           # reservoir over the whole run
+        self.ota = {"triggers": 0, "succeeded": 0, "failed": 0, "bytes": 0}
+
+    def record(self, latency, error=None):
+        self.sent += 1
+        if error is None:
+            self.ok += 1
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        self.window.append(latency)
+        if len(self.samples) < RESERVOIR:
+            self.samples.append(latency)
+        else:
+            i = random.randrange(self.sent)
+            if i < RESERVOIR:
+                self.samples[i] = latency
+
+    def take_window(self):
+        window, self.window = self.window, []
+        return sorted(window)
+
+    def summary(self, devices, interval):
+        elapsed = time.perf_counter() - self.started
+        lat = sorted(self.samples)
+        return {
+            "devices": devices,
+            "target_rps": round(devices / interval, 1),
+            "elapsed_s": round(elapsed, 1),
+            "requests": self.sent,
+            "ok": self.ok,
+            "errors": self.errors,
+            "achieved_rps": round(self.sent / elapsed, 1),
+            "latency_ms": {f"p{int(p * 100)}": round(percentile(lat, p) * 1000, 1)
+                           for p in (0.5, 0.9, 0.95, 0.99)},
+            "latency_max_ms": round(lat[-1] * 1000, 1) if lat else 0.0,
+            "ota": self.ota,
+        }
+
+
+# --- TELEMETRY ---
+async def device_loop(client, device, interval, stats, stop):
+    # Spread the first samples over one interval instead of a thundering herd
+    await asyncio.sleep(random.uniform(0, interval))
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        error = None
+        try:
+            r = await client.post("/telemetry", json=device.telemetry())
+            if r.status_code != 200:
+                error = f"HTTP {r.status_code}"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        latency = time.perf_counter() - t0
+        stats.record(latency, error)
+        await asyncio.sleep(max(0.0, interval - latency))
+
+
+# --- OTA LISTENERS ---
+async def perform_update(client, device, target, stats, install_time):
+    device.updating = True
+    try:
+        async with client.stream("GET", f"/firmware/{target or 'latest'}") as r:
+            if r.status_code != 200:
+                raise httpx.HTTPStatusError(f"HTTP {r.status_code}", request=r.request, response=r)
+            async for chunk in r.aiter_bytes():
+                stats.ota["bytes"] += len(chunk)
+        await asyncio.sleep(install_time)
+        if target:
+            device.version = target
+        stats.ota["succeeded"] += 1
+    except httpx.HTTPError:
+        stats.ota["failed"] += 1
+    finally:
+        device.updating = False
+
+
+def ota_handler(resolve, client, stats, install_time):
+    """Minimal HTTP/1.1 server for POST /ota-trigger; resolve(body) -> Device or None."""
+    updates = set()  # running downloads (the loop only keeps weak references to tasks)
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        length = int(value)
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    payload = {}
+                device = resolve(payload) if request.split(b" ")[1:2] == [b"/ota-trigger"] else None
+                if device is None:
+                    status = b"404 Not Found"
+                elif device.updating:
+                    status = b"409 Conflict"
+                else:
+                    status = b"200 OK"
+                    stats.ota["triggers"] += 1
+                    task = asyncio.create_task(perform_update(client, device, payload.get("target_version"),
+                                                              stats, install_time))
+                    updates.add(task)
+                    task.add_done_callback(updates.discard)
+                writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # closed by the server, or the simulator is shutting down
+        finally:
+            writer.close()
+    return handle
+
+
+async def start_listeners(args, fleet, client, stats):
+    if args.ota_mode == "off":
+        return []
+    if args.ota_mode == "single":
+        by_id = {d.id: d for d in fleet}
+        handler = ota_handler(lambda p: by_id.get(p.get("device_id")), client, stats, args.install_time)
+        return [await asyncio.start_server(handler, "0.0.0.0", args.ota_port)]
+    servers = []
+    for device in fleet:
+        handler = ota_handler(lambda p, d=device: d, client, stats, args.install_time)
+        servers.append(await asyncio.start_server(handler, "0.0.0.0", device.ota_port))
+    return servers
+
+
+# --- REPORTING ---
+async def reporter(stats, every, stop):
+    last_sent, last_t = 0, time.perf_counter()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), every)
+        except asyncio.TimeoutError:
+            pass
+        now = time.perf_counter()
+        lat = stats.take_window()
+        rate = (stats.sent - last_sent) / (now - last_t)
+        last_sent, last_t = stats.sent, now
+        errors = sum(stats.errors.values())
+        print(f"📊 {now - stats.started:6.0f}s | {rate:8,.0f} req/s | p50 {percentile(lat, 0.5) * 1000:6.1f} ms"
+              f" | p95 {percentile(lat, 0.95) * 1000:6.1f} ms | p99 {percentile(lat, 0.99) * 1000:6.1f} ms"
+              f" | errors {errors} | OTA {stats.ota['succeeded']}/{stats.ota['triggers']}")
+
+
+async def main(args, stats):
+    rng = random.Random(42)  # same devices get the high-load profile every run
+    width = max(5, len(str(args.devices - 1)))
+    fleet = []
+    for i in range(args.devices):
+        port = args.ota_port + i if args.ota_mode == "range" else args.ota_port
+        fleet.append(Device(f"{args.prefix}{i:0{width}d}", args.version, rng.random() < args.high_load, port))
+
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    # No pool timeout: when the pool is busy, devices queue (and that shows up as latency)
+    timeout = httpx.Timeout(10.0, pool=None)
+    stats.started = time.perf_counter()
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(base_url=args.url, verify=False, limits=limits, timeout=timeout) as client:
+        servers = await start_listeners(args, fleet, client, stats)
+        print(f"🛰️ Simulating {args.devices} devices ({sum(d.high_load for d in fleet)} high-load) → {args.url}")
+        print(f"   → {args.devices / args.interval:,.0f} req/s target, {args.connections} pooled connections, "
+              f"OTA listener: {args.ota_mode}")
+        tasks = [asyncio.create_task(device_loop(client, d, args.interval, stats, stop)) for d in fleet]
+        report = asyncio.create_task(reporter(stats, args.report, stop))
+        try:
+            if args.duration:
+                await asyncio.sleep(args.duration)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            stop.set()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, report, return_exceptions=True)
+            for s in servers:
+                s.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    stats = Stats()
+    try:
+        asyncio.run(main(args, stats))
+    except KeyboardInterrupt:
+        print("\nSimulator stopping...")
+    except OSError as e:
+        print(f"❌ Error: {e}. Is an OTA listener port already in use?")
+        raise SystemExit(1)
+
+    summary = stats.summary(args.devices, args.interval)
+    lat = summary["latency_ms"]
+    print(f"\n✅ {summary['requests']:,} requests in {summary['elapsed_s']}s: "
+          f"{summary['achieved_rps']:,} req/s (target {summary['target_rps']:,})")
+    print(f"   Latency p50 {lat['p50']} ms | p90 {lat['p90']} ms | p95 {lat['p95']} ms | "
+          f"p99 {lat['p99']} ms | max {summary['latency_max_ms']} ms")
+    if summary["errors"]:
+        print(f"   ⚠️ Errors: {summary['errors']}" + ("  (HTTP 403: whitelist the simulated ids)"
+                                                    if "HTTP 403" in summary["errors"] else ""))
+    print(f"   OTA: {summary['ota']['triggers']} triggers, {summary['ota']['succeeded']} updated, "
+          f"{summary['ota']['failed']} failed, {summary['ota']['bytes'] / 2**20:.1f} MiB downloaded")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
\ No newline at end of file
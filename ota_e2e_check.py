@@ -0,0 +1,133 @@
+import hashlib
+import json
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+# --- END-TO-END OTA CHECK ---
+# Starts the server (plain HTTP, scratch copy of server/) and runs the real
+# device clients (client1/ and client2/) against it:
+#   1. full download of a signed image, with the signing key pinned on first use
+#   2. delta update to the next version, streamed and patched on the device
+#   3. the same update with a different pinned key must be refused
+# Every step checks the installed firmware_update.bin against the manifest.
+# Needs the client's dependencies (requests, psutil, cryptography).
+#
+# Run from the repository root:
+#     python ota_e2e_check.py
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT / "server"))
+from benchmarks.common import scratch_copy
+
+BASE, TARGET = "9.0.0", "9.1.0"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(work):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+                             "--log-level", "warning"], cwd=work, stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("❌ Server did not start")
+
+
+def make_images():
+    rng = random.Random(7)
+    base = bytes(rng.getrandbits(8) for _ in range(512 * 1024))
+    # A patch release: mostly the same bytes, one rewritten region, a bit appended
+    target = base[:200_000] + bytes(rng.getrandbits(8) for _ in range(8_000)) + base[208_000:] + b"v9.1" * 1024
+    return base, target
+
+
+def run_client(device_dir, target):
+    """perform_update() in a fresh client process; returns its output."""
+    r = subprocess.run([sys.executable, "-c", f"import client; client.perform_update({target!r})"],
+                       cwd=device_dir, capture_output=True, text=True, timeout=120)
+    return r.stdout + r.stderr
+
+
+def installed_sha(device_dir):
+    path = device_dir / "firmware_update.bin"
+    return hashlib.sha256(path.read_bytes()).hexdigest() if path.exists() else None
+
+
+def check_client(name, url, manifests, base, check):
+    device_dir = Path(tempfile.mkdtemp(prefix="ota-device-"))
+    try:
+        shutil.copy(ROOT / name / "client.py", device_dir)
+        (device_dir / "config.json").write_text(json.dumps({
+            "device_id": f"e2e-{name}", "server_url": url, "telemetry_interval": 5,
+            "ota_port": free_port(), "current_version": BASE}))
+
+        out = run_client(device_dir, BASE)
+        check(f"{name}: full download of v{BASE} verified against its signed manifest",
+              "SUCCESS" in out and installed_sha(device_dir) == manifests[BASE]["sha256"], out)
+        check(f"{name}: server signing key pinned on first use",
+              (device_dir / "firmware_signing_key.pub").exists(), out)
+
+        out = run_client(device_dir, TARGET)
+        check(f"{name}: delta update v{BASE} → v{TARGET} applied and verified",
+              "Applied delta" in out and installed_sha(device_dir) == manifests[TARGET]["sha256"], out)
+
+        # A device that pinned another key must refuse the server's manifests
+        (device_dir / "firmware_signing_key.pub").write_bytes(
+            ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+        (device_dir / "firmware_update.bin").write_bytes(base)
+        out = run_client(device_dir, TARGET)
+        check(f"{name}: manifest signed by an unpinned key is refused",
+              "INVALID" in out and installed_sha(device_dir) == manifests[BASE]["sha256"], out)
+    finally:
+        shutil.rmtree(device_dir, ignore_errors=True)
+
+
+def main():
+    root, work = scratch_copy()
+    proc, url = start_server(work)
+    failures = []
+
+    def check(name, ok, output=""):
+        print(f"{'✅' if ok else '❌'} {name}")
+        if not ok:
+            failures.append(name)
+            print("   " + output.strip().replace("\n", "\n   "))
+
+    try:
+        base, target = make_images()
+        for version, image in ((BASE, base), (TARGET, target)):
+            requests.post(f"{url}/admin/firmware/{version}", data=image, timeout=30).raise_for_status()
+        manifests = {v: requests.get(f"{url}/firmware/{v}/manifest", timeout=10).json() for v in (BASE, TARGET)}
+        for name in ("client1", "client2"):
+            check_client(name, url, manifests, base, check)
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if failures:
+        print(f"\n❌ {len(failures)} check(s) failed")
+        raise SystemExit(1)
+    print("\n✅ OTA update path works end to end")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,4 +1,6 @@
+import json
 import requests
+import threading
 import time
 import urllib3
 import sys
@@ -50,18 +52,55 @@ current_view = '1'
 selected_device_idx = 0
 device_history = {}
 
-# --- 4. DATA FETCHING ---
+# --- 4. DATA FETCHING (push stream) ---
+# One long-lived /api/stream connection: the server sends a snapshot, then
+# only the devices that changed and new log lines. A background thread
+# applies them to the local copies below; the render loop never waits on
+# the network.
+LOG_LEN = 200
+live_devices = {}
+live_stats = {"anomalies": 0, "log": []}
+stream_connected = False
+state_lock = threading.Lock()
+
+def apply_event(event, payload):
+    with state_lock:
+        if event == "snapshot":
+            live_devices.clear()
+            live_stats["log"] = list(payload.get("log", []))
+        live_devices.update(payload.get("devices", {}))
+        if event == "delta":
+            live_stats["log"] = (live_stats["log"] + payload.get("log", []))[-LOG_LEN:]
+        live_stats["anomalies"] = payload.get("anomalies", live_stats["anomalies"])
+        update_history(payload.get("devices", {}))
+
+def stream_loop():
+    global stream_connected
+    while True:
+        try:
+            with session.get(f"{SERVER_URL}/api/stream", params={"interval": REFRESH_RATE},
+                             stream=True, timeout=(3, 30)) as resp:
+                resp.raise_for_status()
+                stream_connected = True
+                event = None
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        apply_event(event, json.loads(line[5:]))
+        except (requests.RequestException, ValueError):
+            pass
+        stream_connected = False
+        time.sleep(2)
+
 def fetch_data():
-    try:
-        resp_dev = session.get(f"{SERVER_URL}/api/devices", timeout=1)
-        devices = resp_dev.json() if resp_dev.status_code == 200 else {}
-        resp_stat = session.get(f"{SERVER_URL}/api/stats", timeout=1)
-        stats = resp_stat.json() if resp_stat.status_code == 200 else {"anomalies": 0, "log": []}
-        return devices, stats
-    except:
+    if not stream_connected:
         return None, None
+    with state_lock:
+        return dict(live_devices), {"anomalies": live_stats["anomalies"], "log": list(live_stats["log"])}
 
 def update_history(devices):
+    # Called per pushed update, so the graphs show one point per real sample
     for d_id, data in devices.items():
         if d_id not in device_history:
             device_history[d_id] = {
@@ -121,7 +160,7 @@ def render_overview(devices, height=None):
         port = data.get('ota_port', '8000')
         
         # Status Styling
-        if "ANOMALY" in status: 
+        if data.get('is_stable') is False: 
             status_render = Text("⚠️ CRITICAL", style="bold color(196)") # Bright Red
         else: 
             status_render = Text("● Stable", style="color(46)") # Neon Green
@@ -156,7 +195,9 @@ def render_graphs(devices, height=None):
     current_id = device_ids[selected_device_idx]
     data = devices[current_id]
     
-    hist = device_history.get(current_id, {'cpu':[], 'mem':[], 'temp':[]})
+    # The stream thread appends to the deques under state_lock: copy them first
+    with state_lock:
+        hist = {k: list(v) for k, v in device_history.get(current_id, {'cpu':[], 'mem':[], 'temp':[]}).items()}
     
     available_h = (height or 20) - 4
     graph_h = max(3, int(available_h / 3))
@@ -191,6 +232,9 @@ def render_graphs(devices, height=None):
     )
 
 # --- VIEW 3: SECURITY LOGS ---
+LOG_STYLES = {"critical": "bold color(196)", "warning": "color(208)"}  # Red / Orange Red
+OK_KINDS = ("ota_success", "rollout_completed", "recovery")
+
 def render_security(stats, height=None):
     logs = stats.get('log', [])
     log_table = Table(expand=True, box=None, show_header=False)
@@ -200,11 +244,10 @@ def render_security(stats, height=None):
     else:
         max_lines = (height or 20) - 2
         for entry in reversed(logs[-max_lines:]): 
-            style = "dim"
-            if "BLOCKED" in entry: style = "bold color(196)"
-            elif "ALERT" in entry: style = "color(208)" # Orange Red
-            elif "SUCCESS" in entry: style = "color(46)"
-            log_table.add_row(f"[{style}]{entry}[/]")
+            # Structured events: style from severity/kind, text rendered by the server
+            style = LOG_STYLES.get(entry.get('severity'), "dim")
+            if style == "dim" and entry.get('kind') in OK_KINDS: style = "color(46)"
+            log_table.add_row(Text(entry.get('text', ''), style=style))
             
     return Panel(log_table, title="[3] Security Logs", border_style="color(196)", height=height)
 
@@ -246,6 +289,7 @@ if __name__ == "__main__":
     layout = make_layout()
     console.print("[bold yellow]Connecting to Secure Server...[/]")
     
+    threading.Thread(target=stream_loop, daemon=True).start()
     try:
         with Live(layout, refresh_per_second=4, screen=True) as live:
             while True:
@@ -256,8 +300,7 @@ if __name__ == "__main__":
                 
                 devices, stats = fetch_data()
                 
-                if devices:
-                    update_history(devices)
+                if devices is not None:
                     update_layout(layout, devices, stats, current_view)
                 else:
                     err = Panel(Align.center(f"[bold red]CONNECTION LOST[/]\n\nChecking {SERVER_URL}..."), title="Error", border_style="red")
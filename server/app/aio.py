@@ -0,0 +1,29 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from app import metrics
+
+# --- DISK I/O POOL ---
+# Blocking file work started from async handlers (uploads, image mapping,
+# delta builds, archive reads, config writes) runs in this small dedicated
+# pool. Nothing on the event loop waits for the disk, so a slow disk delays
+# those requests without stalling /telemetry. Being separate from the default
+# executor (asyncio.to_thread: fleet scans, cluster polling), a stuck disk
+# can't starve that work either, and vice versa. Calls beyond IO_THREADS queue.
+
+IO_THREADS = 4
+
+_pool = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="ota-io")
+_pending = 0  # calls queued or running (only changed on the event loop)
+
+metrics.Gauge("ota_io_pending", "Disk I/O calls queued or running in the I/O pool", fn=lambda: _pending)
+
+
+async def run_io(fn, *args, **kwargs):
+    """Runs blocking file I/O in the I/O pool and waits for it without blocking the loop."""
+    global _pending
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool, functools.partial(fn, *args, **kwargs))
+    finally:
+        _pending -= 1
\ No newline at end of file
@@ -0,0 +1,146 @@
+from array import array
+from collections import namedtuple
+from app.config import get_thresholds, get_whitelist
+from app.state import get_device
+
+# --- STREAMING ANOMALY DETECTOR ---
+# Each device keeps a fixed-size state: an exponentially weighted mean and
+# variance plus the last raw value for every metric (18 doubles), a sample
+# count and two streak counters. A sample deviates when a metric is more
+# than z_threshold standard deviations above its baseline, rises faster
+# than its rate limit, or breaks a hard cpu/mem limit. Network counters are
+# cumulative, so their per-second rate is what gets tracked.
+#
+# Hysteresis: trigger_count deviating samples in a row enter ANOMALY and
+# clear_count normal samples in a row leave it, so one spike doesn't flap
+# the device status (and the OTA gate) back and forth. Deviating values are
+# folded into the baseline at a tenth of the usual weight: a burst can't
+# hide itself by inflating the variance, but a lasting new level is
+# eventually learned.
+
+METRICS = ("cpu", "mem", "temp", "disk_usage", "net_sent_mb", "net_recv_mb")
+_COUNTER_FROM = 4                                   # METRICS[4:] are counters
+_MIN_VAR = tuple(s * s for s in (5.0, 2.0, 1.0, 0.5, 0.05, 0.05))  # std floors
+_OUTLIER_WEIGHT = 0.1
+_NAN = float("nan")
+
+Verdict = namedtuple("Verdict", "status is_stable entered cleared reason")
+_STABLE = Verdict("Stable", True, False, False, None)
+# status is one of these two fixed strings (the device registry interns it);
+# the reason, which carries live readings, is stored as anomaly_reason
+
+
+class _DeviceState:
+    __slots__ = ("stats", "last_ts", "n", "bad", "good", "anomalous", "reason",
+                 "th", "rates", "cfg")
+
+    def __init__(self):
+        self.stats = array("d", [_NAN, 0.0, _NAN] * len(METRICS))  # mean, var, last
+        self.last_ts = None
+        self.n = 0
+        self.bad = 0
+        self.good = 0
+        self.anomalous = False
+        self.reason = None
+        self.th = None       # resolved Thresholds for this device
+        self.rates = None    # rate limit per metric index (or None)
+        self.cfg = None      # config snapshots th was resolved from
+
+
+class AnomalyDetector:
+    def __init__(self):
+        self._states = {}
+
+    def _state(self, device_id):
+        st = _DeviceState()
+        # Carry a persisted ANOMALY status across restarts until it clears
+        prev = get_device(device_id)
+        if prev is not None and prev.get("is_stable") is False:
+            status = prev.get("status") or ""
+            st.anomalous = True
+            # Records saved before anomaly_reason carried the reason in the status
+            st.reason = (prev.get("anomaly_reason")
+                         or (status[9:-1] if status.startswith("ANOMALY (") else "restored"))
+        self._states[device_id] = st
+        return st
+
+    def _resolve(self, st, device_id):
+        policy, whitelist = get_thresholds(), get_whitelist()
+        if st.cfg is None or st.cfg[0] is not policy or st.cfg[1] is not whitelist:
+            th = policy.resolve(device_id, whitelist.groups_of(device_id))
+            st.th = th
+            st.rates = tuple(th.rate_limits.get(m) for m in METRICS)
+            st.cfg = (policy, whitelist)
+        return st.th
+
+    def observe(self, device_id, timestamp, values):
+        """Feeds one sample (values in METRICS order) and returns a Verdict."""
+        st = self._states.get(device_id)
+        if st is None:
+            st = self._state(device_id)
+        th = self._resolve(st, device_id)
+
+        dt = timestamp - st.last_ts if st.last_ts is not None else 0
+        st.last_ts = timestamp
+        s = st.stats
+        alpha = th.alpha
+        z2 = th.z_threshold * th.z_threshold
+        warm = st.n >= th.warmup
+        rates = st.rates
+        flagged = None
+
+        if values[0] > th.cpu_threshold or values[1] > th.mem_threshold:
+            flagged = "High Load"
+
+        for i in range(len(METRICS)):
+            j = 3 * i
+            raw = values[i]
+            last = s[j + 2]
+            s[j + 2] = raw
+            if i >= _COUNTER_FROM:
+                # Counters: track MB/s; skip first sample, same-second and reset (reboot) samples
+                if dt <= 0 or last != last or raw < last:
+                    continue
+                x = (raw - last) / dt
+            else:
+                x = raw
+                limit = rates[i]
+                if limit is not None and dt > 0 and last == last and (raw - last) / dt > limit:
+                    flagged = flagged or f"{METRICS[i]} rising {(raw - last) / dt:.1f}/s"
+            mean = s[j]
+            if mean != mean:  # first value seeds the baseline
+                s[j] = x
+                continue
+            var = s[j + 1]
+            diff = x - mean
+            a = alpha
+            if warm and diff > 0 and diff * diff > z2 * (var if var > _MIN_VAR[i] else _MIN_VAR[i]):
+                flagged = flagged or f"{METRICS[i]} {x:.1f} vs baseline {mean:.1f}"
+                a = alpha * _OUTLIER_WEIGHT
+            incr = a * diff
+            s[j] = mean + incr
+            s[j + 1] = (1 - a) * (var + diff * incr)
+        st.n += 1
+
+        # --- HYSTERESIS ---
+        entered = cleared = False
+        if flagged:
+            st.bad += 1
+            st.good = 0
+            if not st.anomalous and st.bad >= th.trigger_count:
+                st.anomalous, st.reason, entered = True, flagged, True
+        else:
+            st.good += 1
+            st.bad = 0
+            if st.anomalous and st.good >= th.clear_count:
+                st.anomalous, st.reason, cleared = False, None, True
+
+        if st.anomalous:
+            return Verdict("ANOMALY", False, entered, False, st.reason)
+        return _STABLE._replace(cleared=True) if cleared else _STABLE
+
+    def forget(self, device_id):
+        self._states.pop(device_id, None)
+
+
+detector = AnomalyDetector()
\ No newline at end of file
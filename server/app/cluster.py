@@ -0,0 +1,325 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from app import metrics, state
+from app.utils import BASE_DIR, WORKERS
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# --- MULTI-WORKER MODE ---
+# run.py can start several server processes on the same port (uvicorn
+# workers, see config/server.json). They share state through the SQLite
+# database in WAL mode:
+#   * each worker writes its own telemetry batches; device rows carry a
+#     revision and every worker pulls the others' changes a few times a
+#     second, so its indexes, event log and /api/stream stay fleet-wide
+#   * the anomaly counter is stored as deltas, so it stays exact
+#   * event sequence numbers are assigned by the database
+#   * one worker holds leader.lock and is the only one that runs rollouts,
+#     the periodic fleet scan and WAL checkpoints. Rollout commands that
+#     reach another worker are queued in the database for the leader.
+# If the leader exits, the OS drops its lock and another worker takes over.
+
+SYNC_INTERVAL = 0.25
+LEADER_POLL = 2.0
+CHECKPOINT_EVERY = 5.0
+METRICS_EVERY = 5.0       # how often each worker publishes its metrics snapshot
+METRICS_STALE = 30.0      # snapshots older than this belong to exited workers
+COMMAND_TIMEOUT = 10.0
+COMMAND_TTL = 60.0        # queued commands older than this are deleted by the leader
+LOCK_FILE = BASE_DIR / "leader.lock"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cluster_commands (
+        id         INTEGER PRIMARY KEY AUTOINCREMENT,
+        action     TEXT NOT NULL,
+        target     INTEGER,
+        payload    TEXT,
+        result     TEXT,
+        done       INTEGER NOT NULL DEFAULT 0,  -- 0 queued, 2 running, 1 finished or cancelled
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_commands_pending ON cluster_commands(done, id);
+
+    CREATE TABLE IF NOT EXISTS cluster_rollouts (
+        id         INTEGER PRIMARY KEY,
+        data       TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS cluster_metrics (
+        pid        INTEGER PRIMARY KEY,
+        data       TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    );
+"""
+
+
+class CommandError(Exception):
+    """A queued command failed on the leader (status is the HTTP status to report)."""
+
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+class LeaderLock:
+    """Non-blocking exclusive lock on a file; the OS releases it when the process exits."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def try_acquire(self):
+        if self._fh is not None:
+            return True
+        fh = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            fh.close()
+            return False
+        self._fh = fh
+        return True
+
+    def release(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class Cluster:
+    def __init__(self):
+        self.shared = state.SHARED
+        self.is_leader = False
+        self._lock = LeaderLock(LOCK_FILE)
+        self._on_elected = []
+        self._on_tick = []
+        self._handler = None
+        self._tasks = []
+        self._db = None  # leader loop's connection
+
+    # --- WIRING ---
+    def on_elected(self, fn):
+        """fn() runs once when this process becomes the leader (at startup in single mode).
+
+        A coroutine function is awaited before the leader runs any queued command.
+        """
+        self._on_elected.append(fn)
+
+    def on_leader_tick(self, fn):
+        """fn(db) runs on the leader every SYNC_INTERVAL (shared mode)."""
+        self._on_tick.append(fn)
+
+    def handle_commands(self, fn):
+        """fn(action, target, payload) -> JSON result; runs queued commands on the leader.
+
+        ValueError / LookupError raised by fn reach the caller as 400 / 404."""
+        self._handler = fn
+
+    def connect(self):
+        conn = sqlite3.connect(state.store.db_path, isolation_level=None, timeout=10,
+                               check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout=10000")
+        return conn
+
+    # --- LIFECYCLE ---
+    async def start(self):
+        if not self.shared:
+            await self._become_leader()
+            return
+        await asyncio.to_thread(self._create_tables)
+        self._tasks = [asyncio.create_task(self._sync_loop()),
+                       asyncio.create_task(self._leader_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._lock.release()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _create_tables(self):
+        conn = self.connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    async def _become_leader(self):
+        self.is_leader = True
+        if self.shared:
+            print(f"👑 Worker {os.getpid()} is the leader ({WORKERS} workers)")
+        for fn in self._on_elected:
+            result = fn()
+            if asyncio.iscoroutine(result):
+                await result
+
+    # --- CHANGE FEED (every worker) ---
+    async def _sync_loop(self):
+        last_metrics = 0.0
+        while True:
+            more = False
+            try:
+                store = state.store
+                devices, rev, new_events = await asyncio.to_thread(
+                    store.changes_since, store.device_rev, store.log.last_seq)
+                state.apply_changes(devices, new_events)
+                store.device_rev = rev
+                more = len(devices) >= 10000 or len(new_events) >= 10000
+                if time.monotonic() - last_metrics >= METRICS_EVERY:
+                    # Snapshot on the loop (metrics are written there), store it in a thread
+                    await asyncio.to_thread(self._publish_metrics, metrics.snapshot())
+                    last_metrics = time.monotonic()
+            except Exception as e:
+                print(f"⚠️ Cluster sync failed: {e}")
+            if not more:
+                await asyncio.sleep(SYNC_INTERVAL)
+
+    # --- LEADERSHIP ---
+    async def _leader_loop(self):
+        last_checkpoint = time.monotonic()
+        while True:
+            if not self.is_leader:
+                if not self._lock.try_acquire():
+                    await asyncio.sleep(LEADER_POLL)
+                    continue
+                self._db = await asyncio.to_thread(self.connect)
+                await self._become_leader()
+            try:
+                await self._run_commands()
+                for fn in self._on_tick:
+                    await asyncio.to_thread(fn, self._db)
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_EVERY:
+                    await asyncio.to_thread(self._prune_commands)
+                    await asyncio.to_thread(state.store.checkpoint)
+                    last_checkpoint = time.monotonic()
+            except Exception as e:
+                print(f"⚠️ Leader tick failed: {e}")
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    async def _run_commands(self):
+        rows = await asyncio.to_thread(lambda: self._db.execute(
+            "SELECT id, action, target, payload FROM cluster_commands WHERE done = 0 ORDER BY id"
+        ).fetchall())
+        for cmd_id, action, target, payload in rows:
+            # Claim the row first: a caller that timed out cancels only queued rows
+            claimed = await asyncio.to_thread(lambda: self._db.execute(
+                "UPDATE cluster_commands SET done = 2 WHERE id = ? AND done = 0", (cmd_id,)
+            ).rowcount)
+            if not claimed:
+                continue
+            try:
+                result = {"ok": self._handler(action, target, json.loads(payload or "null"))}
+            except CommandError as e:
+                result = {"status": e.status, "detail": e.detail}
+            except ValueError as e:
+                result = {"status": 400, "detail": str(e)}
+            except LookupError as e:
+                result = {"status": 404, "detail": e.args[0] if e.args else "Not found"}
+            except Exception as e:
+                result = {"status": 500, "detail": str(e)}
+            await asyncio.to_thread(
+                self._db.execute, "UPDATE cluster_commands SET done = 1, result = ? WHERE id = ?",
+                (json.dumps(result, default=str), cmd_id))
+
+    def _prune_commands(self):
+        self._db.execute("DELETE FROM cluster_commands WHERE created_at < ?", (time.time() - COMMAND_TTL,))
+
+    # --- COMMANDS (any worker -> leader) ---
+    def _submit(self, action, target, payload):
+        conn = self.connect()
+        try:
+            return conn.execute(
+                "INSERT INTO cluster_commands (action, target, payload, created_at) VALUES (?, ?, ?, ?)",
+                (action, target, json.dumps(payload), time.time())).lastrowid
+        finally:
+            conn.close()
+
+    def _result(self, cmd_id):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT done, result FROM cluster_commands WHERE id = ?", (cmd_id,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[1]) if row and row[0] == 1 else None
+
+    def _cancel(self, cmd_id):
+        """Marks a still-queued command as cancelled; False if the leader already took it."""
+        conn = self.connect()
+        try:
+            return conn.execute(
+                "UPDATE cluster_commands SET done = 1, result = ? WHERE id = ? AND done = 0",
+                (json.dumps({"status": 503, "detail": "cancelled"}), cmd_id)).rowcount > 0
+        finally:
+            conn.close()
+
+    async def call(self, action, target=None, payload=None):
+        """Queues a command for the leader and waits for its result."""
+        cmd_id = await asyncio.to_thread(self._submit, action, target, payload)
+        deadline = time.monotonic() + COMMAND_TIMEOUT
+        claimed = False
+        while True:
+            await asyncio.sleep(0.05)
+            result = await asyncio.to_thread(self._result, cmd_id)
+            if result is not None:
+                if "ok" in result:
+                    return result["ok"]
+                raise CommandError(result["status"], result["detail"])
+            if time.monotonic() < deadline:
+                continue
+            # Cancel so a later leader doesn't run it after we answered 503. If the
+            # leader has already claimed it, wait once more for its outcome.
+            if claimed or await asyncio.to_thread(self._cancel, cmd_id):
+                raise CommandError(503, "No leader answered; is the server shutting down?")
+            claimed = True
+            deadline = time.monotonic() + COMMAND_TIMEOUT
+
+    # --- METRICS (every worker) ---
+    def _publish_metrics(self, snap):
+        conn = self.connect()
+        try:
+            conn.execute(
+                "INSERT INTO cluster_metrics (pid, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(pid) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (os.getpid(), json.dumps(snap), time.time()))
+        finally:
+            conn.close()
+
+    def worker_metrics(self):
+        """{pid: snapshot} of the workers that published recently."""
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT pid, data FROM cluster_metrics WHERE updated_at > ?",
+                                (time.time() - METRICS_STALE,)).fetchall()
+        finally:
+            conn.close()
+        return {pid: json.loads(data) for pid, data in rows}
+
+    # --- SHARED ROLLOUT STATUS (written by the leader) ---
+    def read_rollouts(self, rollout_id=None):
+        conn = self.connect()
+        try:
+            if rollout_id is None:
+                rows = conn.execute("SELECT data FROM cluster_rollouts ORDER BY id").fetchall()
+            else:
+                rows = conn.execute("SELECT data FROM cluster_rollouts WHERE id = ?", (rollout_id,)).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(r[0]) for r in rows]
+
+
+cluster = Cluster()
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field, fields, replace
+from app.utils import CONFIG_DIR
+
+# --- CACHED CONFIG REGISTRY ---
+# Config files are parsed once into immutable snapshots. Each lookup only
+# re-stats the file (at most every RECHECK_INTERVAL seconds) and re-parses
+# it when its mtime/size changed. In the server a watcher thread does the
+# re-stat instead, so the hot path never touches the disk.
+
+RECHECK_INTERVAL = 1.0
+
+_FILES = []
+_watcher = None  # see start_watcher
+_wake = threading.Event()
+
+
+@dataclass(frozen=True)
+class Thresholds:
+    # Hard limits: a sample above these is always a deviation
+    cpu_threshold: float = 85.0
+    mem_threshold: float = 90.0
+    # Streaming detector (app/anomaly.py)
+    z_threshold: float = 4.0     # deviation = this many std devs above the EWMA baseline
+    alpha: float = 0.1           # EWMA weight of the newest sample
+    warmup: int = 10             # samples before z-scores are trusted
+    trigger_count: int = 3       # consecutive deviating samples to enter ANOMALY
+    clear_count: int = 3         # consecutive normal samples to leave it
+    rate_limits: dict = field(default_factory=lambda: {"temp": 2.0, "disk_usage": 1.0})  # max rise per second
+
+
+@dataclass(frozen=True)
+class ThresholdPolicy:
+    """Global thresholds plus per-group (devices.json tag) and per-device overrides."""
+    default: Thresholds = Thresholds()
+    groups: dict = field(default_factory=dict)   # tag -> Thresholds
+    devices: dict = field(default_factory=dict)  # device_id -> override dict
+
+    def resolve(self, device_id, device_groups=()):
+        base = self.default
+        for tag in device_groups:
+            if tag in self.groups:
+                base = self.groups[tag]
+                break
+        override = self.devices.get(device_id)
+        return _apply_overrides(base, override) if override else base
+
+
+@dataclass(frozen=True)
+class DeviceWhitelist:
+    allowed: frozenset = frozenset()
+    tags: dict = field(default_factory=dict)  # tag -> frozenset of device ids
+
+    def permits(self, device_id):
+        # An empty whitelist means "allow everyone" (legacy behaviour)
+        return not self.allowed or device_id in self.allowed
+
+    def tagged(self, tag):
+        return self.tags.get(tag, frozenset())
+
+    def groups_of(self, device_id):
+        # Tags in sorted order, so the first matching group override wins deterministically
+        return tuple(tag for tag in sorted(self.tags) if device_id in self.tags[tag])
+
+
+@dataclass(frozen=True)
+class OtaSettings:
+    target_firmware_version: str = "2.1.5"
+    trigger_concurrency: int = 100
+    trigger_timeout: float = 5.0
+    trigger_retries: int = 3
+
+
+@dataclass(frozen=True)
+class ProfilingSettings:
+    enabled: bool = False
+    sample_rate: float = 0.01    # fraction of requests that record per-stage timings
+    budget_ms: float = 100.0     # requests slower than this are kept as slow traces
+    cprofile: bool = False       # also run sampled requests under cProfile
+    keep: int = 50               # slow traces kept per worker
+    exclude: tuple = ("/api/stream", "/firmware/")  # path prefixes that are slow by design
+    blocking_ms: float = 0.0     # report event-loop stalls longer than this (0 = off)
+
+
+_THRESHOLD_TYPES = {f.name: f.type for f in fields(Thresholds)}
+
+
+def _apply_overrides(base, cfg):
+    changes = {}
+    for key, value in cfg.items():
+        kind = _THRESHOLD_TYPES.get(key)
+        if kind is dict:
+            changes[key] = {**getattr(base, key), **{m: float(v) for m, v in value.items()}}
+        elif kind in (float, int):
+            changes[key] = kind(value)
+    return replace(base, **changes)
+
+
+def _parse_thresholds(raw):
+    default = _apply_overrides(Thresholds(), raw.get("global", {}))
+    return ThresholdPolicy(
+        default=default,
+        groups={tag: _apply_overrides(default, cfg) for tag, cfg in raw.get("groups", {}).items()},
+        devices={did: dict(cfg) for did, cfg in raw.get("devices", {}).items()},
+    )
+
+
+def _parse_whitelist(raw):
+    return DeviceWhitelist(
+        allowed=frozenset(raw.get("allowed_devices", [])),
+        tags={tag: frozenset(ids) for tag, ids in raw.get("tags", {}).items()},
+    )
+
+
+def _parse_ota_settings(raw):
+    return OtaSettings(
+        target_firmware_version=str(raw.get("target_firmware_version", "2.1.5")),
+        trigger_concurrency=int(raw.get("trigger_concurrency", 100)),
+        trigger_timeout=float(raw.get("trigger_timeout", 5.0)),
+        trigger_retries=int(raw.get("trigger_retries", 3)),
+    )
+
+
+def _parse_profiling(raw):
+    return ProfilingSettings(
+        enabled=bool(raw.get("enabled", False)),
+        sample_rate=min(1.0, max(0.0, float(raw.get("sample_rate", 0.01)))),
+        budget_ms=max(1.0, float(raw.get("budget_ms", 100.0))),
+        cprofile=bool(raw.get("cprofile", False)),
+        keep=max(1, int(raw.get("keep", 50))),
+        exclude=tuple(raw.get("exclude", ("/api/stream", "/firmware/"))),
+        blocking_ms=max(0.0, float(raw.get("blocking_ms", 0.0))),
+    )
+
+
+class ConfigFile:
+    def __init__(self, filename, parser):
+        self.path = CONFIG_DIR / filename
+        self.parser = parser
+        self._lock = threading.Lock()
+        self._snapshot = parser({})
+        self._stamp = None
+        self._checked_at = 0.0
+        _FILES.append(self)
+
+    def get(self):
+        if _watcher is None:
+            now = time.monotonic()
+            if now - self._checked_at >= RECHECK_INTERVAL:
+                self._revalidate(now)
+        return self._snapshot
+
+    def invalidate(self):
+        self._checked_at = 0.0
+        _wake.set()
+
+    def refresh(self):
+        """Re-reads the file now if it changed (blocking; for code that just wrote it)."""
+        self._revalidate(time.monotonic())
+
+    def _revalidate(self, now):
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+                stamp = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                stamp = None
+            if stamp == self._stamp:
+                return
+            try:
+                raw = json.loads(self.path.read_text()) if stamp else {}
+                self._snapshot = self.parser(raw)
+                self._stamp = stamp
+            except Exception as e:
+                # Keep serving the last good snapshot on a bad edit
+                print(f"⚠️ Error reloading {self.path.name}: {e}")
+
+
+thresholds = ConfigFile("thresholds.json", _parse_thresholds)
+whitelist = ConfigFile("devices.json", _parse_whitelist)
+ota_settings = ConfigFile("ota_settings.json", _parse_ota_settings)
+profiling = ConfigFile("profiling.json", _parse_profiling)
+
+
+# --- BACKGROUND RELOAD ---
+# Without a watcher, get() re-stats the file itself (scripts, benchmarks).
+# The server starts one: a thread re-stats every file each RECHECK_INTERVAL,
+# so lookups on the event loop never wait on the disk.
+def start_watcher():
+    """Loads every config file once, then keeps them fresh from a thread (blocking)."""
+    global _watcher
+    if _watcher is not None:
+        return
+    for cfg in _FILES:
+        cfg.refresh()
+    _watcher = threading.Thread(target=_watch, name="config-watcher", daemon=True)
+    _watcher.start()
+
+def stop_watcher():
+    global _watcher
+    _watcher = None
+    _wake.set()
+
+def _watch():
+    me = threading.current_thread()
+    while _watcher is me:
+        _wake.wait(RECHECK_INTERVAL)
+        _wake.clear()
+        for cfg in _FILES:
+            cfg.refresh()
+
+
+def get_thresholds():
+    return thresholds.get()
+
+def get_whitelist():
+    return whitelist.get()
+
+def get_ota_settings():
+    return ota_settings.get()
+
+def get_profiling_settings():
+    return profiling.get()
+
+def invalidate_all():
+    for cfg in (thresholds, whitelist, ota_settings, profiling):
+        cfg.invalidate()
@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.utils import FIRMWARE_DIR
+from app.firmware import repository
+from app.aio import run_io
+
+# --- DELTA FIRMWARE UPDATES ---
+# Binary diffs between firmware images, computed once per (from, to) pair
+# and cached in memory and on disk under firmware/deltas/.
+#
+# Only versions stored in the firmware repository are diffed. A pair is built
+# when an upload precomputes it or when it is first requested, never from
+# the telemetry path. make_delta is pure-Python byte crunching that would hold
+# the GIL for seconds, so it runs in a separate process (BUILD_PROCESSES),
+# not in a thread of the server process.
+#
+# Patch format (zlib-compressed):
+#   b"IOTD1" | sha256(old) | sha256(new) | u64 new_size | ops...
+#   op COPY:   b"C" | u64 offset in old | u32 length
+#   op INSERT: b"I" | u32 length | raw bytes
+
+MAGIC = b"IOTD1"
+BLOCK = 32  # match granularity; smaller finds more matches but indexes more
+BUILD_PROCESSES = 1
+PREBUILD_MAX = 4     # deltas precomputed per upload (from the most common fleet versions)
+MAX_MISSING = 1024   # remembered pairs that could not be built
+
+VERSIONS_DIR = FIRMWARE_DIR / "versions"
+DELTAS_DIR = FIRMWARE_DIR / "deltas"
+
+_VERSION_RE = re.compile(r"^[0-9A-Za-z][0-9A-Za-z._-]{0,63}$")
+
+
+def valid_version(version):
+    # Versions become file names, so keep them to a safe character set
+    return bool(_VERSION_RE.match(version)) and ".." not in version
+
+
+def make_delta(old, new, block=BLOCK):
+    # Index every aligned block of the old image (first occurrence wins)
+    index = {}
+    for off in range(0, len(old) - block + 1, block):
+        index.setdefault(old[off:off + block], off)
+
+    out = [MAGIC, hashlib.sha256(old).digest(), hashlib.sha256(new).digest(),
+           struct.pack(">Q", len(new))]
+    literal_start = 0
+    i = 0
+    n = len(new)
+    while i <= n - block:
+        off = index.get(new[i:i + block])
+        if off is None:
+            i += 1
+            continue
+        # Extend the match forwards as far as the bytes agree
+        length = block
+        while i + length < n and off + length < len(old) and new[i + length] == old[off + length]:
+            length += 1
+        if literal_start < i:
+            lit = new[literal_start:i]
+            out.append(b"I" + struct.pack(">I", len(lit)) + lit)
+        out.append(b"C" + struct.pack(">QI", off, length))
+        i += length
+        literal_start = i
+    if literal_start < n:
+        lit = new[literal_start:]
+        out.append(b"I" + struct.pack(">I", len(lit)) + lit)
+    return zlib.compress(b"".join(out), 9)
+
+
+def apply_delta(old, patch):
+    """Rebuilds the new image; raises ValueError if the patch doesn't match."""
+    raw = zlib.decompress(patch)
+    if raw[:5] != MAGIC:
+        raise ValueError("Not a delta patch")
+    old_hash, new_hash = raw[5:37], raw[37:69]
+    (size,) = struct.unpack(">Q", raw[69:77])
+    if hashlib.sha256(old).digest() != old_hash:
+        raise ValueError("Base image does not match patch")
+
+    out = bytearray()
+    pos = 77
+    while pos < len(raw):
+        op = raw[pos:pos + 1]
+        if op == b"C":
+            off, length = struct.unpack(">QI", raw[pos + 1:pos + 13])
+            out += old[off:off + length]
+            pos += 13
+        elif op == b"I":
+            (length,) = struct.unpack(">I", raw[pos + 1:pos + 5])
+            out += raw[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError("Corrupt delta patch")
+    if len(out) != size or hashlib.sha256(out).digest() != new_hash:
+        raise ValueError("Patched image hash mismatch")
+    return bytes(out)
+
+
+def build_patch(old_path, new_path, out_path):
+    """Diffs two image files into out_path and returns the patch (runs in the build process)."""
+    with open(old_path, "rb") as f:
+        old = f.read()
+    with open(new_path, "rb") as f:
+        new = f.read()
+    patch = make_delta(old, new)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    # Atomic: a crash, or another worker building the same pair, never leaves a truncated patch
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(patch)
+    os.replace(tmp, out_path)
+    return patch
+
+
+def _read_cached(path):
+    return path.read_bytes() if path.exists() else None
+
+
+class DeltaCache:
+    def __init__(self):
+        self._patches = {}   # (from, to) -> bytes
+        self._building = {}  # (from, to) -> asyncio.Task
+        self._missing = OrderedDict()  # pairs that could not be built (don't retry every request)
+        self._pool = None
+
+    def _processes(self):
+        if self._pool is None:
+            # spawn: the server process runs threads, which fork() would copy mid-flight
+            self._pool = ProcessPoolExecutor(BUILD_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def _build(self, from_ver, to_ver):
+        cached = DELTAS_DIR / f"{from_ver}_{to_ver}.patch"
+        patch = await run_io(_read_cached, cached)
+        if patch is not None:
+            return patch
+        old_path, new_path = repository.blob_path(from_ver), repository.blob_path(to_ver)
+        if old_path is None or new_path is None:
+            return None
+        patch = await asyncio.get_running_loop().run_in_executor(
+            self._processes(), build_patch, str(old_path), str(new_path), str(cached))
+        print(f"🧩 Delta built: v{from_ver} → v{to_ver} ({len(patch)} bytes)")
+        return patch
+
+    def _start_build(self, key):
+        task = self._building.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._build(*key))
+            self._building[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return task
+
+    def _finish(self, key, task):
+        self._building.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            print(f"⚠️ Delta build failed for v{key[0]} → v{key[1]}: {task.exception()}")
+            if isinstance(task.exception(), BrokenProcessPool):
+                self._pool = None  # a build process died: start a fresh pool next time
+            return
+        patch = task.result()
+        if patch is None:
+            self._missing[key] = True
+            if len(self._missing) > MAX_MISSING:
+                self._missing.popitem(last=False)
+        else:
+            self._patches[key] = patch
+
+    async def get(self, from_ver, to_ver):
+        """Returns the patch bytes, or None if either image is not in the repository."""
+        key = (from_ver, to_ver)
+        if key in self._patches:
+            return self._patches[key]
+        if key in self._missing:
+            return None
+        # Unknown versions never start a build (or take a _missing slot)
+        if await repository.lookup(from_ver) is None or await repository.lookup(to_ver) is None:
+            return None
+        return await asyncio.shield(self._start_build(key))
+
+    def prebuild(self, to_ver, fleet_versions):
+        """After an upload: starts building deltas to it from the most common stored fleet versions."""
+        self._missing.clear()  # the new image may complete pairs that failed before
+        started = 0
+        for version, _ in sorted(fleet_versions.items(), key=lambda kv: -kv[1]):
+            if started >= PREBUILD_MAX:
+                break
+            key = (version, to_ver)
+            if version != to_ver and key not in self._patches and repository.manifest(version) is not None:
+                self._start_build(key)
+                started += 1
+
+    def close(self):
+        # Queued builds are dropped; a build already running is waited for (its patch is kept)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+cache = DeltaCache()
@@ -0,0 +1,148 @@
+import base64
+import bisect
+import json
+import time
+from collections import OrderedDict
+
+# --- DEVICE QUERY INDEXES ---
+# Secondary indexes behind GET /api/fleet/devices, maintained on every update:
+#   * all device ids in sorted order (id order, cursors, id-prefix ranges)
+#   * the set of devices currently flagged unstable
+#   * devices ordered by when the server last heard from them
+# Together with the version index (app/versions.py) a query starts from the
+# smallest matching candidate set instead of scanning the whole fleet.
+
+
+def encode_cursor(key, device_id):
+    raw = json.dumps([key, device_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, by_seen=False):
+    """Returns (key, device_id); raises ValueError on a malformed cursor or one from another sort.
+
+    An id-sorted cursor carries no key, a last_seen cursor carries the time.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key, device_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(device_id, str):
+        raise ValueError("Invalid cursor")
+    if by_seen:
+        if isinstance(key, bool) or not isinstance(key, (int, float)):
+            raise ValueError("Cursor does not match sort=last_seen")
+        key = float(key)
+    elif key is not None:
+        raise ValueError("Cursor does not match sort=id")
+    return key, device_id
+
+
+class DeviceQueryIndex:
+    def __init__(self):
+        self._ids = []                # sorted device ids
+        self._unstable = set()
+        self._seen = OrderedDict()    # device id -> server receive time, oldest first
+
+    def update(self, device_id, record, seen_at=None):
+        if device_id not in self._seen:
+            bisect.insort(self._ids, device_id)
+        self._seen[device_id] = time.time() if seen_at is None else seen_at
+        self._seen.move_to_end(device_id)
+        if record.get("is_stable") is False:
+            self._unstable.add(device_id)
+        else:
+            self._unstable.discard(device_id)
+
+    def rebuild(self, devices):
+        """Startup: receive times are unknown, so the devices' own timestamps stand in."""
+        self.__init__()
+        for device_id, record in sorted(devices.items(), key=lambda kv: kv[1].get("timestamp") or 0):
+            self.update(device_id, record, seen_at=record.get("timestamp") or 0)
+
+    # --- CANDIDATE SETS ---
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, device_id):
+        return device_id in self._seen
+
+    def ids(self):
+        """Every known device id, sorted (a copy)."""
+        return list(self._ids)
+
+    def prefix_range(self, prefix):
+        lo = bisect.bisect_left(self._ids, prefix)
+        hi = bisect.bisect_left(self._ids, prefix + "\U0010ffff")
+        return self._ids[lo:hi]
+
+    def seen_since(self, cutoff):
+        """Device ids heard from at or after cutoff (newest first; stops at the first older one)."""
+        out = []
+        for device_id in reversed(self._seen):
+            if self._seen[device_id] < cutoff:
+                break
+            out.append(device_id)
+        return out
+
+    # --- QUERY ---
+    def query(self, version_index, status=None, version=None, seen_within=None, prefix=None,
+              sort="id", cursor=None, limit=100):
+        """Returns (page of device ids, next cursor or None, number of matches)."""
+        descending = sort.startswith("-")
+        by_seen = sort.lstrip("-") == "last_seen"
+        after = decode_cursor(cursor, by_seen) if cursor else None
+
+        # Fast path: whole fleet in id order, straight from the sorted id list
+        if not (status or version or seen_within or prefix) and not by_seen:
+            page, more = _page(self._ids, after[1] if after else None, descending, limit)
+            nxt = encode_cursor(None, page[-1]) if more and page else None
+            return page, nxt, len(self._ids)
+
+        # Start from the smallest indexed candidate set, check the other filters per device
+        version_ids = version_index.matching(version) if version is not None else None
+        candidates = []
+        if prefix is not None:
+            candidates.append(self.prefix_range(prefix))
+        if version_ids is not None:
+            candidates.append(version_ids)
+        if status == "anomaly":
+            candidates.append(self._unstable)
+        cutoff = time.time() - seen_within if seen_within else None
+        if cutoff is not None and (not candidates or min(map(len, candidates)) > 1000):
+            candidates.append(self.seen_since(cutoff))
+        pool = min(candidates, key=len) if candidates else self._ids
+
+        matched = []
+        for device_id in pool:
+            if prefix is not None and not device_id.startswith(prefix):
+                continue
+            if version_ids is not None and device_id not in version_ids:
+                continue
+            if status == "anomaly" and device_id not in self._unstable:
+                continue
+            if status == "stable" and device_id in self._unstable:
+                continue
+            if cutoff is not None and self._seen.get(device_id, 0) < cutoff:
+                continue
+            matched.append(device_id)
+
+        if by_seen:
+            keyed = sorted((self._seen.get(did, 0), did) for did in matched)
+            mark = after
+        else:
+            keyed = [(None, did) for did in sorted(matched)]
+            mark = (None, after[1]) if after else None
+        page, more = _page(keyed, mark, descending, limit)
+        nxt = encode_cursor(*page[-1]) if more and page else None
+        return [did for _, did in page], nxt, len(keyed)
+
+
+def _page(asc, mark, descending, limit):
+    """Slice of an ascending list after the cursor mark (in either direction) + 'more?'."""
+    if descending:
+        end = bisect.bisect_left(asc, mark) if mark is not None else len(asc)
+        return asc[max(0, end - limit):end][::-1], end - limit > 0
+    start = bisect.bisect_right(asc, mark) if mark is not None else 0
+    return asc[start:start + limit], start + limit < len(asc)
\ No newline at end of file
@@ -0,0 +1,104 @@
+import asyncio
+import random
+import time
+from collections import deque
+import httpx
+from app import metrics
+
+# --- ASYNC OTA TRIGGER DISPATCHER ---
+# Sends /ota-trigger requests to devices without blocking the event loop.
+# One pooled AsyncClient keeps connections alive per device host, a
+# semaphore caps how many triggers are in flight, and failed attempts are
+# retried with jittered exponential backoff.
+
+
+class OtaDispatcher:
+    def __init__(self, max_concurrency=100, timeout=5.0, retries=3,
+                 backoff_base=0.5, backoff_max=8.0, keepalive_per_host=2):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.keepalive_per_host = keepalive_per_host
+
+        self._client = None
+        self._sem = None
+        self.results = deque(maxlen=1000)  # recent structured results
+
+    def configure(self, max_concurrency=None, timeout=None, retries=None):
+        if max_concurrency is not None:
+            self.max_concurrency = max_concurrency
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+
+    def _ensure_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency * self.keepalive_per_host,
+                ),
+            )
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._sem = None
+
+    def _backoff(self, attempt):
+        # "Full jitter": spreads retries from many devices over the window
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def trigger(self, device_id, ip_address, port, target_version):
+        """Sends one OTA trigger (with retries) and returns a result record."""
+        client = self._ensure_client()
+        url = f"http://{ip_address}:{port}/ota-trigger"
+        record = {
+            "device_id": device_id,
+            "url": url,
+            "target_version": target_version,
+            "outcome": "failed",
+            "attempts": 0,
+            "status_code": None,
+            "error": None,
+            "started_at": time.time(),
+            "elapsed_ms": 0.0,
+        }
+        start = time.perf_counter()
+
+        async with self._sem:
+            for attempt in range(self.retries + 1):
+                record["attempts"] = attempt + 1
+                try:
+                    # device_id lets one listener serve many (simulated) devices
+                    resp = await client.post(url, json={"target_version": target_version,
+                                                        "device_id": device_id})
+                    record["status_code"] = resp.status_code
+                    if resp.is_success:
+                        record["outcome"] = "success"
+                        record["error"] = None
+                        break
+                    record["error"] = f"HTTP {resp.status_code}"
+                    if resp.status_code < 500:
+                        break  # device rejected the trigger; retrying won't help
+                except httpx.HTTPError as e:
+                    record["error"] = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                if attempt < self.retries:
+                    await asyncio.sleep(self._backoff(attempt))
+
+        elapsed = time.perf_counter() - start
+        record["elapsed_ms"] = round(elapsed * 1000, 1)
+        self.results.append(record)
+        metrics.TRIGGERS.labels(record["outcome"]).inc()
+        metrics.TRIGGER_SECONDS.observe(elapsed)
+        return record
+
+
+dispatcher = OtaDispatcher()
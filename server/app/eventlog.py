@@ -0,0 +1,204 @@
+import json
+import os
+import time
+from collections import Counter, deque
+from app import events
+from app.events import from_dict, make_event
+
+# --- OTA EVENT LOG ---
+# Every event (app/events.py) gets a monotonic sequence number and a
+# timestamp. Only the newest `capacity` events are held in memory, indexed
+# by device and by kind. The full history is on disk (the storage backend's
+# log archive), so consumers can poll /api/log?since=<seq> for just the
+# events they haven't seen, even after those have left memory.
+
+DEFAULT_CAPACITY = 1000
+
+
+def upgrade_entries(items, first_seq=1):
+    """Stored events as dicts; older snapshots held bare strings (given seqs here)."""
+    out = []
+    seq = first_seq
+    for item in items:
+        if isinstance(item, dict):
+            seq = item["seq"]
+        else:
+            item = events.to_dict(from_dict(item, seq))
+        out.append(item)
+        seq += 1
+    return out
+
+
+def matcher(device=None, kind=None, min_severity=None):
+    """Predicate over events for the given filters (None if there are none)."""
+    if device is None and kind is None and min_severity is None:
+        return None
+    rank = events.SEVERITY_RANK.get(min_severity, 0)
+    return lambda e: ((device is None or e.device == device) and (kind is None or e.kind == kind)
+                      and events.SEVERITY_RANK.get(e.severity, 0) >= rank)
+
+
+class EventLog:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.ring = deque(maxlen=capacity)
+        self.next_seq = 1
+        self._by_device = {}            # device -> deque of its events in the ring
+        self._by_kind = {}              # kind -> deque of events in the ring
+        self._severity = Counter()      # severity -> events in the ring
+        self.totals = Counter()         # kind -> events since startup
+
+    def restore(self, entries, next_seq=None):
+        """Loads the tail of a persisted log (dicts, oldest first)."""
+        self.__init__(self.ring.maxlen)
+        for data in entries:
+            self._add(from_dict(data))
+        last = self.ring[-1].seq if self.ring else 0
+        self.next_seq = max(last + 1, next_seq or 1)
+
+    def append(self, kind, **fields):
+        event = make_event(self.next_seq, time.time(), kind, **fields)
+        self.next_seq += 1
+        self._add(event)
+        self.totals[kind] += 1
+        return event
+
+    def ingest(self, new_events):
+        """Adds events numbered elsewhere (the database, in shared mode); returns the new ones."""
+        added = []
+        for event in new_events:
+            if event.seq < self.next_seq:
+                continue
+            self._add(event)
+            self.totals[event.kind] += 1
+            self.next_seq = event.seq + 1
+            added.append(event)
+        return added
+
+    def _add(self, event):
+        if len(self.ring) == self.ring.maxlen:
+            old = self.ring[0]  # about to be evicted: it is the oldest in its indexes too
+            if old.device is not None:
+                self._drop(self._by_device, old.device)
+            self._drop(self._by_kind, old.kind)
+            self._severity[old.severity] -= 1
+        self.ring.append(event)
+        if event.device is not None:
+            self._by_device.setdefault(event.device, deque()).append(event)
+        self._by_kind.setdefault(event.kind, deque()).append(event)
+        self._severity[event.severity] += 1
+
+    @staticmethod
+    def _drop(index, key):
+        bucket = index[key]
+        bucket.popleft()
+        if not bucket:
+            del index[key]
+
+    @property
+    def first_seq(self):
+        return self.ring[0].seq if self.ring else self.next_seq
+
+    @property
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def recent(self, limit=20):
+        n = len(self.ring)
+        return [self.ring[i] for i in range(max(0, n - limit), n)]
+
+    def since(self, seq, limit=100, device=None, kind=None, min_severity=None):
+        """Events with seq > `seq` matching the filters, or None if some may no longer be in memory."""
+        if not self.ring:
+            return []
+        first = self.ring[0].seq
+        if seq + 1 < first:
+            return None
+        match = matcher(device, kind, min_severity)
+        if match is None:
+            # Sequence numbers are contiguous, so the start is an index, not a search
+            if seq >= self.ring[-1].seq:
+                return []
+            start = seq + 1 - first
+            if start < len(self.ring) and self.ring[start].seq == seq + 1:
+                end = min(len(self.ring), start + limit)
+                return [self.ring[i] for i in range(start, end)]
+            # A gap (a rolled-back insert in shared mode): fall through to the scan
+        # Walk the smallest index that covers the filters
+        match = match or (lambda e: True)
+        if device is not None:
+            pool = self._by_device.get(device, ())
+        elif kind is not None:
+            pool = self._by_kind.get(kind, ())
+        else:
+            pool = self.ring
+        out = []
+        for e in pool:
+            if e.seq > seq and match(e):
+                out.append(e)
+                if len(out) >= limit:
+                    break
+        return out
+
+    def summary(self, top=10):
+        """Counts over the in-memory window, straight from the indexes."""
+        busiest = sorted(self._by_device.items(), key=lambda kv: len(kv[1]), reverse=True)[:top]
+        return {
+            "window": {"from_seq": self.ring[0].seq if self.ring else None,
+                       "to_seq": self.last_seq, "events": len(self.ring)},
+            "by_kind": {k: len(v) for k, v in self._by_kind.items()},
+            "by_severity": {s: self._severity[s] for s in events.SEVERITIES},
+            "top_devices": [{"device": d, "events": len(v)} for d, v in busiest],
+            "since_startup": dict(self.totals),
+        }
+
+
+# --- ON-DISK ARCHIVE (JSON backend) ---
+# One NDJSON line per event, appended by the journal writer thread. Lines
+# are in seq order, so a lookup is a binary search over byte offsets.
+
+def append_archive(fh, entries):
+    fh.write("".join(json.dumps(e) + "\n" for e in entries))
+
+
+def _seq_at(f, offset):
+    """Seq of the first whole line starting at or after `offset` (None at EOF/torn tail)."""
+    f.seek(offset)
+    if offset:
+        f.readline()  # skip the partial line we landed in
+    line = f.readline()
+    try:
+        return json.loads(line)["seq"] if line else None
+    except (ValueError, KeyError):
+        return None
+
+
+def read_archive(path, since, limit, match=None):
+    """Events with seq > since (and matching, if given) from an NDJSON archive."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        lo, hi = 0, os.fstat(f.fileno()).st_size
+        # Find a line-aligned offset whose next line has seq <= since + 1
+        while hi - lo > 4096:
+            mid = (lo + hi) // 2
+            s = _seq_at(f, mid)
+            if s is None or s > since:
+                hi = mid
+            else:
+                lo = mid
+        f.seek(lo)
+        if lo:
+            f.readline()
+        out = []
+        for line in f:
+            try:
+                event = from_dict(json.loads(line))
+            except ValueError:
+                break  # torn tail from a write in progress
+            if event.seq > since and (match is None or match(event)):
+                out.append(event)
+                if len(out) >= limit:
+                    break
+        return out
@@ -0,0 +1,109 @@
+from collections import namedtuple
+
+# --- OTA / SECURITY EVENTS ---
+# The OTA log holds typed records, not display strings. Producers say what
+# happened (kind, device, versions, metrics); the text shown in the
+# dashboard is rendered from the record only when it is sent out, so the
+# hot path never formats or scans strings and events can be filtered and
+# counted by field.
+
+# Severities, lowest first
+INFO, WARNING, CRITICAL = "info", "warning", "critical"
+SEVERITIES = (INFO, WARNING, CRITICAL)
+SEVERITY_RANK = {s: i for i, s in enumerate(SEVERITIES)}
+
+# Kinds
+ANOMALY = "anomaly"                     # device entered ANOMALY state
+RECOVERY = "recovery"                   # ... and returned to Stable
+OTA_DEPLOY = "ota_deploy"
+OTA_BLOCKED = "ota_blocked"             # detail: reason (high_load / downgrade / invalid_version)
+OTA_SKIPPED = "ota_skipped"
+OTA_SUCCESS = "ota_success"
+OTA_FAILED = "ota_failed"
+ROLLOUT_STARTED = "rollout_started"
+ROLLOUT_HALTED = "rollout_halted"
+ROLLOUT_COMPLETED = "rollout_completed"
+ROLLOUT_CANCELLED = "rollout_cancelled"
+FLEET_ALERT = "fleet_alert"
+FIRMWARE_UPLOADED = "firmware_uploaded"
+NOTE = "note"                           # free text (log lines from before this model)
+
+DEFAULT_SEVERITY = {
+    ANOMALY: WARNING, OTA_FAILED: WARNING, FLEET_ALERT: WARNING, ROLLOUT_CANCELLED: WARNING,
+    OTA_BLOCKED: CRITICAL, ROLLOUT_HALTED: CRITICAL,
+}
+
+# metrics / detail are small dicts; everything else is a scalar
+Event = namedtuple("Event", "seq ts kind severity device from_version to_version metrics detail",
+                   defaults=(None, None, None, None, None))
+
+
+def make_event(seq, ts, kind, severity=None, device=None, from_version=None, to_version=None,
+               metrics=None, **detail):
+    return Event(seq, ts, kind, severity or DEFAULT_SEVERITY.get(kind, INFO), device,
+                 from_version, to_version, metrics or None, detail or None)
+
+
+def to_dict(event):
+    """Compact JSON form (empty fields left out) used on disk."""
+    return {k: v for k, v in zip(Event._fields, event) if v is not None}
+
+
+def from_dict(data, seq=None):
+    """Inverse of to_dict. Bare strings (older logs) become NOTE events."""
+    if isinstance(data, str):
+        return Event(seq, 0.0, NOTE, INFO, detail={"text": data})
+    if "kind" not in data:  # {seq, ts, msg} entries
+        return Event(data["seq"], data.get("ts", 0.0), NOTE, INFO, detail={"text": data.get("msg")})
+    return Event(**{k: data.get(k) for k in Event._fields})
+
+
+def to_public(event):
+    """API/stream form: the record plus its rendered text."""
+    d = to_dict(event)
+    d["text"] = render(event)
+    return d
+
+
+# --- RENDERING (display time only) ---
+def _blocked(e, d):
+    reason = d.get("reason")
+    if reason == "downgrade":
+        return (f"🛑 BLOCKED → Downgrade attack prevention. {e.device} "
+                f"(v{e.from_version}) > Target (v{e.to_version})")
+    if reason == "invalid_version":
+        return f"🛑 BLOCKED → Invalid target version '{e.to_version}' for {e.device}"
+    text = f"🛑 BLOCKED → OTA for {e.device} rejected (Risk: High Load)"
+    return text + (f" [rollout #{d['rollout']}]" if d.get("rollout") else "")
+
+
+_TEMPLATES = {
+    ANOMALY: lambda e, d: (f"⚠️ ALERT → {e.device} entered ANOMALY state: {d.get('reason')} "
+                           f"(CPU:{(e.metrics or {}).get('cpu')}%)"),
+    RECOVERY: lambda e, d: f"✅ RECOVERY → {e.device} returned to Stable state",
+    OTA_DEPLOY: lambda e, d: f"🚀 DEPLOYING → {e.device} (Stable). Sending trigger...",
+    OTA_BLOCKED: _blocked,
+    OTA_SKIPPED: lambda e, d: f"🛑 SKIPPED → {e.device} is already on v{e.to_version}",
+    OTA_SUCCESS: lambda e, d: (f"✅ SUCCESS → {e.device} updated to v{e.to_version} "
+                               f"(attempts: {d.get('attempts')}, {d.get('elapsed_ms')}ms)"),
+    OTA_FAILED: lambda e, d: (f"⚠️ FAILED → Connection error with {e.device}: {d.get('error')} "
+                              f"(attempts: {d.get('attempts')})"),
+    ROLLOUT_STARTED: lambda e, d: (f"🚀 ROLLOUT #{d.get('rollout')} → v{e.to_version} started for "
+                                   f"{d.get('devices')} devices in {d.get('waves')} waves"),
+    ROLLOUT_HALTED: lambda e, d: f"🛑 BLOCKED → ROLLOUT #{d.get('rollout')} halted: {d.get('reason')}",
+    ROLLOUT_COMPLETED: lambda e, d: (f"✅ SUCCESS → ROLLOUT #{d.get('rollout')} completed: "
+                                     f"{d.get('succeeded')} updated, {d.get('failed')} failed, "
+                                     f"{d.get('blocked')} blocked"),
+    ROLLOUT_CANCELLED: lambda e, d: f"🛑 ROLLOUT #{d.get('rollout')} cancelled",
+    FLEET_ALERT: lambda e, d: (f"⚠️ FLEET → {str(d.get('alert')).replace('_', ' ')} in {d.get('group')}: "
+                               f"{d.get('rate', 0):.0%} of {d.get('devices')} devices"),
+    FIRMWARE_UPLOADED: lambda e, d: f"📦 FIRMWARE → v{e.to_version} uploaded ({d.get('size')} bytes)",
+}
+
+
+def render(event):
+    detail = event.detail or {}
+    template = _TEMPLATES.get(event.kind)
+    if template is None:
+        return detail.get("text") or f"{event.kind} {event.device or ''}".strip()
+    return template(event, detail)
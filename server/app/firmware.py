@@ -0,0 +1,391 @@
+import asyncio
+import base64
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+from fastapi import HTTPException
+from fastapi.responses import Response
+from app.utils import FIRMWARE_DIR, WORKERS, load_signing_key
+from app import metrics
+from app.aio import run_io
+
+# --- CONTENT-ADDRESSED FIRMWARE REPOSITORY ---
+# Images are stored once under store/objects/<sha256> and each version gets a
+# manifest (size, digest, per-chunk hashes, Ed25519 signature) written at
+# upload time. Requests only read the cached manifest and the blob; nothing
+# is hashed or signed on the request path.
+#
+# The signature covers the manifest without its "signature" field, encoded
+# as compact JSON with sorted keys (see canonical_manifest()).
+
+STORE_DIR = FIRMWARE_DIR / "store"
+OBJECTS_DIR = STORE_DIR / "objects"
+MANIFESTS_DIR = STORE_DIR / "manifests"
+MANIFEST_CHUNK_SIZE = 64 * 1024
+
+
+def canonical_manifest(manifest):
+    body = {k: v for k, v in manifest.items() if k != "signature"}
+    return json.dumps(body, sort_keys=True, separators=(",", ":")).encode()
+
+
+class FirmwareRepository:
+    def __init__(self):
+        self._manifests = {}  # version -> manifest dict
+        self._key = None
+
+    def load(self):
+        """Reads cached manifests and imports images not in the store yet."""
+        from app.delta import VERSIONS_DIR, valid_version  # delta imports this module
+        from app.config import get_ota_settings
+
+        OBJECTS_DIR.mkdir(parents=True, exist_ok=True)
+        MANIFESTS_DIR.mkdir(parents=True, exist_ok=True)
+        self._key = load_signing_key()
+        self._manifests = {}
+        self.refresh()
+
+        # Loose images: versions/<v>.bin and the legacy firmware.bin (= target)
+        loose = [(p.stem, p) for p in sorted(VERSIONS_DIR.glob("*.bin"))]
+        loose.append((get_ota_settings().target_firmware_version, FIRMWARE_DIR / "firmware.bin"))
+        for version, path in loose:
+            if valid_version(version) and version not in self._manifests and path.exists():
+                self.add_file(version, path, copy=True, exclusive=False)
+
+        # Map the rollout target up front so the first wave of downloads is served hot
+        hot_images.clear()
+        target = self._manifests.get(get_ota_settings().target_firmware_version)
+        if target is not None:
+            hot_images.get(target["sha256"])
+        print(f"📦 Firmware repository: {len(self._manifests)} versions")
+
+    def add_file(self, version, path, copy=False, exclusive=True):
+        """Hashes, signs and stores an image; the file is moved unless copy=True.
+
+        With exclusive=True, raises FileExistsError if the version is already
+        stored, also when another upload (in any worker) stores it first.
+        """
+        final = MANIFESTS_DIR / f"{version}.json"
+        if exclusive and (version in self._manifests or final.exists()):
+            raise FileExistsError(f"Firmware v{version} already exists")
+        h = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(MANIFEST_CHUNK_SIZE), b""):
+                h.update(chunk)
+                chunks.append(hashlib.sha256(chunk).hexdigest())
+                size += len(chunk)
+        digest = h.hexdigest()
+
+        blob = OBJECTS_DIR / digest
+        if not blob.exists():
+            fd, tmp = tempfile.mkstemp(dir=OBJECTS_DIR)
+            os.close(fd)
+            if copy:
+                shutil.copyfile(path, tmp)
+            else:
+                shutil.move(str(path), tmp)
+            os.replace(tmp, blob)
+        elif not copy:
+            os.remove(path)  # identical image already stored
+
+        manifest = {
+            "version": version,
+            "size": size,
+            "sha256": digest,
+            "chunk_size": MANIFEST_CHUNK_SIZE,
+            "chunks": chunks,
+        }
+        manifest["signature"] = base64.b64encode(self._key.sign(canonical_manifest(manifest))).decode()
+        fd, tmp = tempfile.mkstemp(dir=MANIFESTS_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(manifest))
+        if not exclusive:
+            os.replace(tmp, final)
+        else:
+            try:
+                os.link(tmp, final)  # fails if the version appeared meanwhile: the first upload wins
+            except FileExistsError:
+                raise FileExistsError(f"Firmware v{version} already exists") from None
+            finally:
+                os.remove(tmp)
+        self._manifests[version] = manifest
+        print(f"📦 Firmware v{version} stored ({size} bytes, sha256 {digest[:12]}…)")
+        return manifest
+
+    def refresh(self):
+        """Picks up manifests written since (by another worker, in multi-worker mode)."""
+        for path in MANIFESTS_DIR.glob("*.json"):
+            if path.stem in self._manifests:
+                continue
+            try:
+                manifest = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            if (OBJECTS_DIR / manifest["sha256"]).exists():
+                self._manifests[manifest["version"]] = manifest
+
+    def manifest(self, version):
+        """Manifest of a stored version (may read the disk with several workers: see lookup())."""
+        manifest = self._manifests.get(version)
+        if manifest is None and WORKERS > 1 and (MANIFESTS_DIR / f"{version}.json").is_file():
+            self.refresh()  # uploaded through another worker
+            manifest = self._manifests.get(version)
+        return manifest
+
+    async def lookup(self, version):
+        """manifest() for the event loop: an unknown version is looked for on disk in the I/O pool."""
+        manifest = self._manifests.get(version)
+        if manifest is None and WORKERS > 1:
+            manifest = await run_io(self.manifest, version)
+        return manifest
+
+    def blob_path(self, version):
+        manifest = self.manifest(version)
+        return None if manifest is None else OBJECTS_DIR / manifest["sha256"]
+
+    def versions(self):
+        if WORKERS > 1:
+            self.refresh()
+        return sorted(self._manifests)
+
+    async def list_versions(self):
+        """versions() for the event loop (the directory scan runs in the I/O pool)."""
+        if WORKERS > 1:
+            await run_io(self.refresh)
+        return sorted(self._manifests)
+
+    def public_key_pem(self):
+        from cryptography.hazmat.primitives import serialization
+        return self._key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+
+# --- FIRMWARE DELIVERY ---
+# Stored images are immutable (content-addressed), so a hot image is opened
+# and memory-mapped once and its response headers are built once. Every
+# download of that image sends slices (memoryviews) of the same mapping, so
+# hundreds of concurrent readers share one copy of the image in the page
+# cache and no per-request open()/stat()/exists() happens. When the ASGI
+# server offers the "http.response.zerocopysend" extension (kernel sendfile)
+# the bytes never pass through Python at all; uvicorn over TLS does not, so
+# there the mmap path is used. Opening and mapping a cold image is disk work,
+# so it runs in the I/O pool (app/aio.py), and the kernel is asked to read
+# the image ahead so later sends don't fault pages in on the event loop.
+
+CHUNK_SIZE = 64 * 1024  # send granularity when sendfile isn't available
+MEDIA_TYPE = b"application/octet-stream"
+
+
+def _parse_range(header, size):
+    """Returns (start, end) inclusive for a single 'bytes=' range, or None if unsupported."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[6:].strip().partition("-")
+    try:
+        if start_s == "":  # suffix range: last N bytes
+            length = int(end_s)
+            if length <= 0:
+                raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+            return max(0, size - length), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+class HotImage:
+    __slots__ = ("digest", "size", "etag", "file", "view", "headers")
+
+    def __init__(self, digest, path):
+        self.digest = digest
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapping, "madvise"):
+                mapping.madvise(mmap.MADV_WILLNEED)
+            self.view = memoryview(mapping)
+        else:
+            # mmap of an empty file is not allowed; an empty view serves the same purpose
+            self.view = memoryview(b"")
+        self.etag = f'"{digest}"'
+        self.headers = [
+            (b"content-type", MEDIA_TYPE),
+            (b"etag", self.etag.encode()),
+            (b"accept-ranges", b"bytes"),
+            (b"cache-control", b"no-cache"),
+        ]
+
+
+class HotImageCache:
+    """LRU of memory-mapped images, keyed by digest."""
+
+    def __init__(self, max_images=4):
+        self.max_images = max_images
+        self._images = OrderedDict()
+
+    def get(self, digest):
+        """Blocking on a miss (startup); request handlers use load()."""
+        return self._lookup(digest) or self._add(HotImage(digest, OBJECTS_DIR / digest))
+
+    async def load(self, digest):
+        image = self._lookup(digest)
+        if image is None:
+            image = self._add(await run_io(HotImage, digest, OBJECTS_DIR / digest))
+        return image
+
+    def _lookup(self, digest):
+        image = self._images.get(digest)
+        if image is not None:
+            self._images.move_to_end(digest)
+        return image
+
+    def _add(self, image):
+        # Two requests may have mapped the same cold image; keep the first one
+        if image.digest in self._images:
+            return self._lookup(image.digest)
+        self._images[image.digest] = image
+        while len(self._images) > self.max_images:
+            # Responses still sending hold their own reference; the mapping
+            # is unmapped by the GC once the last of them finishes.
+            self._images.popitem(last=False)
+        return image
+
+    def cached_bytes(self):
+        return sum(image.size for image in self._images.values())
+
+    def clear(self):
+        self._images.clear()
+
+
+class DeliveryStats:
+    """Served-bytes counters with a per-second history for rates."""
+
+    def __init__(self, window=60):
+        self.bytes_total = 0
+        self.requests_total = 0
+        self.not_modified_total = 0
+        self.active = 0
+        self.zero_copy_total = 0
+        self._buckets = deque(maxlen=window)  # [second, bytes]
+
+    def add_bytes(self, n):
+        self.bytes_total += n
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += n
+        else:
+            self._buckets.append([now, n])
+
+    def rate(self, seconds=10):
+        """Average served bytes/sec over the last `seconds` complete seconds."""
+        now = int(time.monotonic())
+        total = sum(n for sec, n in self._buckets if now - seconds <= sec < now)
+        return total / seconds
+
+    def snapshot(self):
+        return {
+            "requests_total": self.requests_total,
+            "not_modified_total": self.not_modified_total,
+            "zero_copy_total": self.zero_copy_total,
+            "active_downloads": self.active,
+            "bytes_total": self.bytes_total,
+            "bytes_per_sec_10s": round(self.rate(10), 1),
+            "bytes_per_sec_60s": round(self.rate(60), 1),
+            "cached_images": len(hot_images._images),
+            "cached_bytes": hot_images.cached_bytes(),
+        }
+
+
+class ImageResponse(Response):
+    """ASGI response that sends a (range of a) hot image with prebuilt headers."""
+
+    def __init__(self, image, start=0, end=None, status_code=200):
+        self.image = image
+        self.start = start
+        self.end = image.size - 1 if end is None else end
+        self.status_code = status_code
+        self.background = None
+        length = self.end - self.start + 1 if image.size else 0
+        self.raw_headers = image.headers + [(b"content-length", str(length).encode())]
+        if status_code == 206:
+            self.raw_headers.append(
+                (b"content-range", f"bytes {self.start}-{self.end}/{image.size}".encode()))
+
+    async def __call__(self, scope, receive, send):
+        image = self.image
+        stats.requests_total += 1
+        stats.active += 1
+        try:
+            await send({"type": "http.response.start", "status": self.status_code,
+                        "headers": self.raw_headers})
+            if not image.size:
+                await send({"type": "http.response.body", "body": b""})
+                return
+            count = self.end - self.start + 1
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                stats.zero_copy_total += 1
+                await send({"type": "http.response.zerocopysend", "file": image.file,
+                            "offset": self.start, "count": count})
+                stats.add_bytes(count)
+                return
+            await self._send_view(receive, send, count)
+        finally:
+            stats.active -= 1
+
+    async def _send_view(self, receive, send, count):
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch())
+        try:
+            pos, stop = self.start, self.start + count
+            view = self.image.view
+            while pos < stop and not disconnected.is_set():
+                chunk = view[pos:min(pos + CHUNK_SIZE, stop)]  # no copy
+                pos += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": pos < stop})
+                stats.add_bytes(len(chunk))
+        finally:
+            watcher.cancel()
+
+
+async def serve_image(request, manifest):
+    """Response for an image download honouring If-None-Match and Range/If-Range."""
+    image = await hot_images.load(manifest["sha256"])
+    inm = request.headers.get("if-none-match")
+    if inm and image.etag in [t.strip() for t in inm.split(",")]:
+        stats.not_modified_total += 1
+        return Response(status_code=304, headers={"ETag": image.etag})
+
+    rng = _parse_range(request.headers.get("range"), image.size)
+    if_range = request.headers.get("if-range")
+    if rng is not None and (not if_range or if_range == image.etag):
+        return ImageResponse(image, rng[0], rng[1], status_code=206)
+    # Full body (also when If-Range no longer matches: the image changed)
+    return ImageResponse(image)
+
+
+repository = FirmwareRepository()
+hot_images = HotImageCache()
+stats = DeliveryStats()
+
+metrics.Counter("ota_firmware_bytes_served_total", "Firmware bytes sent to devices",
+                fn=lambda: stats.bytes_total)
+metrics.Counter("ota_firmware_requests_total", "Firmware download requests", fn=lambda: stats.requests_total)
+metrics.Gauge("ota_firmware_active_downloads", "Firmware downloads in progress", fn=lambda: stats.active)
\ No newline at end of file
@@ -0,0 +1,230 @@
+import asyncio
+import time
+from app.registry import INT_NONE
+from app.state import device_columns, log_event
+from app import events
+from app.config import get_ota_settings
+from app.versions import compare_versions
+
+try:
+    import numpy as np
+except ImportError:  # optional: the fleet scan is disabled without it
+    np = None
+
+# --- FLEET HEALTH SCAN ---
+# Per-sample checks (app/anomaly.py) only see one device. This background
+# job periodically copies the latest telemetry of every device into NumPy
+# columns and looks at the fleet as a whole:
+#   * cpu/mem/temp percentiles and anomaly rate per firmware version and
+#     per /24 subnet (one sort per metric, no per-device Python loop)
+#   * a robust outlier score per device (median/MAD z-score, max over metrics)
+#   * the updated cohort (on or above the target version) against the rest
+# and raises alerts such as "20% of devices on v2.1.5 are outliers".
+
+METRICS = ("cpu", "mem", "temp")
+FIELDS = METRICS + ("timestamp", "version", "ip", "is_stable")
+PERCENTILES = (0.5, 0.9, 0.99)
+_MIN_SCALE = {"cpu": 2.0, "mem": 1.0, "temp": 0.5}  # MAD floors (flat fleets)
+
+DEFAULTS = {
+    "interval": 15,          # seconds between scans
+    "stale_after": 600,      # ignore devices whose last sample is older than this
+    "outlier_z": 3.5,        # robust z-score above which a device is an outlier
+    "spike_fraction": 0.2,   # alert when this share of a version/subnet are outliers
+    "min_group": 5,          # smallest group/cohort worth judging
+    "regression_margin": 0.1,  # alert when updated cohort anomaly rate exceeds the rest by this
+    "top_outliers": 20,
+    "max_subnets": 50,
+}
+
+
+def _group_stats(keys, values, valid):
+    """Per-group percentiles of `values` (NaNs dropped): sort by value, then stably by group."""
+    k, v = keys[valid], values[valid]
+    if not len(k):
+        return np.array([], dtype=keys.dtype), {q: np.array([]) for q in PERCENTILES}
+    order = np.argsort(v)
+    order = order[np.argsort(k[order], kind="stable")]  # small int keys: radix sort
+    k, v = k[order], v[order]
+    groups, start, counts = np.unique(k, return_index=True, return_counts=True)
+    return groups, {q: v[start + np.floor(q * (counts - 1)).astype(np.int64)] for q in PERCENTILES}
+
+
+def _robust_z(x):
+    ok = ~np.isnan(x)
+    if not ok.any():
+        return np.zeros_like(x), 0.0, 1.0
+    med = float(np.median(x[ok]))
+    mad = float(np.median(np.abs(x[ok] - med))) * 1.4826
+    return x - med, med, mad
+
+
+def _summaries(labels, inverse, n_groups, cols, valid, anomalous, outlier, counts):
+    """Per-group dicts: size, anomaly/outlier rates and metric percentiles."""
+    anom = np.bincount(inverse, weights=anomalous, minlength=n_groups)
+    outl = np.bincount(inverse, weights=outlier, minlength=n_groups)
+    rows = [{"group": labels[g], "devices": int(counts[g]),
+             "anomaly_rate": round(float(anom[g] / counts[g]), 4),
+             "outlier_rate": round(float(outl[g] / counts[g]), 4)} for g in range(n_groups)]
+    for m in METRICS:
+        groups, pct = _group_stats(inverse, cols[m], valid[m])
+        for i, g in enumerate(groups):
+            rows[g][m] = {f"p{int(q * 100)}": round(float(pct[q][i]), 2) for q in PERCENTILES}
+    return rows
+
+
+def _cohort(mask, cols, anomalous, outlier):
+    n = int(mask.sum())
+    out = {"devices": n}
+    if not n:
+        return out
+    out["anomaly_rate"] = round(float(anomalous[mask].mean()), 4)
+    out["outlier_rate"] = round(float(outlier[mask].mean()), 4)
+    for m in METRICS:
+        x = cols[m][mask]
+        x = x[~np.isnan(x)]
+        if len(x):
+            out[m] = {"mean": round(float(x.mean()), 2), "p90": round(float(np.quantile(x, 0.9)), 2)}
+    return out
+
+
+def compute_health(raw, target, params, now=None):
+    """Fleet statistics from DeviceRegistry.export() columns (pure NumPy, no I/O)."""
+    t0 = time.perf_counter()
+    now = time.time() if now is None else now
+    ids = raw["device_id"]
+    strings = raw["strings"]
+
+    ts = np.frombuffer(raw["timestamp"], dtype=np.int64)
+    live = (ts != INT_NONE) & (ts >= now - params["stale_after"])
+    idx = np.flatnonzero(live)
+    cols = {m: np.frombuffer(raw[m], dtype=np.float64)[idx] for m in METRICS}
+    valid = {m: ~np.isnan(cols[m]) for m in METRICS}
+    stable = np.frombuffer(raw["is_stable"], dtype=np.int8)[idx]
+    anomalous = (stable == 0).astype(np.float64)
+    n = len(idx)
+
+    # --- OUTLIER SCORE: max robust z over metrics (upward deviations only) ---
+    score = np.zeros(n)
+    for m in METRICS:
+        dev, _, mad = _robust_z(cols[m])
+        z = np.nan_to_num(dev / max(mad, _MIN_SCALE[m]), nan=0.0)
+        np.maximum(score, z, out=score)
+    outlier = (score > params["outlier_z"]).astype(np.float64)
+
+    # --- PER VERSION ---
+    vcodes = np.frombuffer(raw["version"], dtype=np.uint32)[idx]
+    vgroups, vinv, vcounts = np.unique(vcodes, return_inverse=True, return_counts=True)
+    vnames = [strings[c] for c in vgroups]
+    versions = _summaries(vnames, vinv, len(vgroups), cols, valid, anomalous, outlier, vcounts)
+
+    # --- PER /24 SUBNET (non-IPv4 addresses grouped as "other") ---
+    ip = np.frombuffer(raw["ip"], dtype=np.int64)[idx]
+    subnet = np.where(ip >= 0, ip >> 8, -1)
+    sgroups, sinv, scounts = np.unique(subnet, return_inverse=True, return_counts=True)
+    snames = ["other" if s < 0 else
+              f"{s >> 16 & 255}.{s >> 8 & 255}.{s & 255}.0/24" for s in sgroups.tolist()]
+    subnets = _summaries(snames, sinv, len(sgroups), cols, valid, anomalous, outlier, scounts)
+    subnets.sort(key=lambda r: r["devices"], reverse=True)
+
+    # --- COHORTS: updated (>= target) vs not updated ---
+    updated_codes = np.array([compare_versions(v, target) >= 0 for v in vnames], dtype=bool)
+    updated = updated_codes[vinv] if n else np.zeros(0, dtype=bool)
+    cohorts = {"updated": _cohort(updated, cols, anomalous, outlier),
+               "not_updated": _cohort(~updated, cols, anomalous, outlier)}
+
+    # --- OUTLIERS ---
+    top = params["top_outliers"]
+    if n > top:
+        best = np.argpartition(-score, top)[:top]
+    else:
+        best = np.arange(n)
+    best = best[np.argsort(-score[best])]
+    outliers = [{"device_id": ids[idx[i]], "score": round(float(score[i]), 2),
+                 **{m: None if np.isnan(cols[m][i]) else round(float(cols[m][i]), 2) for m in METRICS}}
+                for i in best if score[i] > params["outlier_z"]]
+
+    # --- ALERTS ---
+    alerts = []
+    for kind, rows in (("version", versions), ("subnet", subnets)):
+        for r in rows:
+            if r["devices"] >= params["min_group"] and r["outlier_rate"] >= params["spike_fraction"]:
+                alerts.append({"kind": f"{kind}_spike", "group": r["group"], "devices": r["devices"],
+                               "outlier_rate": r["outlier_rate"]})
+    up, rest = cohorts["updated"], cohorts["not_updated"]
+    if up["devices"] >= params["min_group"] and rest["devices"] and \
+            up["anomaly_rate"] - rest["anomaly_rate"] > params["regression_margin"]:
+        alerts.append({"kind": "rollout_regression", "group": target, "devices": up["devices"],
+                       "anomaly_rate": up["anomaly_rate"], "baseline_rate": rest["anomaly_rate"]})
+
+    return {
+        "generated_at": now,
+        "compute_ms": round((time.perf_counter() - t0) * 1000, 2),
+        "devices": len(ids),
+        "reporting": n,
+        "anomaly_rate": round(float(anomalous.mean()), 4) if n else 0.0,
+        "outlier_rate": round(float(outlier.mean()), 4) if n else 0.0,
+        "target": target,
+        "alerts": alerts,
+        "cohorts": cohorts,
+        "versions": versions,
+        "subnets": subnets[:params["max_subnets"]],
+        "outliers": outliers,
+    }
+
+
+class FleetHealthMonitor:
+    def __init__(self):
+        self.params = dict(DEFAULTS)
+        self.latest = None
+        self._task = None
+        self._active_alerts = set()
+
+    @property
+    def available(self):
+        return np is not None
+
+    def configure(self, settings):
+        self.params = {**DEFAULTS, **{k: v for k, v in (settings or {}).items() if k in DEFAULTS}}
+
+    async def run_once(self):
+        # Copying the columns (one memcpy each) and crunching them both run
+        # in a worker thread, off the event loop.
+        target = get_ota_settings().target_firmware_version
+        params = self.params
+        report = await asyncio.to_thread(lambda: compute_health(device_columns(FIELDS), target, params))
+        if self._task is not None:  # only the process running the periodic scan raises alerts
+            self._log_alerts(report["alerts"])
+        self.latest = report
+        return report
+
+    def _log_alerts(self, alerts):
+        keys = {(a["kind"], a["group"]) for a in alerts}
+        for a in alerts:
+            if (a["kind"], a["group"]) not in self._active_alerts:
+                rate = a.get("outlier_rate", a.get("anomaly_rate"))
+                log_event(events.FLEET_ALERT, alert=a["kind"], group=a["group"], rate=rate,
+                          devices=a["devices"])
+        self._active_alerts = keys
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"⚠️ Fleet health scan failed: {e}")
+            await asyncio.sleep(self.params["interval"])
+
+    def start(self):
+        if not self.available:
+            print("⚠️ NumPy not installed: fleet health scan disabled")
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+monitor = FleetHealthMonitor()
@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from app import metrics
+from app.events import from_dict, to_dict
+from app.eventlog import DEFAULT_CAPACITY, upgrade_entries, append_archive, read_archive
+
+# --- WRITE-BEHIND STATE JOURNAL ---
+# Every state mutation is queued as one small record and appended to an
+# NDJSON journal by a background thread. Records are written in groups
+# (one write + fsync per batch), and the journal is periodically folded
+# into the JSON snapshot so that replay on startup stays short.
+#
+# OTA log entries are also appended to a separate NDJSON archive that is
+# never compacted; the snapshot only keeps the newest `log_capacity` of them.
+
+SAVE_SECONDS = metrics.SAVE_SECONDS.labels("json")
+SAVE_BYTES = metrics.SAVE_BYTES.labels("json")
+
+
+class StateJournal:
+    def __init__(self, snapshot_path, journal_path, flush_interval=0.2,
+                 max_batch=1000, compact_every=5000, fsync=True,
+                 archive_path=None, log_capacity=DEFAULT_CAPACITY):
+        self.snapshot_path = Path(snapshot_path)
+        self.journal_path = Path(journal_path)
+        self.archive_path = Path(archive_path) if archive_path else self.journal_path.with_suffix(".log")
+        self.log_capacity = log_capacity
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.compact_every = compact_every
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._fh = None
+        self._archive = None
+
+        self._seq = 0
+        self._pending = []          # ordered records (logs, counters)
+        self._pending_devices = {}  # coalesced device upserts: id -> record
+        self._since_compact = 0
+
+        # Shadow copy owned by the writer thread, used to build snapshots
+        # without touching the live (event loop) state.
+        self._shadow = {"devices": {}, "ota_log": deque(maxlen=log_capacity),
+                        "anomaly_count": 0, "seq": 0}
+
+    # --- LOADING ---
+    def load(self):
+        """Rebuilds state from the snapshot plus the journal tail."""
+        state = {"devices": {}, "ota_log": deque(maxlen=self.log_capacity), "anomaly_count": 0}
+        snap_seq = 0
+        if self.snapshot_path.exists():
+            try:
+                data = json.loads(self.snapshot_path.read_text())
+                state["devices"] = data.get("devices", {})
+                state["ota_log"].extend(upgrade_entries(data.get("ota_log", [])))
+                state["anomaly_count"] = data.get("anomaly_count", 0)
+                snap_seq = data.get("journal_seq", 0)
+            except Exception as e:
+                print(f"⚠️ Error reading snapshot: {e}")
+
+        seq = snap_seq
+        replayed = 0
+        if self.journal_path.exists():
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn tail from a crash mid-write
+                    if rec.get("seq", 0) <= snap_seq:
+                        continue
+                    _apply(state, rec)
+                    seq = max(seq, rec.get("seq", 0))
+                    replayed += 1
+
+        self._seq = seq
+        self._since_compact = replayed
+        self._shadow = {
+            "devices": dict(state["devices"]),
+            "ota_log": deque(state["ota_log"], maxlen=self.log_capacity),
+            "anomaly_count": state["anomaly_count"],
+            "seq": seq,
+        }
+        self._repair_archive(state["ota_log"])
+        return state
+
+    def _repair_archive(self, tail):
+        """Appends log entries the archive missed (crash between journal and archive write)."""
+        if not tail:
+            return
+        last = read_archive(self.archive_path, tail[-1]["seq"] - 1, 1)
+        if last and last[0].seq == tail[-1]["seq"]:
+            return
+        have = read_archive(self.archive_path, tail[0]["seq"] - 1, len(tail))
+        known = {e.seq for e in have}
+        missing = [e for e in tail if e["seq"] not in known]
+        with open(self.archive_path, "a", encoding="utf-8") as f:
+            append_archive(f, missing)
+
+    def read_log(self, since, limit, match=None):
+        """Archived events with seq > since (safe from any thread)."""
+        return read_archive(self.archive_path, since, limit, match)
+
+    # --- RECORDING (called from request handlers, O(1)) ---
+    def record(self, op, **fields):
+        with self._lock:
+            self._seq += 1
+            self._pending.append({"seq": self._seq, "op": op, **fields})
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def record_device(self, device_id, data):
+        # Only the latest upsert per device within a batch is written. `data`
+        # may be a live record; it is serialized by the writer at flush time.
+        with self._lock:
+            self._seq += 1
+            self._pending_devices[device_id] = {
+                "seq": self._seq, "op": "device", "id": device_id, "data": data
+            }
+            full = len(self._pending_devices) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    # --- BACKGROUND WRITER ---
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._fh = open(self.journal_path, "a", encoding="utf-8")
+        self._archive = open(self.archive_path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="state-journal", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._flush_pending()
+            except Exception as e:
+                print(f"⚠️ Error writing state journal: {e}")
+
+    def _flush_pending(self):
+        with self._io_lock:
+            self._write_batch()
+
+    def _write_batch(self):
+        with self._lock:
+            batch = self._pending + list(self._pending_devices.values())
+            self._pending = []
+            self._pending_devices = {}
+        if not batch:
+            return
+
+        for rec in batch:
+            if rec["op"] == "device" and not isinstance(rec["data"], dict):
+                rec["data"] = rec["data"].to_dict()
+
+        # Group commit: one write and one fsync for the whole batch
+        start = time.perf_counter()
+        payload = "".join(json.dumps(rec) + "\n" for rec in batch)
+        self._fh.write(payload)
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+        SAVE_BYTES.inc(len(payload))
+
+        entries = [rec["entry"] for rec in batch if rec["op"] == "log"]
+        if entries:
+            append_archive(self._archive, entries)
+            self._archive.flush()
+        SAVE_SECONDS.observe(time.perf_counter() - start)
+
+        for rec in batch:
+            _apply(self._shadow, rec)
+            self._shadow["seq"] = max(self._shadow["seq"], rec["seq"])
+        self._since_compact += len(batch)
+
+        if self._since_compact >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        """Folds the journal into a fresh snapshot, then truncates it."""
+        snapshot = {
+            "devices": self._shadow["devices"],
+            "ota_log": list(self._shadow["ota_log"]),
+            "anomaly_count": self._shadow["anomaly_count"],
+            "journal_seq": self._shadow["seq"],
+        }
+        tmp = self.snapshot_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(snapshot, indent=4))
+        os.replace(tmp, self.snapshot_path)
+
+        # A crash before this point is safe: replay skips seq <= journal_seq.
+        self._fh.close()
+        self._fh = open(self.journal_path, "w", encoding="utf-8")
+        self._since_compact = 0
+
+    def flush(self):
+        """Synchronously writes everything queued so far."""
+        if self._fh is None:
+            return
+        self._flush_pending()
+
+    def close(self):
+        """Stops the writer, drains the queue and compacts."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._fh is None:
+            return
+        self._flush_pending()
+        if self._since_compact:
+            self._compact()
+        self._fh.close()
+        self._fh = None
+        self._archive.close()
+        self._archive = None
+
+
+def _apply(state, rec):
+    op = rec.get("op")
+    if op == "device":
+        state["devices"][rec["id"]] = rec["data"]
+    elif op == "log":
+        entry = rec.get("entry")
+        if entry is None:  # journals written before log entries had sequence numbers
+            log = state["ota_log"]
+            entry = to_dict(from_dict(rec["msg"], (log[-1]["seq"] if log else 0) + 1))
+        state["ota_log"].append(entry)
+    elif op == "anomaly":
+        state["anomaly_count"] = rec["count"]
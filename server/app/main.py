@@ -1,6 +1,16 @@
 from fastapi import FastAPI
 from app.utils import setup_directories, load_json, CONFIG_DIR
 from app.routes import telemetry, admin, public
+from app.state import load_state, close_state
+from app.config import invalidate_all, start_watcher, stop_watcher
+from app import timeseries, metrics, aio, delta
+from app.firmware import repository
+from app.config import get_ota_settings
+from app.dispatcher import dispatcher
+from app.fleet import monitor as fleet_monitor, DEFAULTS as FLEET_DEFAULTS
+from app.cluster import cluster
+from app.profiling import ProfilingMiddleware, detector
+import asyncio
 import json
 
 app = FastAPI(title="IOTFW Secure OTA Server (Modular)")
@@ -10,19 +20,68 @@ app.include_router(telemetry.router)
 app.include_router(admin.router)
 app.include_router(public.router)
 
-# Event: On Startup
-@app.on_event("startup")
-async def startup_event():
+# Opt-in request profiling (config/profiling.json; a pass-through while disabled)
+app.add_middleware(ProfilingMiddleware)
+
+def prepare():
+    """Directories and default configs (run.py also calls this once before forking workers)."""
     setup_directories()
     
     # Create default config files if missing
     defaults = {
         "thresholds.json": {"global": {"cpu_threshold": 85.0, "mem_threshold": 90.0}},
         "devices.json": {"allowed_devices": ["iot-001", "iot-002", "sensor-03"]},
-        "ota_settings.json": {"target_firmware_version": "2.1.5"}
+        "ota_settings.json": {"target_firmware_version": "2.1.5"},
+        "storage.json": {"backend": "json", "sqlite_path": "data_store.db", "log_memory": 1000},
+        "timeseries.json": {"metrics": ["cpu", "mem", "temp", "disk_usage"],
+                            "raw_points": 120, "minute_points": 120, "hour_points": 168},
+        "fleet.json": FLEET_DEFAULTS,
+        "server.json": {"workers": 1},
+        "profiling.json": {"enabled": False, "sample_rate": 0.01, "budget_ms": 100, "cprofile": False, "keep": 50,
+                           "blocking_ms": 0}
     }
     for f, d in defaults.items():
         if not load_json(f): 
             (CONFIG_DIR / f).write_text(json.dumps(d, indent=4))
+    invalidate_all()
+
+# Event: On Startup
+@app.on_event("startup")
+async def startup_event():
+    # Disk work goes through the I/O pool, keeping the loop free (other workers may be serving)
+    await aio.run_io(prepare)
+    await aio.run_io(start_watcher)  # configs are re-checked from a thread from now on
+
+    # Open the configured storage backend and restore devices/logs
+    await aio.run_io(load_state)
+    timeseries.configure(await aio.run_io(load_json, "timeseries.json"))
+
+    # Index stored firmware and import any new loose images (hashing/signing happens here, once)
+    await aio.run_io(repository.load)
+
+    ota = get_ota_settings()
+    dispatcher.configure(ota.trigger_concurrency, ota.trigger_timeout, ota.trigger_retries)
+
+    # Periodic fleet-wide health scan (needs NumPy); with several workers only the leader runs it
+    fleet_monitor.configure(await aio.run_io(load_json, "fleet.json"))
+    cluster.on_elected(fleet_monitor.start)
+    await cluster.start()
+
+    # Event-loop lag for /metrics
+    app.state.lag_watcher = asyncio.create_task(metrics.watch_loop_lag())
+    # Stall detector heartbeat (idle unless profiling.json sets blocking_ms)
+    app.state.stall_heartbeat = asyncio.create_task(detector.heartbeat())
             
-    print("✅ Server Modules Loaded Successfully")
\ No newline at end of file
+    print("✅ Server Modules Loaded Successfully")
+
+# Event: On Shutdown
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.lag_watcher.cancel()
+    app.state.stall_heartbeat.cancel()
+    await cluster.stop()
+    await fleet_monitor.stop()
+    await dispatcher.close()
+    delta.cache.close()
+    close_state()
+    stop_watcher()
\ No newline at end of file
@@ -0,0 +1,191 @@
+import asyncio
+from bisect import bisect_left
+
+# --- METRICS ---
+# Counters, gauges and histograms served at /metrics in the Prometheus text
+# exposition format. Updating one is a dict lookup (labelled metrics) plus
+# an integer add, with no locks: each metric is only written by one thread
+# (the event loop, or the storage writer for the save metrics). Gauges can
+# instead read a value when scraped (fn=...).
+#
+# With several workers (app/cluster.py) each process keeps its own values
+# and publishes a snapshot to the database every few seconds. /metrics
+# merges them: counters and histograms are summed, gauges get a "worker"
+# label.
+
+REGISTRY = []
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SAVE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn  # read-on-scrape: () -> value, or {label tuple: value} when labelled
+        self._children = {}
+        if not self.labelnames:
+            self._default = self._children[()] = self._new()
+        REGISTRY.append(self)
+
+    def _new(self):
+        return _Value()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new()
+        return child
+
+    def samples(self):
+        """[(label values, state)]; state is a number, or [bucket counts..., sum] for histograms."""
+        if self.fn is not None:
+            value = self.fn()
+            return list(value.items()) if self.labelnames else [((), value)]
+        return [(labels, child.value) for labels, child in self._children.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self._default.value = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        return [(labels, b.counts + [b.sum]) for labels, b in self._children.items()]
+
+
+# --- INSTRUMENTS ---
+TELEMETRY_SAMPLES = Counter("ota_telemetry_samples_total", "Telemetry samples accepted", ("endpoint",))
+TELEMETRY_SECONDS = Histogram("ota_telemetry_ingest_seconds",
+                              "Server-side handling time of a telemetry request", ("endpoint",))
+WHITELIST_REJECTIONS = Counter("ota_whitelist_rejections_total",
+                               "Telemetry samples rejected by the device whitelist")
+EVENTS = Counter("ota_events_total",
+                 "OTA log events by kind (anomaly/recovery transitions, blocked/skipped OTAs, ...)",
+                 ("kind",))
+TRIGGERS = Counter("ota_triggers_total", "OTA triggers sent to devices, by outcome", ("outcome",))
+TRIGGER_SECONDS = Histogram("ota_trigger_seconds", "OTA trigger time including retries",
+                            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+SAVE_SECONDS = Histogram("ota_state_save_seconds", "Time to write one batch of state to disk",
+                         ("backend",), buckets=SAVE_BUCKETS)
+SAVE_BYTES = Counter("ota_state_save_bytes_total", "Bytes of state written to disk", ("backend",))
+LOOP_LAG = Histogram("ota_event_loop_lag_seconds", "How late the event loop woke up a sleeping task",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+# --- EXPOSITION ---
+def snapshot():
+    return {m.name: [[list(labels), state] for labels, state in m.samples()] for m in REGISTRY}
+
+
+def merge(snapshots):
+    """Combines per-worker snapshots ({pid: snapshot}) into one."""
+    merged = {}
+    for m in REGISTRY:
+        out = {}
+        for pid, snap in snapshots.items():
+            for labels, state in snap.get(m.name, ()):
+                if m.kind == "gauge":
+                    out[tuple(labels) + (str(pid),)] = state
+                elif m.kind == "histogram":
+                    prev = out.get(tuple(labels))
+                    out[tuple(labels)] = state if prev is None else [a + b for a, b in zip(prev, state)]
+                else:
+                    out[tuple(labels)] = out.get(tuple(labels), 0) + state
+        merged[m.name] = [[list(labels), state] for labels, state in out.items()]
+    return merged
+
+
+def _labels(names, values, extra=""):
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snap=None, merged=False):
+    """Text exposition format (merged=True: gauges carry the extra worker label)."""
+    snap = snapshot() if snap is None else snap
+    lines = []
+    for m in REGISTRY:
+        names = m.labelnames + (("worker",) if merged and m.kind == "gauge" else ())
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for labels, state in snap.get(m.name, ()):
+            if m.kind != "histogram":
+                lines.append(f"{m.name}{_labels(names, labels)} {_num(state)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(m.buckets + ("+Inf",), state[:-1]):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == "+Inf" else _num(float(bound)))
+                lines.append(f"{m.name}_bucket{_labels(names, labels, le)} {cumulative}")
+            lines.append(f"{m.name}_sum{_labels(names, labels)} {_num(state[-1])}")
+            lines.append(f"{m.name}_count{_labels(names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# --- EVENT LOOP LAG ---
+async def watch_loop_lag(interval=0.5):
+    """Sleeps `interval` over and over; any extra delay is time the loop spent busy."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
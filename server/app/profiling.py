@@ -0,0 +1,290 @@
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import asdict
+from app.config import get_profiling_settings
+from app.utils import BASE_DIR
+from app import metrics
+
+# --- REQUEST PROFILING ---
+# Opt-in via config/profiling.json ("enabled"). While it is on, the middleware
+# times every request and keeps the ones slower than budget_ms as slow traces
+# (served at /admin/profiling/slow):
+#   * a sampled fraction (sample_rate) also records per-stage timings from the
+#     stage()/mark() calls in the handlers. With "cprofile", a sampled request
+#     also runs under cProfile (one at a time). The profiler sees the whole
+#     event loop thread, so requests handled meanwhile show up in it too.
+#   * a watchdog thread samples the event loop thread's stack each time an
+#     in-flight request crosses another multiple of the budget. A handler that
+#     blocks the loop shows up there. A loop idle in select() means the request
+#     is waiting on I/O.
+# Separately, blocking_ms > 0 turns on the stall detector: a heartbeat task on
+# the loop and a thread that notices when it stops beating. Any call that
+# holds the loop longer than blocking_ms (sync disk I/O, heavy CPU work) is
+# reported with its stack at /admin/profiling/blocking and in the log.
+# The settings file is a cached config like thresholds.json, so edits (by hand
+# or through PUT /admin/profiling) apply within a second, in every worker.
+# Each worker keeps its own slow traces and stall reports.
+
+MAX_STACKS = 5       # stack samples per slow request
+STACK_DEPTH = 30
+PROFILE_LINES = 25   # functions listed from a cProfile capture
+
+SLOW_REQUESTS = metrics.Counter("ota_slow_requests_total", "Requests slower than the profiling budget")
+LOOP_STALLS = metrics.Counter("ota_event_loop_stalls_total", "Event-loop stalls longer than blocking_ms")
+
+_current = contextvars.ContextVar("profiling_trace", default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class Trace:
+    __slots__ = ("method", "path", "t0", "checkpoint", "ttfb", "status", "thread", "stages", "stacks")
+
+    def __init__(self, scope, sampled):
+        self.method = scope.get("method", "")
+        self.path = scope["path"]
+        self.t0 = self.checkpoint = time.perf_counter()
+        self.ttfb = None
+        self.status = None
+        self.thread = threading.get_ident()  # the event loop thread
+        self.stages = {} if sampled else None  # name -> [calls, seconds]
+        self.stacks = []  # [(seconds into the request, frames)]
+
+    def add(self, name, seconds):
+        entry = self.stages.get(name)
+        if entry is None:
+            self.stages[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+class _Stage:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.trace.add(self.name, end - self.start)
+        self.trace.checkpoint = end
+
+
+def stage(name):
+    """Times a block of the current request (a shared no-op unless it was sampled)."""
+    trace = _current.get()
+    return _NOOP if trace is None else _Stage(trace, name)
+
+
+def sample_stack(thread_id, frames=None):
+    """Another thread's current stack, innermost frame first (no source lines read from disk)."""
+    frame = (frames or sys._current_frames()).get(thread_id)
+    if frame is None:
+        return []
+    stack = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=STACK_DEPTH, lookup_lines=False)
+    return [f"{fs.filename}:{fs.lineno} in {fs.name}" for fs in stack]
+
+
+def mark(name):
+    """Records the time since the request started (or the last stage ended) as a stage."""
+    trace = _current.get()
+    if trace is not None:
+        now = time.perf_counter()
+        trace.add(name, now - trace.checkpoint)
+        trace.checkpoint = now
+
+
+class Profiler:
+    def __init__(self):
+        self.slow = deque(maxlen=50)
+        self.inflight = {}  # id(trace) -> trace, read by the watchdog thread
+        self.counts = {"requests": 0, "sampled": 0, "profiled": 0, "slow": 0}
+        self._profiling = False
+        self._watchdog = None
+
+    async def run(self, settings, app, scope, receive, send):
+        trace = Trace(scope, random.random() < settings.sample_rate)
+        self.counts["requests"] += 1
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="profiling-watchdog", daemon=True)
+            self._watchdog.start()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                trace.ttfb = time.perf_counter() - trace.t0
+            await send(message)
+
+        token = prof = None
+        if trace.stages is not None:
+            self.counts["sampled"] += 1
+            token = _current.set(trace)
+            if settings.cprofile and not self._profiling:
+                self._profiling = True
+                self.counts["profiled"] += 1
+                prof = cProfile.Profile()
+                prof.enable()
+        self.inflight[id(trace)] = trace
+        try:
+            await app(scope, receive, timed_send)
+        finally:
+            total = time.perf_counter() - trace.t0
+            del self.inflight[id(trace)]
+            if prof is not None:
+                prof.disable()
+                self._profiling = False
+            if token is not None:
+                _current.reset(token)
+            if total * 1000 > settings.budget_ms:
+                self._keep(settings, trace, total, prof)
+
+    def _keep(self, settings, trace, total, prof):
+        self.counts["slow"] += 1
+        SLOW_REQUESTS.inc()
+        if self.slow.maxlen != settings.keep:
+            self.slow = deque(self.slow, maxlen=settings.keep)
+        stages = None
+        if trace.stages is not None:
+            stages = [{"stage": name, "calls": calls, "ms": round(seconds * 1000, 3)}
+                      for name, (calls, seconds) in trace.stages.items()]
+        self.slow.append({
+            "started_at": time.time() - total,
+            "worker": os.getpid(),
+            "method": trace.method,
+            "path": trace.path,
+            "status": trace.status,
+            "total_ms": round(total * 1000, 2),
+            "ttfb_ms": round(trace.ttfb * 1000, 2) if trace.ttfb is not None else None,
+            "budget_ms": settings.budget_ms,
+            "stages": stages,
+            "stacks": [{"at_ms": round(at * 1000, 1), "frames": frames} for at, frames in trace.stacks],
+            "profile": _format_profile(prof) if prof is not None else None,
+        })
+
+    def _watch(self):
+        # Runs while profiling is enabled; the middleware starts a new one when needed
+        while True:
+            settings = get_profiling_settings()
+            if not settings.enabled:
+                self._watchdog = None
+                return
+            budget = settings.budget_ms / 1000
+            now = time.perf_counter()
+            frames = None
+            for trace in list(self.inflight.values()):
+                taken = len(trace.stacks)
+                elapsed = now - trace.t0
+                if taken >= MAX_STACKS or elapsed < budget * (taken + 1):
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                trace.stacks.append((elapsed, sample_stack(trace.thread, frames)))
+            frames = None  # don't keep the other threads' frames alive while sleeping
+            time.sleep(min(0.05, budget / 4))
+
+    def recent(self, limit=20):
+        """Slow traces, newest first."""
+        return list(reversed(self.slow))[:limit]
+
+    def clear(self):
+        self.slow.clear()
+
+    def describe(self):
+        return {"settings": asdict(get_profiling_settings()), "worker": os.getpid(),
+                "in_flight": len(self.inflight), "kept": len(self.slow), "counts": dict(self.counts),
+                "stalls": len(detector.reports)}
+
+
+class BlockingDetector:
+    """Reports calls that hold the event loop longer than blocking_ms, with their stack."""
+
+    def __init__(self):
+        self.reports = deque(maxlen=50)
+        self.beat = 0.0
+        self.interval = 0.0
+        self.loop_thread = None
+        self._thread = None
+
+    async def heartbeat(self):
+        # Runs on the loop for the server's lifetime; idles while the detector is off
+        self.loop_thread = threading.get_ident()
+        while True:
+            limit = get_profiling_settings().blocking_ms / 1000
+            if not limit:
+                await asyncio.sleep(1.0)
+                continue
+            self.interval = max(0.005, limit / 4)
+            self.beat = time.perf_counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="stall-detector", daemon=True)
+                self._thread.start()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        stalled_beat = stack = None
+        while True:
+            limit = get_profiling_settings().blocking_ms / 1000
+            if not limit:
+                self._thread = None
+                return
+            beat, interval = self.beat, self.interval
+            late = time.perf_counter() - beat - interval
+            if stalled_beat is None and late > limit:
+                # The loop missed its heartbeat by more than the limit: see what it is running
+                stalled_beat, stack = beat, sample_stack(self.loop_thread)
+            elif stalled_beat is not None and beat != stalled_beat:
+                self._report(beat - stalled_beat - interval, limit, stack)
+                stalled_beat = stack = None
+            time.sleep(min(0.01, limit / 2))
+
+    def _report(self, blocked, limit, stack):
+        LOOP_STALLS.inc()
+        app_dir = str(BASE_DIR / "app")
+        culprit = next((f for f in stack if f.startswith(app_dir)), stack[0] if stack else "?")
+        self.reports.append({"at": time.time(), "worker": os.getpid(), "blocked_ms": round(blocked * 1000, 1),
+                             "limit_ms": round(limit * 1000, 1), "culprit": culprit, "stack": stack})
+        print(f"🐌 Event loop blocked for {blocked * 1000:.0f} ms (limit {limit * 1000:.0f} ms) at {culprit}")
+
+    def recent(self, limit=20):
+        """Stall reports, newest first."""
+        return list(reversed(self.reports))[:limit]
+
+
+def _format_profile(prof):
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return [line.rstrip() for line in out.getvalue().splitlines() if line.strip()]
+
+
+profiler = Profiler()
+detector = BlockingDetector()
+
+
+class ProfilingMiddleware:
+    """Plain ASGI middleware (cheaper than BaseHTTPMiddleware); a pass-through while disabled."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        settings = get_profiling_settings()
+        if not settings.enabled or scope["path"].startswith(settings.exclude):
+            return await self.app(scope, receive, send)
+        await profiler.run(settings, self.app, scope, receive, send)
\ No newline at end of file
@@ -0,0 +1,238 @@
+import math
+import socket
+from array import array
+
+# --- COMPACT DEVICE REGISTRY ---
+# Struct-of-arrays: each known field is one typed array column and a device
+# is a row index (device_id -> slot). Telemetry updates write the columns in
+# place, so no per-device dict or boxed float/int objects are kept alive.
+# Repeated strings (versions, statuses, last_seen) are stored once in a
+# string table and referenced by a 4-byte code; IPv4 addresses are packed
+# into an integer column. An int that doesn't fit its int64 column is kept
+# boxed with the unknown keys instead. Interned strings are never freed, so
+# only fields with a small set of values belong in STR_FIELDS; free text
+# (e.g. anomaly_reason) stays with the unknown keys, where setting it to
+# None drops it.
+
+FLOAT_FIELDS = ("cpu", "mem", "temp", "disk_usage", "net_sent_mb", "net_recv_mb")
+INT_FIELDS = ("timestamp", "ota_port", "boot_time", "cpu_cores")
+STR_FIELDS = ("version", "last_seen", "status")
+ADDR_FIELDS = ("ip",)
+BOOL_FIELDS = ("is_stable",)
+
+# Output order matches the dicts the telemetry route used to store
+FIELDS = (
+    "device_id", "cpu", "mem", "temp", "version", "timestamp", "ota_port",
+    "disk_usage", "net_sent_mb", "net_recv_mb", "boot_time", "cpu_cores",
+    "ip", "last_seen", "status", "is_stable",
+)
+
+_NAN = float("nan")
+_INT_NONE = -(2 ** 63)  # sentinel for "missing" in int columns
+INT_NONE = _INT_NONE
+_KIND = {f: "f" for f in FLOAT_FIELDS}
+_KIND.update({f: "i" for f in INT_FIELDS})
+_KIND.update({f: "s" for f in STR_FIELDS})
+_KIND.update({f: "b" for f in BOOL_FIELDS})
+_KIND.update({f: "a" for f in ADDR_FIELDS})
+
+
+class DeviceView:
+    """Read-only, dict-like window onto one registry row."""
+    __slots__ = ("_reg", "_slot")
+
+    def __init__(self, registry, slot):
+        self._reg = registry
+        self._slot = slot
+
+    def get(self, key, default=None):
+        value = self._reg._read(self._slot, key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self._reg._read(self._slot, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def to_dict(self):
+        reg, slot = self._reg, self._slot
+        d = {f: reg._read(slot, f) for f in FIELDS}
+        extra = reg._extra.get(slot)
+        if extra:
+            d.update(extra)
+        return d
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self._slots = {}   # device_id -> row index
+        self._ids = []     # row index -> device_id
+        self._cols = {}
+        for f in FLOAT_FIELDS:
+            self._cols[f] = array("d")
+        for f in INT_FIELDS:
+            self._cols[f] = array("q")
+        for f in STR_FIELDS:
+            self._cols[f] = array("I")
+        for f in BOOL_FIELDS:
+            self._cols[f] = array("b")
+        for f in ADDR_FIELDS:
+            self._cols[f] = array("q")  # >= 0: IPv4, < 0: -string code
+        self._strings = [None]   # code -> string (0 = missing)
+        self._codes = {None: 0}  # string -> code
+        self._extra = {}         # row index -> dict, only for unknown keys
+
+    # --- WRITES ---
+    def _code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._strings)
+            self._strings.append(value)
+            self._codes[value] = code
+        return code
+
+    def _new_slot(self, device_id):
+        slot = len(self._ids)
+        self._ids.append(device_id)
+        self._slots[device_id] = slot
+        for f, col in self._cols.items():
+            kind = _KIND[f]
+            col.append(_NAN if kind == "f" else 0 if kind == "s" else
+                       -1 if kind == "b" else _INT_NONE)
+        return slot
+
+    def upsert(self, device_id, fields):
+        slot = self._slots.get(device_id)
+        if slot is None:
+            slot = self._new_slot(device_id)
+        cols = self._cols
+        for key, value in fields.items():
+            kind = _KIND.get(key)
+            if kind == "f":
+                cols[key][slot] = _NAN if value is None else value
+            elif kind == "i":
+                try:
+                    cols[key][slot] = _INT_NONE if value is None else value
+                except (OverflowError, TypeError):
+                    cols[key][slot] = _INT_NONE
+                    self._extra.setdefault(slot, {})[key] = value
+                    continue
+                if slot in self._extra:
+                    self._extra[slot].pop(key, None)
+            elif kind == "s":
+                cols[key][slot] = self._code(value)
+            elif kind == "b":
+                cols[key][slot] = -1 if value is None else int(bool(value))
+            elif kind == "a":
+                cols[key][slot] = self._pack_addr(value)
+            elif key != "device_id":
+                if value is not None:
+                    self._extra.setdefault(slot, {})[key] = value
+                elif slot in self._extra:
+                    extra = self._extra[slot]
+                    extra.pop(key, None)
+                    if not extra:
+                        del self._extra[slot]
+        return DeviceView(self, slot)
+
+    def _pack_addr(self, value):
+        if value is None:
+            return _INT_NONE
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, value), "big")
+        except (OSError, TypeError):
+            # IPv6 / hostnames (e.g. test clients) go through the string table
+            return -self._code(value)
+
+    def _unpack_addr(self, v):
+        if v == _INT_NONE:
+            return None
+        if v < 0:
+            return self._strings[-v]
+        return socket.inet_ntop(socket.AF_INET, v.to_bytes(4, "big"))
+
+    # --- READS ---
+    def _read(self, slot, key):
+        kind = _KIND.get(key)
+        if kind == "f":
+            v = self._cols[key][slot]
+            return None if math.isnan(v) else v
+        if kind == "i":
+            v = self._cols[key][slot]
+            return self._extra.get(slot, {}).get(key) if v == _INT_NONE else v
+        if kind == "s":
+            return self._strings[self._cols[key][slot]]
+        if kind == "b":
+            v = self._cols[key][slot]
+            return None if v < 0 else bool(v)
+        if kind == "a":
+            return self._unpack_addr(self._cols[key][slot])
+        if key == "device_id":
+            return self._ids[slot]
+        return self._extra.get(slot, {}).get(key)
+
+    def get(self, device_id):
+        slot = self._slots.get(device_id)
+        return None if slot is None else DeviceView(self, slot)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, device_id):
+        return device_id in self._slots
+
+    def column(self, field):
+        """Decoded values of one field for every row, in slot order."""
+        kind = _KIND.get(field)
+        raw = self._cols[field].tolist() if kind else None
+        if kind == "f":
+            return [None if v != v else v for v in raw]
+        if kind == "i":
+            extra = self._extra
+            return [extra.get(i, {}).get(field) if v == _INT_NONE else v for i, v in enumerate(raw)]
+        if kind == "s":
+            strings = self._strings
+            return [strings[c] for c in raw]
+        if kind == "b":
+            return [None if v < 0 else bool(v) for v in raw]
+        if kind == "a":
+            unpack = self._unpack_addr
+            return [unpack(v) for v in raw]
+        if field == "device_id":
+            return list(self._ids)
+        return [self._extra.get(i, {}).get(field) for i in range(len(self._ids))]
+
+    def export(self, fields):
+        """Copies of the raw columns for bulk (e.g. NumPy) analysis.
+
+        Floats use NaN and ints INT_NONE for missing (or oversized) values; string fields
+        are codes into the returned "strings" table; ip is packed IPv4 (or a
+        negated string code); is_stable is 1/0/-1 (missing).
+
+        Safe to call from a worker thread while the loop keeps writing: rows
+        added mid-copy are cut off so every column has the same length, and
+        ids and strings are copied last so they cover every copied row and
+        code. A row updated mid-copy may mix old and new values.
+        """
+        out = {f: self._cols[f][:] for f in fields}  # array slice: one memcpy each
+        strings, ids = list(self._strings), list(self._ids)
+        n = min([len(ids)] + [len(col) for col in out.values()])
+        for f, col in out.items():
+            if len(col) > n:
+                out[f] = col[:n]
+        out["device_id"] = ids[:n]
+        out["strings"] = strings
+        return out
+
+    def to_dict(self):
+        """Serializes the whole fleet column by column (no per-field lookups)."""
+        columns = [self.column(f) for f in FIELDS]
+        out = {}
+        for slot, row in enumerate(zip(*columns)):
+            d = dict(zip(FIELDS, row))
+            extra = self._extra.get(slot)
+            if extra:
+                d.update(extra)
+            out[row[0]] = d
+        return out
@@ -0,0 +1,332 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import time
+from app.state import device_ids, device_known, get_device, log_event, version_index
+from app import events
+from app.services import trigger_device_update
+from app.config import get_whitelist
+from app.firmware import repository
+from app.cluster import cluster
+
+# --- STAGED ROLLOUT ENGINE ---
+# A rollout selects a set of devices, splits them into waves and triggers
+# each wave with a cap on concurrent triggers and an optional download
+# bandwidth budget. Between waves the anomaly rate of the already-updated
+# cohort is checked and the rollout pauses itself if it is too high.
+#
+# With several server workers only the leader (app/cluster.py) runs
+# rollouts: other workers forward commands to it and read progress from the
+# snapshot it publishes to the database.
+
+RUNNING, PAUSED, HALTED, COMPLETED, CANCELLED = "running", "paused", "halted", "completed", "cancelled"
+
+
+def _bucket(device_id):
+    # Stable 0-99 bucket so "percentage" selects the same devices every time
+    return int.from_bytes(hashlib.sha1(device_id.encode()).digest()[:4], "big") % 100
+
+
+def parse_percentage(value):
+    """The value of a "percentage" selector as a float in (0, 100]; ValueError otherwise."""
+    try:
+        pct = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Percentage selector needs a numeric value between 0 and 100") from None
+    if not 0 < pct <= 100:
+        raise ValueError("Percentage selector needs a numeric value between 0 and 100")
+    return pct
+
+
+def select_devices(selector, target_version=None):
+    """Resolves a selector to a sorted list of device ids (from the indexes, no records read)."""
+    kind = selector.get("type", "all")
+    value = selector.get("value")
+
+    if kind == "all":
+        ids = device_ids()
+    elif kind == "version":
+        # Exact ("2.0.3") or wildcard ("2.0.x", "2.x") via the version index
+        if value is None:
+            raise ValueError("Version selector needs a value")
+        ids = version_index.matching(str(value))
+    elif kind == "below":
+        ids = version_index.below(str(value) if value is not None else target_version)
+    elif kind == "tag":
+        tagged = get_whitelist().tagged(value)
+        ids = [did for did in tagged if device_known(did)]
+    elif kind == "percentage":
+        pct = parse_percentage(value)
+        ids = [did for did in device_ids() if _bucket(did) < pct]
+    else:
+        raise ValueError(f"Unknown selector type '{kind}'")
+    return sorted(ids)
+
+
+class Rollout:
+    _ids = itertools.count(1)
+
+    def __init__(self, target_version, selector, device_ids, wave_size=50, max_in_flight=20,
+                 bandwidth_budget_kbps=None, wave_interval=30.0, anomaly_threshold=0.2,
+                 min_cohort=5):
+        self.id = next(self._ids)
+        self.target_version = target_version
+        self.selector = selector
+        self.device_ids = device_ids
+        self.wave_size = max(1, wave_size)
+        self.max_in_flight = max(1, max_in_flight)
+        self.bandwidth_budget_kbps = bandwidth_budget_kbps
+        self.wave_interval = wave_interval
+        self.anomaly_threshold = anomaly_threshold
+        self.min_cohort = min_cohort
+
+        self.status = RUNNING
+        self.reason = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.wave = 0
+        self.waves_total = (len(device_ids) + self.wave_size - 1) // self.wave_size
+        self.in_flight = 0
+        self.counts = {"succeeded": 0, "failed": 0, "skipped": 0, "blocked": 0}
+        self.updated = []  # devices whose trigger succeeded (the watched cohort)
+        self.anomaly_rate = 0.0
+        self.bytes_scheduled = 0
+
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._task = None
+
+    # --- CONTROL ---
+    def pause(self, reason="Paused by admin"):
+        if self.status == RUNNING:
+            self.status, self.reason = PAUSED, reason
+            self._resume.clear()
+
+    def resume(self):
+        if self.status not in (PAUSED, HALTED):
+            return
+        if self._task is not None and self._task.done():
+            # Halted after the final wave: run() has exited and no device is left,
+            # so resuming accepts the verdict and closes the rollout
+            self._complete()
+            return
+        self.status, self.reason = RUNNING, None
+        self._resume.set()
+
+    def cancel(self):
+        if self.status in (RUNNING, PAUSED, HALTED):
+            self.status, self.reason = CANCELLED, "Cancelled by admin"
+            self.finished_at = time.time()
+            self._resume.set()
+            if self._task:
+                self._task.cancel()
+
+    # --- EXECUTION ---
+    async def _image_size(self):
+        manifest = await repository.lookup(self.target_version)
+        return manifest["size"] if manifest else 0
+
+    def _check_cohort(self):
+        """Fraction of updated devices currently flagged unstable."""
+        if len(self.updated) < self.min_cohort:
+            return False
+        unstable = 0
+        for did in self.updated:
+            dev = get_device(did)
+            if dev is not None and not dev.get("is_stable", True):
+                unstable += 1
+        self.anomaly_rate = unstable / len(self.updated)
+        return self.anomaly_rate > self.anomaly_threshold
+
+    async def _update_one(self, device_id, sem):
+        async with sem:
+            await self._resume.wait()
+            if self.status == CANCELLED:
+                return
+            dev = get_device(device_id)
+            if dev is None or not dev.get("ip"):
+                self.counts["skipped"] += 1
+                return
+            if not dev.get("is_stable", True):
+                # Same security gating as a manual deploy
+                log_event(events.OTA_BLOCKED, device=device_id, reason="high_load", rollout=self.id)
+                self.counts["blocked"] += 1
+                return
+            self.in_flight += 1
+            try:
+                result = await trigger_device_update(device_id, dev["ip"], self.target_version)
+            finally:
+                self.in_flight -= 1
+            if result is None:
+                self.counts["skipped"] += 1
+            elif result["outcome"] == "success":
+                self.counts["succeeded"] += 1
+                self.updated.append(device_id)
+            else:
+                self.counts["failed"] += 1
+
+    async def _pace(self, image_size):
+        # Bandwidth budget: space triggers so that expected downloads
+        # (one image per triggered device) stay under the budget.
+        if self.bandwidth_budget_kbps and image_size:
+            await asyncio.sleep(image_size / (self.bandwidth_budget_kbps * 1024))
+
+    async def run(self):
+        log_event(events.ROLLOUT_STARTED, to_version=self.target_version, rollout=self.id,
+                  devices=len(self.device_ids), waves=self.waves_total)
+        image_size = await self._image_size()
+        sem = asyncio.Semaphore(self.max_in_flight)
+        try:
+            for start in range(0, len(self.device_ids), self.wave_size):
+                await self._resume.wait()
+                if self.status == CANCELLED:
+                    return
+                self.wave += 1
+                tasks = []
+                for device_id in self.device_ids[start:start + self.wave_size]:
+                    await self._resume.wait()
+                    tasks.append(asyncio.create_task(self._update_one(device_id, sem)))
+                    self.bytes_scheduled += image_size
+                    await self._pace(image_size)
+                await asyncio.gather(*tasks)
+
+                # Let updated devices report telemetry before judging the cohort
+                # (the final wave too: its health gate decides the verdict)
+                await asyncio.sleep(self.wave_interval)
+                if self._check_cohort():
+                    self.status = HALTED
+                    self.reason = (f"Anomaly rate {self.anomaly_rate:.0%} in updated cohort "
+                                   f"exceeds {self.anomaly_threshold:.0%}")
+                    self._resume.clear()
+                    log_event(events.ROLLOUT_HALTED, to_version=self.target_version, rollout=self.id,
+                              reason=self.reason, anomaly_rate=self.anomaly_rate)
+
+            self.finished_at = time.time()
+            if self.status == HALTED:
+                return  # halted after the final wave: leave the verdict visible (resume() completes it)
+            self._complete()
+        except asyncio.CancelledError:
+            log_event(events.ROLLOUT_CANCELLED, to_version=self.target_version, rollout=self.id)
+
+    def _complete(self):
+        self.status, self.reason = COMPLETED, None
+        log_event(events.ROLLOUT_COMPLETED, to_version=self.target_version, rollout=self.id,
+                  succeeded=self.counts["succeeded"], failed=self.counts["failed"],
+                  blocked=self.counts["blocked"])
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self
+
+    # --- REPORTING ---
+    def progress(self):
+        end = self.finished_at or time.time()
+        elapsed = max(end - self.created_at, 1e-6)
+        done = sum(self.counts.values())
+        return {
+            "id": self.id,
+            "status": self.status,
+            "reason": self.reason,
+            "target_version": self.target_version,
+            "selector": self.selector,
+            "devices_total": len(self.device_ids),
+            "devices_done": done,
+            "in_flight": self.in_flight,
+            "wave": self.wave,
+            "waves_total": self.waves_total,
+            **self.counts,
+            "cohort_anomaly_rate": round(self.anomaly_rate, 3),
+            "elapsed_s": round(elapsed, 1),
+            "throughput_devices_per_min": round(done / elapsed * 60, 2),
+            "scheduled_download_bytes": self.bytes_scheduled,
+        }
+
+
+class RolloutManager:
+    def __init__(self):
+        self.rollouts = {}
+        cluster.handle_commands(self.execute)
+        cluster.on_elected(self.adopt)
+        cluster.on_leader_tick(self.publish)
+
+    def create(self, target_version, selector, **options):
+        device_ids = select_devices(selector, target_version)
+        rollout = Rollout(target_version, selector, device_ids, **options)
+        self.rollouts[rollout.id] = rollout
+        return rollout.start()
+
+    def get(self, rollout_id):
+        return self.rollouts.get(rollout_id)
+
+    def all(self):
+        return list(self.rollouts.values())
+
+    # --- COMMANDS (run here, or on the leader via the cluster queue) ---
+    def execute(self, action, rollout_id=None, payload=None):
+        if action == "create":
+            rollout = self.create(payload["target_version"], payload["selector"], **payload["options"])
+        elif action in ("pause", "resume", "cancel"):
+            rollout = self.get(rollout_id)
+            if rollout is None:
+                raise LookupError("Rollout not found")
+            getattr(rollout, action)()
+        else:
+            raise ValueError(f"Unknown rollout action '{action}'")
+        return rollout.progress()
+
+    async def submit(self, action, rollout_id=None, payload=None):
+        if cluster.shared:
+            return await cluster.call(action, rollout_id, payload)
+        return self.execute(action, rollout_id, payload)
+
+    async def describe(self, rollout_id=None):
+        """Progress of one rollout (LookupError if unknown), or of all of them."""
+        if cluster.shared and not cluster.is_leader:
+            found = await asyncio.to_thread(cluster.read_rollouts, rollout_id)
+        elif rollout_id is None:
+            found = [r.progress() for r in self.all()]
+        else:
+            found = [self.rollouts[rollout_id].progress()] if rollout_id in self.rollouts else []
+        if rollout_id is None:
+            return found
+        if not found:
+            raise LookupError("Rollout not found")
+        return found[0]
+
+    # --- SHARED MODE (leader only) ---
+    def publish(self, db):
+        """Leader tick: writes every rollout's progress where the other workers read it."""
+        now = time.time()
+        db.executemany(
+            "INSERT INTO cluster_rollouts (id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            [(r.id, json.dumps(r.progress()), now) for r in self.all()])
+
+    async def adopt(self):
+        """On election: rollouts a previous leader was running cannot be resumed here."""
+        if not cluster.shared:
+            return
+        for p in await asyncio.to_thread(self._halt_orphans):
+            log_event(events.ROLLOUT_HALTED, to_version=p["target_version"], rollout=p["id"],
+                      reason=p["reason"])
+
+    def _halt_orphans(self):
+        # Worker thread: marks the previous leader's unfinished rollouts halted, returns them
+        previous = cluster.read_rollouts()
+        Rollout._ids = itertools.count(max((p["id"] for p in previous), default=0) + 1)
+        orphaned = [p for p in previous if p["status"] in (RUNNING, PAUSED)]
+        if not orphaned:
+            return []
+        for p in orphaned:
+            p["status"], p["reason"], p["in_flight"] = HALTED, "Leader changed; create a new rollout", 0
+        conn = cluster.connect()
+        try:
+            conn.executemany("UPDATE cluster_rollouts SET data = ?, updated_at = ? WHERE id = ?",
+                             [(json.dumps(p), time.time(), p["id"]) for p in orphaned])
+        finally:
+            conn.close()
+        return orphaned
+
+
+manager = RolloutManager()
@@ -1,32 +1,202 @@
 import asyncio
-from fastapi import APIRouter, HTTPException
-from app.state import devices, ota_log
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Union
+from fastapi import APIRouter, HTTPException, Query, Request
+from pydantic import BaseModel, Field, model_validator
+from app.state import get_device, log_event, version_index
+from app import events
 from app.services import trigger_device_update
-from app.utils import load_json
+from app.config import get_ota_settings, get_profiling_settings, profiling as profiling_config
+from app.dispatcher import dispatcher
+from app.rollouts import manager as rollouts, parse_percentage
+from app.cluster import CommandError
+from app.firmware import repository, STORE_DIR
+from app.delta import valid_version, cache as delta_cache
+from app.versions import compare_versions
+from app.profiling import profiler, detector
+from app.aio import run_io
+from app.utils import load_json, CONFIG_DIR
 
 # Initialize the Router (This was likely missing or named wrong)
 router = APIRouter()
 
+# Keep references to fire-and-forget trigger tasks so they aren't GC'd mid-flight
+_trigger_tasks = set()
+
 @router.post("/admin/deploy/{device_id}")
 async def deploy_ota_manual(device_id: str):
-    device = devices.get(device_id)
+    device = get_device(device_id)
     if not device: raise HTTPException(404, "Device not found")
 
     # Security Check
     if not device.get("is_stable", True):
-        msg = f"🛑 BLOCKED → OTA for {device_id} rejected (Risk: High Load)"
-        ota_log.append(msg)
+        log_event(events.OTA_BLOCKED, device=device_id, reason="high_load")
         return {"status": "blocked", "reason": "Anomaly Detected"}
 
     # Version Check
-    ota_settings = load_json("ota_settings.json", {"target_firmware_version": "2.1.5"})
-    target_ver = ota_settings.get("target_firmware_version", "2.1.5")
+    target_ver = get_ota_settings().target_firmware_version
     
-    if device.get("version") == target_ver:
+    if compare_versions(device.get("version"), target_ver) == 0:
          return {"status": "skipped", "reason": f"Device already on v{target_ver}"}
 
-    msg = f"🚀 DEPLOYING → {device_id} (Stable). Sending trigger..."
-    ota_log.append(msg)
-    asyncio.create_task(trigger_device_update(device_id, device["ip"]))
+    log_event(events.OTA_DEPLOY, device=device_id, from_version=device.get("version"), to_version=target_ver)
+    task = asyncio.create_task(trigger_device_update(device_id, device["ip"]))
+    _trigger_tasks.add(task)
+    task.add_done_callback(_trigger_tasks.discard)
     
-    return {"status": "initiated", "target_ip": device["ip"], "target_ver": target_ver}
\ No newline at end of file
+    return {"status": "initiated", "target_ip": device["ip"], "target_ver": target_ver}
+
+@router.get("/admin/ota/results")
+async def get_trigger_results(limit: int = Query(50, ge=1, le=1000)):
+    """Most recent structured OTA trigger results (newest last)."""
+    results = list(dispatcher.results)
+    return {"in_flight": len(_trigger_tasks), "results": results[-limit:]}
+
+# --- FLEET ROLLOUTS ---
+class RolloutSelector(BaseModel):
+    type: str = "all"                       # all | version (e.g. "2.0.x") | below | tag | percentage
+    value: Optional[Union[float, str]] = None
+
+    @model_validator(mode="after")
+    def _check_value(self):
+        if self.type == "percentage":
+            self.value = parse_percentage(self.value)
+        elif self.type in ("version", "tag") and self.value is None:
+            raise ValueError(f"'{self.type}' selector needs a value")
+        return self
+
+class RolloutRequest(BaseModel):
+    target_version: Optional[str] = None    # defaults to ota_settings.json
+    selector: RolloutSelector = RolloutSelector()
+    wave_size: int = 50
+    max_in_flight: int = 20
+    bandwidth_budget_kbps: Optional[float] = None
+    wave_interval: float = 30.0             # seconds to observe each wave
+    anomaly_threshold: float = 0.2          # auto-halt above this cohort anomaly rate
+    min_cohort: int = 5
+
+async def _rollout_call(call):
+    # Rollouts run on the leader worker; commands may be answered through the cluster queue
+    try:
+        return await call
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except LookupError:
+        raise HTTPException(404, "Rollout not found")
+    except CommandError as e:
+        raise HTTPException(e.status, e.detail)
+
+@router.post("/admin/rollouts")
+async def create_rollout(req: RolloutRequest):
+    target_ver = req.target_version or get_ota_settings().target_firmware_version
+    payload = {"target_version": target_ver, "selector": req.selector.dict(),
+               "options": req.dict(exclude={"target_version", "selector"})}
+    return await _rollout_call(rollouts.submit("create", payload=payload))
+
+@router.get("/admin/rollouts")
+async def list_rollouts():
+    return await rollouts.describe()
+
+@router.get("/admin/rollouts/{rollout_id}")
+async def get_rollout(rollout_id: int):
+    return await _rollout_call(rollouts.describe(rollout_id))
+
+@router.post("/admin/rollouts/{rollout_id}/pause")
+async def pause_rollout(rollout_id: int):
+    return await _rollout_call(rollouts.submit("pause", rollout_id))
+
+@router.post("/admin/rollouts/{rollout_id}/resume")
+async def resume_rollout(rollout_id: int):
+    return await _rollout_call(rollouts.submit("resume", rollout_id))
+
+@router.post("/admin/rollouts/{rollout_id}/cancel")
+async def cancel_rollout(rollout_id: int):
+    return await _rollout_call(rollouts.submit("cancel", rollout_id))
+
+# --- FIRMWARE UPLOAD ---
+UPLOAD_FLUSH = 1024 * 1024  # body bytes buffered between writes (each one runs in the I/O pool)
+
+@router.post("/admin/firmware/{version}")
+async def upload_firmware(version: str, request: Request):
+    """Stores a raw image body as a new version; the manifest is computed and signed here."""
+    if not valid_version(version) or version == "latest":
+        raise HTTPException(400, "Invalid version")
+    if await repository.lookup(version) is not None:
+        raise HTTPException(409, f"Firmware v{version} already exists")
+
+    # Unique name: concurrent uploads (even of the same version) never share a file
+    fd, tmp = await run_io(tempfile.mkstemp, dir=STORE_DIR, prefix=f"upload-{version}-", suffix=".tmp")
+    f = await run_io(os.fdopen, fd, "wb")
+    size = 0
+    try:
+        pending, buffered = [], 0
+        async for chunk in request.stream():
+            pending.append(chunk)
+            buffered += len(chunk)
+            if buffered >= UPLOAD_FLUSH:
+                await run_io(f.writelines, pending)
+                size += buffered
+                pending, buffered = [], 0
+        await run_io(f.writelines, pending)
+        size += buffered
+    finally:
+        await run_io(f.close)
+    if size == 0:
+        await run_io(os.remove, tmp)
+        raise HTTPException(400, "Empty firmware image")
+
+    try:
+        manifest = await run_io(repository.add_file, version, tmp)
+    except FileExistsError as e:
+        await run_io(Path(tmp).unlink, missing_ok=True)  # add_file may have moved it already
+        raise HTTPException(409, str(e))
+    delta_cache.prebuild(version, version_index.counts())  # deltas from what the fleet runs now
+    log_event(events.FIRMWARE_UPLOADED, to_version=version, size=manifest["size"])
+    return {k: v for k, v in manifest.items() if k != "chunks"}
+
+# --- REQUEST PROFILING (app/profiling.py) ---
+class ProfilingUpdate(BaseModel):
+    enabled: Optional[bool] = None
+    sample_rate: Optional[float] = Field(None, ge=0, le=1)
+    budget_ms: Optional[float] = Field(None, ge=1)
+    cprofile: Optional[bool] = None
+    keep: Optional[int] = Field(None, ge=1)
+    exclude: Optional[List[str]] = None
+    blocking_ms: Optional[float] = Field(None, ge=0)
+
+@router.get("/admin/profiling")
+async def get_profiling():
+    """Current profiling settings and this worker's request counts."""
+    return profiler.describe()
+
+def _write_profiling(changes):
+    cfg = {**load_json("profiling.json"), **changes}
+    tmp = CONFIG_DIR / "profiling.json.tmp"
+    tmp.write_text(json.dumps(cfg, indent=4))
+    os.replace(tmp, CONFIG_DIR / "profiling.json")  # other workers never read a half-written file
+    profiling_config.refresh()
+
+@router.put("/admin/profiling")
+async def update_profiling(update: ProfilingUpdate):
+    """Changes profiling settings at runtime; every worker picks up the file within a second."""
+    await run_io(_write_profiling, update.dict(exclude_none=True))
+    return profiler.describe()
+
+@router.get("/admin/profiling/slow")
+async def get_slow_requests(limit: int = 20):
+    """Recent requests over the budget on this worker (newest first)."""
+    return {"worker": os.getpid(), "slow": profiler.recent(limit)}
+
+@router.delete("/admin/profiling/slow")
+async def clear_slow_requests():
+    profiler.clear()
+    return {"status": "cleared"}
+
+@router.get("/admin/profiling/blocking")
+async def get_loop_stalls(limit: int = 20):
+    """Recent event-loop stalls over blocking_ms on this worker, with stacks (newest first)."""
+    return {"worker": os.getpid(), "blocking_ms": get_profiling_settings().blocking_ms,
+            "stalls": detector.recent(limit)}
\ No newline at end of file
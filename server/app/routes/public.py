@@ -1,20 +1,220 @@
-from fastapi import APIRouter
-from fastapi.responses import FileResponse
-from app.state import devices, ota_log, anomaly_count
-from app.utils import FIRMWARE_DIR
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from app.state import all_devices, device_count, recent_log, get_anomaly_count, version_index, query_devices
+from app.state import devices_revision
+from app.state import first_log_seq, last_log_seq, log_since, read_archived_log, log_summary
+from app.events import SEVERITIES, to_public
+from app.registry import FIELDS as DEVICE_FIELDS
+from app.config import get_ota_settings
+from app.firmware import repository, serve_image, stats as delivery_stats
+from app import timeseries, delta, metrics
+from app.cluster import cluster
+from app.fleet import monitor as fleet_monitor
+from app.stream import hub, event_stream
+from app.aio import run_io
 
 router = APIRouter()
 
+def _resolve_version(version):
+    # "latest" is the version currently being rolled out
+    return get_ota_settings().target_firmware_version if version == "latest" else version
+
+async def _serve_version(request, version):
+    manifest = await repository.lookup(version)
+    if manifest is None:
+        raise HTTPException(404, f"Firmware v{version} not found")
+    return await serve_image(request, manifest)
+
 @router.get("/firmware/latest.bin")
-async def get_firmware():
-    fw_path = FIRMWARE_DIR / "firmware.bin"
-    if not fw_path.exists():
-        fw_path.write_bytes(b"IOTFW-MODULAR-FIRMWARE-v2.1.5")
-    return FileResponse(fw_path)
+async def get_firmware(request: Request):
+    """Full image, or a byte range of it for resumed downloads (ETag = SHA-256)."""
+    return await _serve_version(request, _resolve_version("latest"))
+
+@router.get("/firmware/signing-key")
+async def get_signing_key():
+    """Ed25519 public key that verifies firmware manifests (PEM)."""
+    return Response(repository.public_key_pem(), media_type="application/x-pem-file")
+
+@router.get("/firmware/versions")
+async def get_firmware_versions():
+    return {"target": _resolve_version("latest"), "versions": await repository.list_versions()}
+
+@router.get("/firmware/delta")
+async def get_firmware_delta(from_ver: str = Query(..., alias="from"), to_ver: str = Query(..., alias="to")):
+    """Binary patch from one firmware version to another (404 -> use the full image)."""
+    if not (delta.valid_version(from_ver) and delta.valid_version(to_ver)):
+        raise HTTPException(400, "Invalid version")
+    if from_ver == to_ver:
+        raise HTTPException(400, "Versions are identical")
+    patch = await delta.cache.get(from_ver, to_ver)
+    if patch is None:
+        raise HTTPException(404, "No delta available for these versions")
+    return Response(patch, media_type="application/octet-stream",
+                    headers={"X-Delta-From": from_ver, "X-Delta-To": to_ver})
+
+@router.get("/firmware/{version}/manifest")
+async def get_firmware_manifest(version: str):
+    """Size, SHA-256, chunk hashes and signature of a stored image."""
+    manifest = await repository.lookup(_resolve_version(version))
+    if manifest is None:
+        raise HTTPException(404, f"Firmware v{version} not found")
+    return manifest
+
+@router.get("/firmware/{version}")
+async def get_firmware_version(version: str, request: Request):
+    return await _serve_version(request, _resolve_version(version))
+
+def _devices_etag(request, seen_within=None):
+    # Weak ETag from the device revision and the query, known before any body is built.
+    # seen_within matches move with the clock, so those tags also change every second.
+    key = f"{devices_revision()}|{request.url.query}|{int(time.time()) if seen_within else ''}"
+    return f'W/"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+def _cached(request, etag):
+    """(304 response or None, headers for the full response)."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers), headers
+    return None, headers
 
 @router.get("/api/devices")
-async def get_devices(): return devices
+async def get_devices(request: Request):
+    """Every device record, keyed by device id (see /api/fleet/devices for pages and filters)."""
+    not_modified, headers = _cached(request, _devices_etag(request))
+    if not_modified:
+        return not_modified
+    # Plain dicts of scalars: skip FastAPI's generic jsonable_encoder pass
+    return Response(json.dumps(all_devices()), media_type="application/json", headers=headers)
+
+@router.get("/api/fleet/devices")
+async def get_device_page(
+    request: Request,
+    status: Optional[str] = Query(None, pattern="^(stable|anomaly)$"),
+    version: Optional[str] = Query(None, description="Exact version or wildcard such as 2.0.x"),
+    seen_within: Optional[float] = Query(None, gt=0, description="Only devices heard from in the last N seconds"),
+    prefix: Optional[str] = Query(None, description="Device id prefix"),
+    sort: str = Query("id", pattern="^-?(id|last_seen)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+):
+    """One page of devices: {"items": [...], "next_cursor": ..., "count": total matches}."""
+    wanted = None
+    if fields:
+        wanted = tuple(f for f in (s.strip() for s in fields.split(",")) if f and f != "device_id")
+        unknown = [f for f in wanted if f not in DEVICE_FIELDS]
+        if unknown:
+            raise HTTPException(400, f"Unknown field(s): {', '.join(unknown)}")
+    not_modified, headers = _cached(request, _devices_etag(request, seen_within))
+    if not_modified:
+        return not_modified
+    try:
+        items, next_cursor, count = query_devices(
+            wanted, status=status, version=version, seen_within=seen_within,
+            prefix=prefix, sort=sort, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    # Plain dicts of scalars: skip FastAPI's generic jsonable_encoder pass
+    body = json.dumps({"items": items, "next_cursor": next_cursor, "count": count})
+    return Response(body, media_type="application/json", headers=headers)
+
+@router.get("/api/devices/{device_id}/history")
+async def get_device_history(
+    device_id: str,
+    metric: str = "cpu",
+    from_ts: Optional[int] = Query(None, alias="from"),
+    to_ts: Optional[int] = Query(None, alias="to"),
+    step: Optional[int] = Query(None, gt=0),
+):
+    ts_store = timeseries.store
+    if not ts_store.has_device(device_id):
+        raise HTTPException(404, "No history for device")
+    if metric not in ts_store.metrics:
+        raise HTTPException(400, f"Unknown metric. Available: {', '.join(ts_store.metrics)}")
+
+    end = to_ts if to_ts is not None else int(time.time())
+    start = from_ts if from_ts is not None else end - 3600
+    resolution, points = ts_store.query(device_id, metric, start, end, step)
+    return {"device_id": device_id, "metric": metric, "resolution": resolution, "points": points}
+
+@router.get("/api/firmware/stats")
+async def get_firmware_stats():
+    """Firmware delivery counters: requests, served bytes and bytes/sec."""
+    return delivery_stats.snapshot()
+
+@router.get("/api/fleet/versions")
+async def get_fleet_versions(target: Optional[str] = None):
+    """Devices per firmware version and how many are below/at/above the target."""
+    target = target or get_ota_settings().target_firmware_version
+    return {"target": target, **version_index.relative_to(target), "versions": version_index.counts()}
+
+@router.get("/api/fleet/health")
+async def get_fleet_health(refresh: bool = False):
+    """Latest fleet-wide scan: per-version/subnet percentiles, cohorts, outliers, alerts."""
+    if not fleet_monitor.available:
+        raise HTTPException(503, "Fleet health scan needs NumPy (pip install numpy)")
+    if refresh or fleet_monitor.latest is None:
+        return await fleet_monitor.run_once()
+    return fleet_monitor.latest
+
+@router.get("/api/stream")
+async def stream_updates(interval: float = Query(0.5, ge=0.1, le=10.0)):
+    """SSE push channel: a snapshot, then device deltas and new log lines (at most every `interval` s)."""
+    snapshot = lambda: {"devices": all_devices(), "log": [to_public(e) for e in recent_log(50)]}
+    counters = lambda: {"total": device_count(), "anomalies": get_anomaly_count()}
+    return StreamingResponse(event_stream(hub, snapshot, counters, interval),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/api/log")
+async def get_log(
+    since: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    device: Optional[str] = None,
+    kind: Optional[str] = None,
+    severity: Optional[str] = Query(None, description=f"Minimum severity: {', '.join(SEVERITIES)}"),
+):
+    """OTA events with seq > since (optionally filtered); poll again with since=next_since."""
+    if severity is not None and severity not in SEVERITIES:
+        raise HTTPException(400, f"Unknown severity. Available: {', '.join(SEVERITIES)}")
+    filters = {"device": device, "kind": kind, "min_severity": severity}
+    entries = log_since(since, limit, **filters)
+    if entries is None:
+        # Older than the in-memory ring: read them back from disk, then carry
+        # on from memory if the disk ran out before the page was full
+        entries = await run_io(read_archived_log, since, limit, **filters)
+        if len(entries) < limit:
+            start = max(entries[-1].seq if entries else since, first_log_seq() - 1)
+            entries += log_since(start, limit - len(entries), **filters) or []
+    # A short page means everything up to last_seq has been seen
+    next_since = entries[-1].seq if len(entries) == limit else last_log_seq()
+    return {"entries": [to_public(e) for e in entries], "next_since": next_since,
+            "last_seq": last_log_seq()}
+
+@router.get("/api/log/summary")
+async def get_log_summary():
+    """Event counts by kind, severity and device over the in-memory window."""
+    return log_summary()
 
 @router.get("/api/stats")
 async def get_stats():
-    return {"total": len(devices), "anomalies": anomaly_count, "log": ota_log[-20:]}
\ No newline at end of file
+    return {"total": device_count(), "anomalies": get_anomaly_count(),
+            "log": [to_public(e) for e in recent_log(20)], "log_seq": last_log_seq()}
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text exposition; with several workers, all of them merged."""
+    if not cluster.shared:
+        body = metrics.render()
+    else:
+        snapshots = await asyncio.to_thread(cluster.worker_metrics)
+        snapshots[os.getpid()] = metrics.snapshot()  # our own, fresh
+        body = metrics.render(metrics.merge(snapshots), merged=True)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
\ No newline at end of file
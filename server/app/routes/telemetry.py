@@ -1,13 +1,25 @@
+import json
+import time
 from fastapi import APIRouter, HTTPException, Request
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from typing import Optional
 from datetime import datetime
-from app.state import devices
-from app.utils import load_json
+from app.state import update_device
+from app import timeseries, metrics
+from app.profiling import stage, mark
+from app.config import get_whitelist
 from app.services import check_telemetry_health, log_security_events
 
 router = APIRouter()
 
+MAX_BATCH_SIZE = 5000
+
+# Metric children bound once, so the hot path is a plain add
+SINGLE_SAMPLES = metrics.TELEMETRY_SAMPLES.labels("single")
+SINGLE_SECONDS = metrics.TELEMETRY_SECONDS.labels("single")
+BATCH_SAMPLES = metrics.TELEMETRY_SAMPLES.labels("batch")
+BATCH_SECONDS = metrics.TELEMETRY_SECONDS.labels("batch")
+
 # 1. DEFINE DATA MODEL
 # This MUST match the fields sent by your client/client.py
 class TelemetryModel(BaseModel):
@@ -17,7 +29,7 @@ class TelemetryModel(BaseModel):
     mem: float
     temp: float
     version: str
-    timestamp: int
+    timestamp: int = Field(ge=0, lt=2**32)  # unix seconds (history rings store u32)
     ota_port: int = 8000 
     
     # Extended Fields (These were missing!)
@@ -27,28 +39,118 @@ class TelemetryModel(BaseModel):
     boot_time: Optional[int] = 0       # <--- Critical for Uptime
     cpu_cores: Optional[int] = 1
 
+def ingest_sample(data, ip):
+    """Runs one validated, whitelisted sample through the anomaly engine and stores it."""
+    # Logic Check (Anomaly Detection)
+    with stage("anomaly"):
+        verdict = check_telemetry_health(data)
+    
+    # Logging (state transitions only)
+    with stage("log_events"):
+        log_security_events(data.device_id, verdict, data.cpu)
+
+    # 2. CAPTURE AND SAVE CLIENT DETAILS
+    # Now that 'boot_time' is in the model, data.dict() will include it!
+    # The storage backend copies these fields into its own record.
+    sample = data.dict()
+    sample["ip"] = ip
+    sample["last_seen"] = datetime.now().strftime("%H:%M:%S")
+    sample["status"] = verdict.status
+    sample["is_stable"] = verdict.is_stable
+    sample["anomaly_reason"] = verdict.reason  # None (dropped from the record) while stable
+    with stage("store"):
+        update_device(data.device_id, sample)
+
+    # 3. KEEP HISTORY (bounded ring buffers per device/metric)
+    with stage("timeseries"):
+        timeseries.store.record(data.device_id, data.timestamp, sample)
+
 @router.post("/telemetry")
 async def receive_telemetry(data: TelemetryModel, request: Request):
-    # Security Whitelist Check
-    allowed = load_json("devices.json", {}).get("allowed_devices", [])
-    if allowed and data.device_id not in allowed:
+    start = time.perf_counter()
+    mark("receive+validate")  # body read and model validation, before the handler ran
+    # Security Whitelist Check (O(1) frozenset lookup, cached config)
+    with stage("whitelist"):
+        permitted = get_whitelist().permits(data.device_id)
+    if not permitted:
+        metrics.WHITELIST_REJECTIONS.inc()
         print(f"⛔ BLOCKED unauthorized device: {data.device_id}")
         raise HTTPException(status_code=403, detail="Unauthorized")
 
-    # Logic Check (Anomaly Detection)
-    status, is_stable = check_telemetry_health(data)
-    
-    # Logging
-    log_security_events(data.device_id, not is_stable, data.cpu)
+    ingest_sample(data, request.client.host)
+    SINGLE_SAMPLES.inc()
+    SINGLE_SECONDS.observe(time.perf_counter() - start)
+    return {"status": "ok"}
 
-    # 2. CAPTURE AND SAVE CLIENT DETAILS
-    # Now that 'boot_time' is in the model, data.dict() will include it!
-    devices[data.device_id] = {
-        **data.dict(), 
-        "ip": request.client.host,
-        "last_seen": datetime.now().strftime("%H:%M:%S"),
-        "status": status,
-        "is_stable": is_stable
-    }
-    
-    return {"status": "ok"}
\ No newline at end of file
+# 5. BATCHED INGESTION
+# Gateways aggregate samples (from one or many devices) and send them in one
+# request: either a JSON array, or NDJSON (one sample per line) with
+# Content-Type: application/x-ndjson, which is processed as it streams in.
+def _ingest_item(index, item, whitelist, ip):
+    try:
+        with stage("validate"):
+            data = TelemetryModel(**item) if isinstance(item, dict) else None
+    except ValidationError as e:
+        return {"index": index, "status": "invalid", "detail": e.errors(include_url=False, include_context=False, include_input=False)}
+    if data is None:
+        return {"index": index, "status": "invalid", "detail": "Sample must be a JSON object"}
+
+    if not whitelist.permits(data.device_id):
+        return {"index": index, "device_id": data.device_id, "status": "rejected", "detail": "Unauthorized"}
+
+    try:
+        ingest_sample(data, ip)
+    except Exception as e:
+        # One bad sample must not fail the samples already ingested in this batch
+        print(f"⚠️ Error ingesting sample from {data.device_id}: {e}")
+        return {"index": index, "device_id": data.device_id, "status": "error", "detail": str(e)}
+    return {"index": index, "device_id": data.device_id, "status": "ok"}
+
+async def _iter_ndjson(request):
+    buf = b""
+    async for chunk in request.stream():
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buf.strip():
+        yield buf
+
+@router.post("/telemetry/batch")
+async def receive_telemetry_batch(request: Request):
+    start = time.perf_counter()
+    whitelist = get_whitelist()
+    ip = request.client.host
+    results = []
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        async for line in _iter_ndjson(request):
+            if len(results) >= MAX_BATCH_SIZE:
+                raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_SIZE} samples")
+            try:
+                item = json.loads(line)
+            except ValueError:
+                results.append({"index": len(results), "status": "invalid", "detail": "Malformed JSON line"})
+                continue
+            results.append(_ingest_item(len(results), item, whitelist, ip))
+    else:
+        try:
+            with stage("receive+parse"):
+                items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of samples")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body must be a JSON array of samples")
+        if len(items) > MAX_BATCH_SIZE:
+            raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_SIZE} samples")
+        results = [_ingest_item(i, item, whitelist, ip) for i, item in enumerate(items)]
+
+    accepted = sum(1 for r in results if r["status"] == "ok")
+    rejected = [r["device_id"] for r in results if r["status"] == "rejected"]
+    if rejected:
+        metrics.WHITELIST_REJECTIONS.inc(len(rejected))
+        print(f"⛔ BLOCKED unauthorized device(s) in batch: {', '.join(sorted(set(rejected)))}")
+    BATCH_SAMPLES.inc(accepted)
+    BATCH_SECONDS.observe(time.perf_counter() - start)
+    return {"accepted": accepted, "failed": len(results) - accepted, "results": results}
\ No newline at end of file
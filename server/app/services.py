@@ -1,71 +1,72 @@
-import requests
-from app.state import devices, ota_log, increment_anomaly, save_state
-from app.utils import load_json
+from app.state import get_device, increment_anomaly, log_event
+from app import events
+from app.config import get_ota_settings
+from app.anomaly import detector
+from app.dispatcher import dispatcher
+from app.versions import parse_version, compare_versions
 
 # --- ANOMALY ENGINE ---
 def check_telemetry_health(data):
-    cfg = load_json("thresholds.json", {"global": {}}).get("global", {})
-    cpu_th = cfg.get("cpu_threshold", 85.0)
-    mem_th = cfg.get("mem_threshold", 90.0)
-
-    if data.cpu > cpu_th or data.mem > mem_th:
+    """Runs a sample through the streaming detector (app/anomaly.py) and returns its Verdict."""
+    verdict = detector.observe(data.device_id, data.timestamp, (
+        data.cpu, data.mem, data.temp, data.disk_usage or 0.0,
+        data.net_sent_mb or 0.0, data.net_recv_mb or 0.0))
+    if not verdict.is_stable:
         increment_anomaly()
-        return "ANOMALY (High Load)", False
-    
-    return "Stable", True
+    return verdict
 
-def log_security_events(device_id, is_anomaly, cpu_val):
-    prev_device = devices.get(device_id, {})
-    prev_status = prev_device.get("status", "Unknown")
-
-    if is_anomaly and "ANOMALY" not in prev_status:
-        ota_log.append(f"⚠️ ALERT → {device_id} entered ANOMALY state (CPU:{cpu_val}%)")
-        save_state()
-    elif not is_anomaly and "ANOMALY" in prev_status:
-        ota_log.append(f"ea RECOVERY → {device_id} returned to Stable state")
-        save_state()
+def log_security_events(device_id, verdict, cpu_val):
+    # The detector reports state transitions, so no previous-status lookup is needed
+    if verdict.entered:
+        log_event(events.ANOMALY, device=device_id, metrics={"cpu": cpu_val}, reason=verdict.reason)
+    elif verdict.cleared:
+        log_event(events.RECOVERY, device=device_id)
 
 # --- OTA SERVICE WITH VALIDATION ---
-async def trigger_device_update(device_id, ip_address):
+async def trigger_device_update(device_id, ip_address, target_ver=None):
     """
     Triggers OTA update with Version Validation.
+    Returns the dispatcher result record, or None if the update was skipped/blocked.
     """
-    # 1. Load Target Version from Config
-    ota_settings = load_json("ota_settings.json", {"target_firmware_version": "2.1.5"})
-    target_ver = ota_settings.get("target_firmware_version", "2.1.5")
+    # 1. Load Target Version from Config (unless a rollout pins one)
+    if target_ver is None:
+        target_ver = get_ota_settings().target_firmware_version
 
     # 2. Get Device Current Version
-    device_info = devices.get(device_id, {})
+    device_info = get_device(device_id) or {}
     current_ver = device_info.get("version", "0.0.0")
     target_port = device_info.get("ota_port", 8000)
 
     print(f"🔍 Validating {device_id}: Current={current_ver} -> Target={target_ver}")
 
-    # 3. VALIDATION LOGIC
-    if current_ver == target_ver:
-        msg = f"🛑 SKIPPED → {device_id} is already on v{target_ver}"
-        ota_log.append(msg)
-        print(msg)
-        save_state()
+    # 3. VALIDATION LOGIC (semantic: "10.0.0" > "9.0.0", "2.1" == "2.1.0")
+    if parse_version(target_ver) is None:
+        print(events.render(log_event(events.OTA_BLOCKED, device=device_id, from_version=current_ver,
+                                      to_version=target_ver, reason="invalid_version")))
+        return
+
+    order = compare_versions(current_ver, target_ver)
+    if order == 0:
+        print(events.render(log_event(events.OTA_SKIPPED, device=device_id, from_version=current_ver,
+                                      to_version=target_ver)))
         return # Stop execution
     
-    # Optional: Prevent Downgrades (Simple string comparison, ideally use semantic versioning lib)
-    if current_ver > target_ver:
-        msg = f"🛑 BLOCKED → Downgrade attack prevention. {device_id} (v{current_ver}) > Target (v{target_ver})"
-        ota_log.append(msg)
-        print(msg)
-        save_state()
+    # Prevent Downgrades (an unparseable current version counts as oldest)
+    if order > 0:
+        print(events.render(log_event(events.OTA_BLOCKED, device=device_id, from_version=current_ver,
+                                      to_version=target_ver, reason="downgrade")))
         return
 
     # 4. Proceed if Valid
     print(f"🚀 Validation Passed. Triggering OTA for {device_id}...")
-    
-    try:
-        url = f"http://{ip_address}:{target_port}/ota-trigger"
-        # We send the target version in the request so client knows what to expect
-        requests.post(url, json={"target_version": target_ver}, timeout=5)
-        ota_log.append(f"✅ SUCCESS → {device_id} updated to v{target_ver}")
-    except Exception as e:
-        ota_log.append(f"⚠️ FAILED → Connection error with {device_id}: {e}")
-    
-    save_state()
\ No newline at end of file
+
+    # Non-blocking: pooled async client, bounded concurrency, retries.
+    # We send the target version in the request so client knows what to expect
+    result = await dispatcher.trigger(device_id, ip_address, target_port, target_ver)
+    if result["outcome"] == "success":
+        log_event(events.OTA_SUCCESS, device=device_id, from_version=current_ver, to_version=target_ver,
+                  attempts=result["attempts"], elapsed_ms=result["elapsed_ms"])
+    else:
+        log_event(events.OTA_FAILED, device=device_id, from_version=current_ver, to_version=target_ver,
+                  attempts=result["attempts"], error=result["error"])
+    return result
\ No newline at end of file
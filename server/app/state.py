@@ -1,51 +1,168 @@
-import json
+import os
 from pathlib import Path
+from app.storage import JsonStore, create_store
+from app.utils import load_json, WORKERS
+from app.versions import VersionIndex
+from app.device_index import DeviceQueryIndex
+from app.stream import hub
+from app import metrics
 
 # Define storage file path relative to this file
 # app/state.py -> parent=app -> parent=server -> data_store.json
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_STORE = BASE_DIR / "data_store.json"
+JOURNAL_FILE = BASE_DIR / "data_store.journal"
 
-# In-memory storage
-devices = {}
-ota_log = []
-anomaly_count = 0
+# Several worker processes share one SQLite database (app/cluster.py)
+SHARED = WORKERS > 1
+
+# Active storage backend (selected from config/storage.json in load_state).
+# Routes and services go through the functions below, never the backend directly.
+store = JsonStore(DATA_STORE, JOURNAL_FILE)
+
+# version -> device ids, maintained on every update (see app/versions.py)
+version_index = VersionIndex()
+# id order / status / last-seen indexes for /api/fleet/devices (see app/device_index.py)
+query_index = DeviceQueryIndex()
+
+# Bumped whenever this process applies a device change (its own or another
+# worker's), so /api/devices can answer If-None-Match without building a body.
+# The boot token keeps a restarted process or another worker from matching.
+_BOOT = os.urandom(4).hex()
+_revision = 0
+
+# --- DEVICES ---
+def get_device(device_id):
+    return store.get_device(device_id)
+
+def update_device(device_id, record):
+    global _revision
+    store.upsert_device(device_id, record)
+    _revision += 1
+    if "version" in record:
+        version_index.update(device_id, record["version"])
+    query_index.update(device_id, record)
+    hub.publish_device(device_id, record)  # live /api/stream subscribers
+
+def all_devices():
+    return store.all_devices()
+
+def device_count():
+    return store.count_devices()
+
+def device_ids():
+    """Sorted ids of every known device, from the query index (no records read)."""
+    return query_index.ids()
+
+def device_known(device_id):
+    return device_id in query_index
+
+def devices_revision():
+    """Opaque tag that changes whenever any device record changes in this process."""
+    return f"{_BOOT}.{_revision}"
+
+def query_devices(fields=None, **filters):
+    """One page of devices from the query indexes: (records, next cursor, number matched)."""
+    ids, next_cursor, matched = query_index.query(version_index, **filters)
+    records = []
+    for device_id in ids:
+        dev = get_device(device_id)
+        if dev is None:
+            continue
+        if fields:
+            # Projection reads just these columns, no full-record copy
+            records.append({"device_id": device_id, **{f: dev.get(f) for f in fields}})
+        else:
+            records.append(dev.to_dict() if hasattr(dev, "to_dict") else dict(dev))
+    return records, next_cursor, matched
+
+def device_columns(fields):
+    """Raw per-field columns of the whole fleet (for the fleet health scan)."""
+    return store.device_columns(fields)
+
+# --- OTA LOG & COUNTERS ---
+def log_event(kind, **fields):
+    """Records a typed OTA/security event (see app/events.py) and returns it."""
+    event = store.append_event(kind, **fields)
+    metrics.EVENTS.labels(kind).inc()
+    if not SHARED:  # shared mode: published once numbered, by apply_changes
+        hub.publish_log(event)
+    return event
+
+def recent_log(limit=20):
+    return store.recent_log(limit)
+
+def first_log_seq():
+    """Oldest sequence number still held in memory."""
+    return store.log.first_seq
+
+def last_log_seq():
+    return store.log.last_seq
+
+def log_since(seq, limit=100, **filters):
+    """Events after `seq` from memory, or None if they've left the in-memory ring."""
+    return store.log_since(seq, limit, **filters)
+
+def read_archived_log(seq, limit=100, **filters):
+    """Events after `seq` from the on-disk archive (blocking; run in a thread)."""
+    store.flush()  # the archive is written behind; make sure it has caught up with memory
+    return store.read_log(seq, limit, **filters)
+
+def log_summary():
+    return store.log.summary()
 
 def increment_anomaly():
-    global anomaly_count
-    anomaly_count += 1
-    save_state()
+    store.increment_anomaly()
+
+def get_anomaly_count():
+    return store.anomaly_count
+
+# --- SHARED MODE (app/cluster.py) ---
+def apply_changes(devices, new_events):
+    """Folds device updates from other workers and newly numbered events into this process."""
+    global _revision
+    _revision += len(devices)
+    store.apply_devices(devices)
+    for device_id, record in devices:
+        if "version" in record:
+            version_index.update(device_id, record["version"])
+        query_index.update(device_id, record)
+        hub.publish_device(device_id, record)
+    for event in store.log.ingest(new_events):
+        hub.publish_log(event)
 
+# --- PERSISTENCE ---
 def save_state():
-    """Saves the current in-memory state to a JSON file."""
-    state = {
-        "devices": devices,
-        "ota_log": ota_log,
-        "anomaly_count": anomaly_count
-    }
+    """Forces buffered mutations to disk (normally done in the background)."""
     try:
-        DATA_STORE.write_text(json.dumps(state, indent=4))
+        store.flush()
     except Exception as e:
         print(f"⚠️ Error saving state: {e}")
 
 def load_state():
-    """Loads state from JSON file into memory."""
-    global devices, ota_log, anomaly_count
-    if DATA_STORE.exists():
-        try:
-            data = json.loads(DATA_STORE.read_text())
-            
-            # Update devices dictionary (don't overwrite the object reference)
-            saved_devices = data.get("devices", {})
-            devices.update(saved_devices)
-            
-            # Restore logs
-            saved_logs = data.get("ota_log", [])
-            if saved_logs:
-                ota_log.clear()
-                ota_log.extend(saved_logs)
-                
-            anomaly_count = data.get("anomaly_count", 0)
-            print(f"✅ State Loaded: {len(devices)} devices, {len(ota_log)} logs.")
-        except Exception as e:
-            print(f"⚠️ Error loading state: {e}")
\ No newline at end of file
+    """Opens the configured backend and loads persisted state into it."""
+    global store
+    settings = load_json("storage.json", {"backend": "json"})
+    store = create_store(settings, BASE_DIR, shared=SHARED)
+    try:
+        store.load()
+        devices = store.all_devices()
+        version_index.rebuild(devices)
+        query_index.rebuild(devices)
+        backend = "sqlite, shared" if SHARED else settings.get("backend", "json")
+        print(f"✅ State Loaded ({backend}): "
+              f"{device_count()} devices, anomalies={get_anomaly_count()}.")
+    except Exception as e:
+        print(f"⚠️ Error loading state: {e}")
+
+metrics.Gauge("ota_devices", "Devices known to the server", fn=lambda: device_count())
+metrics.Gauge("ota_anomaly_count", "Persisted count of unstable telemetry samples",
+              fn=lambda: get_anomaly_count())
+metrics.Gauge("ota_stream_subscribers", "Open /api/stream connections", fn=lambda: len(hub))
+
+def close_state():
+    """Flushes and closes the storage backend."""
+    try:
+        store.close()
+    except Exception as e:
+        print(f"⚠️ Error closing state: {e}")
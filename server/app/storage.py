@@ -0,0 +1,450 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from app.journal import StateJournal
+from app.registry import DeviceRegistry
+from app import events, metrics
+from app.eventlog import DEFAULT_CAPACITY, EventLog, matcher
+
+# --- STORAGE BACKENDS ---
+# Both backends expose the same small interface used by app.state:
+#   load(), flush(), close()
+#   get_device(id), upsert_device(id, record), all_devices(), count_devices()
+#   device_columns(fields)  (raw columns, see DeviceRegistry.export)
+#   append_event(kind, **fields) -> Event, recent_log(limit),
+#   log_since(seq, limit, **filters), read_log(seq, limit, **filters)
+#   (log_since answers from memory or returns None; read_log hits the disk archive)
+#   increment_anomaly(), anomaly_count
+
+
+class JsonStore:
+    """In-memory dicts persisted through the append-only journal (small setups)."""
+
+    def __init__(self, snapshot_path, journal_path, log_capacity=DEFAULT_CAPACITY):
+        self.devices = DeviceRegistry()
+        self.log = EventLog(log_capacity)
+        self.anomaly_count = 0
+        self.journal = StateJournal(snapshot_path, journal_path, log_capacity=log_capacity)
+
+    def load(self):
+        data = self.journal.load()
+        for device_id, record in data["devices"].items():
+            self.devices.upsert(device_id, record)
+        self.log.restore(data["ota_log"])
+        self.anomaly_count = data["anomaly_count"]
+        self.journal.start()
+
+    def flush(self):
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+    # Devices
+    def get_device(self, device_id):
+        return self.devices.get(device_id)
+
+    def upsert_device(self, device_id, record):
+        # Fields are written into the registry columns in place
+        rec = self.devices.upsert(device_id, record)
+        self.journal.record_device(device_id, rec)
+
+    def all_devices(self):
+        return self.devices.to_dict()
+
+    def count_devices(self):
+        return len(self.devices)
+
+    def device_columns(self, fields):
+        return self.devices.export(fields)
+
+    # OTA log
+    def append_event(self, kind, **fields):
+        event = self.log.append(kind, **fields)
+        self.journal.record("log", entry=events.to_dict(event))
+        return event
+
+    def recent_log(self, limit=20):
+        return self.log.recent(limit)
+
+    def log_since(self, seq, limit=100, **filters):
+        return self.log.since(seq, limit, **filters)
+
+    def read_log(self, seq, limit=100, **filters):
+        return self.journal.read_log(seq, limit, matcher(**filters))
+
+    # Counters
+    def increment_anomaly(self):
+        self.anomaly_count += 1
+        self.journal.record("anomaly", count=self.anomaly_count)
+
+
+class SQLiteStore:
+    """SQLite (WAL) backend with indexed tables and batched, write-behind inserts.
+
+    With shared=True several server processes use the same database (see
+    app/cluster.py): counters are updated as deltas, event sequence numbers
+    are assigned by the database, and every device batch is stamped with a
+    revision so each process can pull the others' changes (changes_since).
+
+    Device records are also kept in memory in a DeviceRegistry (as in
+    JsonStore), so device reads never wait for the disk on the event loop;
+    the database is the durable copy and, when shared, the channel between
+    workers (apply_devices folds their rows in). The whole fleet is therefore
+    held in RAM, as with JsonStore.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS devices (
+            device_id TEXT PRIMARY KEY,
+            status    TEXT,
+            version   TEXT,
+            last_seen TEXT,
+            is_stable INTEGER,
+            data      TEXT NOT NULL,
+            rev       INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS ota_events (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts       REAL NOT NULL,
+            message  TEXT NOT NULL,
+            kind     TEXT,
+            severity TEXT,
+            device   TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS counters (
+            name  TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, flush_interval=0.2, max_batch=1000, log_capacity=DEFAULT_CAPACITY,
+                 shared=False):
+        self.db_path = Path(db_path)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.shared = shared
+        self.log = EventLog(log_capacity)
+        self.devices = DeviceRegistry()
+        self.device_rev = 0        # newest device revision applied in this process
+
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+        # Write-behind buffers (reads are answered from self.devices)
+        self._pending_devices = {}
+        self._pending_logs = []
+        # anomaly_count = stored value + increments not committed yet
+        self._anomaly_stored = 0
+        self._anomaly_pending = 0
+        self._anomaly_inflight = 0
+        # Batch currently being committed
+        self._inflight_devices = {}
+
+        self._reader = None
+        self._writer = None
+        self._sync = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if self.shared:
+            # Only the leader checkpoints (checkpoint()), so followers never stall on it
+            conn.execute("PRAGMA wal_autocheckpoint=0")
+        return conn
+
+    def load(self):
+        self._writer = self._connect()
+        self._writer.executescript(self.SCHEMA)
+        self._migrate()
+        self._reader = self._connect()
+        self._anomaly_stored = self._counter(self._reader, "anomaly_count")
+        self.device_rev = self._counter(self._reader, "device_rev")
+        for device_id, data in self._reader.execute("SELECT device_id, data FROM devices"):
+            self.devices.upsert(device_id, json.loads(data))
+        # ota_events.id is the log sequence number
+        rows = self._reader.execute(
+            f"SELECT {self.EVENT_COLUMNS} FROM ota_events ORDER BY id DESC LIMIT ?",
+            (self.log.ring.maxlen,)
+        ).fetchall()
+        last = self._reader.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ota_events'").fetchone()
+        self.log.restore([events.to_dict(_event_row(r)) for r in reversed(rows)],
+                         (last[0] + 1) if last else 1)
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    EVENT_COLUMNS = "id, ts, message, kind"
+
+    @staticmethod
+    def _counter(conn, name):
+        row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    @property
+    def anomaly_count(self):
+        return self._anomaly_stored + self._anomaly_inflight + self._anomaly_pending
+
+    def _migrate(self):
+        # Older databases lack the typed event columns and device revisions, and
+        # still carry device indexes that nothing queries since reads moved to memory
+        have = {r[1] for r in self._writer.execute("PRAGMA table_info(ota_events)")}
+        for column in ("kind", "severity", "device"):
+            if column not in have:
+                self._writer.execute(f"ALTER TABLE ota_events ADD COLUMN {column} TEXT")
+        if "rev" not in {r[1] for r in self._writer.execute("PRAGMA table_info(devices)")}:
+            self._writer.execute("ALTER TABLE devices ADD COLUMN rev INTEGER")
+        self._writer.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_events_device ON ota_events(device, id);
+            CREATE INDEX IF NOT EXISTS idx_events_kind   ON ota_events(kind, id);
+            CREATE INDEX IF NOT EXISTS idx_devices_rev   ON devices(rev);
+            DROP INDEX IF EXISTS idx_devices_status;
+            DROP INDEX IF EXISTS idx_devices_version;
+            DROP INDEX IF EXISTS idx_devices_last_seen;
+        """)
+
+    # --- BACKGROUND WRITER ---
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Error writing to SQLite: {e}")
+
+    def flush(self):
+        """Writes all buffered mutations in a single transaction."""
+        with self._io_lock:
+            with self._lock:
+                devices = list(self._pending_devices.items())
+                logs = self._pending_logs
+                anomalies = self._anomaly_pending
+                self._inflight_devices = self._pending_devices
+                self._pending_devices = {}
+                self._pending_logs = []
+                self._anomaly_pending = 0
+                self._anomaly_inflight = anomalies
+            stored = None
+            start = time.perf_counter()
+            try:
+                stored = self._commit(devices, logs, anomalies)
+                if devices or logs:
+                    metrics.SAVE_SECONDS.labels("sqlite").observe(time.perf_counter() - start)
+            finally:
+                with self._lock:
+                    self._inflight_devices = {}
+                    if stored is None:
+                        self._anomaly_pending += anomalies  # retried with the next batch
+                    else:
+                        self._anomaly_stored = stored
+                    self._anomaly_inflight = 0
+
+    def _commit(self, devices, logs, anomalies):
+        """Writes one batch; returns the stored anomaly count (which other processes may have moved)."""
+        if not devices and not logs and not anomalies:
+            return self._counter(self._writer, "anomaly_count") if self.shared else self._anomaly_stored
+
+        cur = self._writer.cursor()
+        written = 0  # bytes of JSON payload, for the save metrics
+        # IMMEDIATE takes the write lock up front, so revisions commit in order across processes
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            if devices:
+                cur.execute(
+                    "INSERT INTO counters (name, value) VALUES ('device_rev', 1) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+                )
+                rev = self._counter(cur, "device_rev")
+                rows = [(did, rec.get("status"), rec.get("version"), rec.get("last_seen"),
+                         int(bool(rec.get("is_stable", True))), json.dumps(rec), rev)
+                        for did, rec in devices]
+                written += sum(len(r[5]) for r in rows)
+                cur.executemany(
+                    "INSERT OR REPLACE INTO devices "
+                    "(device_id, status, version, last_seen, is_stable, data, rev) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            if logs:
+                # Shared mode: seq is None and the database assigns it (id AUTOINCREMENT)
+                rows = [(e.seq, e.ts, json.dumps(events.to_dict(e)), e.kind, e.severity, e.device)
+                        for e in logs]
+                written += sum(len(r[2]) for r in rows)
+                cur.executemany(
+                    "INSERT INTO ota_events (id, ts, message, kind, severity, device) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            if anomalies:
+                cur.execute(
+                    "INSERT INTO counters (name, value) VALUES ('anomaly_count', ?) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    (anomalies,),
+                )
+            stored = self._counter(cur, "anomaly_count")
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        metrics.SAVE_BYTES.labels("sqlite").inc(written)
+        return stored
+
+    # --- CHANGE FEED (shared mode) ---
+    def changes_since(self, rev, seq, limit=10000):
+        """Device rows stored after revision `rev` and events after `seq`, by any process.
+
+        Returns ([(device_id, record)], newest rev, [Event]). Runs in a worker thread.
+        """
+        if self._sync is None:
+            self._sync = self._connect()
+        rows = self._sync.execute(
+            "SELECT device_id, data, rev FROM devices WHERE rev > ? ORDER BY rev, device_id LIMIT ?",
+            (rev, limit),
+        ).fetchall()
+        if len(rows) == limit:
+            # A whole batch commits under one revision: read the rest of the last one,
+            # or the next call (rev > last) would skip the rows past the limit
+            last_id, last_rev = rows[-1][0], rows[-1][2]
+            rows += self._sync.execute(
+                "SELECT device_id, data, rev FROM devices WHERE rev = ? AND device_id > ? ORDER BY device_id",
+                (last_rev, last_id),
+            ).fetchall()
+        devices = [(did, json.loads(data)) for did, data, _ in rows]
+        if rows:
+            rev = rows[-1][2]
+        new_events = [_event_row(r) for r in self._sync.execute(
+            f"SELECT {self.EVENT_COLUMNS} FROM ota_events WHERE id > ? ORDER BY id LIMIT ?", (seq, limit)
+        )]
+        return devices, rev, new_events
+
+    def checkpoint(self):
+        """Folds the WAL back into the database file (the leader does this in shared mode)."""
+        with self._io_lock:
+            self._writer.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._writer:
+            self.flush()
+            self._writer.close()
+            self._reader.close()
+            self._writer = self._reader = None
+        if self._sync:
+            self._sync.close()
+            self._sync = None
+
+    def _nudge(self, size):
+        if size >= self.max_batch:
+            self._wakeup.set()
+
+    # Devices
+    def get_device(self, device_id):
+        return self.devices.get(device_id)
+
+    def upsert_device(self, device_id, record):
+        self.devices.upsert(device_id, record)
+        with self._lock:
+            self._pending_devices[device_id] = dict(record)
+            size = len(self._pending_devices)
+        self._nudge(size)
+
+    def apply_devices(self, devices):
+        """Folds rows from changes_since (other workers' writes) into the in-memory registry."""
+        with self._lock:
+            local = self._pending_devices.keys() | self._inflight_devices.keys()
+        for device_id, record in devices:
+            if device_id not in local:  # a newer local write is still on its way to the DB
+                self.devices.upsert(device_id, record)
+
+    def all_devices(self):
+        return self.devices.to_dict()
+
+    def device_columns(self, fields):
+        return self.devices.export(fields)
+
+    def count_devices(self):
+        return len(self.devices)
+
+    # OTA log
+    def append_event(self, kind, **fields):
+        if self.shared:
+            # Numbered by the database; reaches self.log through the change feed
+            event = events.make_event(None, time.time(), kind, **fields)
+        else:
+            event = self.log.append(kind, **fields)
+        with self._lock:
+            self._pending_logs.append(event)
+            size = len(self._pending_logs)
+        self._nudge(size)
+        return event
+
+    def recent_log(self, limit=20):
+        return self.log.recent(limit)
+
+    def log_since(self, seq, limit=100, **filters):
+        return self.log.since(seq, limit, **filters)
+
+    def read_log(self, seq, limit=100, device=None, kind=None, min_severity=None):
+        where, args = ["id > ?"], [seq]
+        if device is not None:
+            where.append("device = ?")
+            args.append(device)
+        if kind is not None:
+            where.append("kind = ?")
+            args.append(kind)
+        if min_severity is not None:
+            allowed = events.SEVERITIES[events.SEVERITY_RANK.get(min_severity, 0):]
+            where.append(f"severity IN ({','.join('?' * len(allowed))})")
+            args.extend(allowed)
+        # Own connection: called from worker threads
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute(
+                f"SELECT {self.EVENT_COLUMNS} FROM ota_events WHERE {' AND '.join(where)} "
+                "ORDER BY id LIMIT ?", (*args, limit)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [_event_row(r) for r in rows]
+
+    # Counters
+    def increment_anomaly(self):
+        with self._lock:
+            self._anomaly_pending += 1
+
+
+def _event_row(row):
+    seq, ts, message, kind = row
+    if kind is None:  # plain text line written before typed events
+        return events.from_dict({"seq": seq, "ts": ts, "msg": message})
+    # The row id is the seq (events written in shared mode are numbered by the insert)
+    return events.from_dict(json.loads(message))._replace(seq=seq)
+
+
+def create_store(settings, base_dir, shared=False):
+    """Builds the backend selected in config/storage.json (always SQLite when shared)."""
+    backend = settings.get("backend", "json")
+    log_capacity = max(1, int(settings.get("log_memory", DEFAULT_CAPACITY)))
+    if shared and backend != "sqlite":
+        print(f"⚠️ Storage backend '{backend}' can't be shared between workers, using sqlite")
+        backend = "sqlite"
+    if backend == "sqlite":
+        return SQLiteStore(base_dir / settings.get("sqlite_path", "data_store.db"),
+                           log_capacity=log_capacity, shared=shared)
+    if backend != "json":
+        print(f"⚠️ Unknown storage backend '{backend}', falling back to json")
+    return JsonStore(base_dir / "data_store.json", base_dir / "data_store.journal", log_capacity)
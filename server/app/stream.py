@@ -0,0 +1,106 @@
+import asyncio
+import json
+from app.events import to_public
+
+# --- LIVE PUSH STREAM ---
+# Dashboards subscribe to /api/stream (Server-Sent Events) instead of
+# polling. Each subscriber gets a full snapshot once, then deltas: the
+# devices that changed and the new log events since its last message.
+#
+# Coalescing/backpressure: publishing never blocks and never queues one
+# message per update. A subscriber only holds "device id -> latest record"
+# for devices changed since its last send plus a bounded list of new log
+# events, so a slow reader receives fewer, larger deltas and its pending
+# state is bounded by the fleet size. If it falls too far behind it is sent
+# a fresh snapshot instead.
+
+MAX_PENDING_LOGS = 500
+MAX_PENDING_DEVICES = 10000  # beyond this a snapshot is cheaper than a delta
+
+
+class Subscriber:
+    __slots__ = ("devices", "logs", "dropped_logs", "resync", "wakeup")
+
+    def __init__(self):
+        self.devices = {}
+        self.logs = []
+        self.dropped_logs = 0
+        self.resync = False
+        self.wakeup = asyncio.Event()
+
+    def take(self):
+        """Pending changes since the last call (and resets them)."""
+        devices, logs, dropped = self.devices, self.logs, self.dropped_logs
+        self.devices, self.logs, self.dropped_logs = {}, [], 0
+        self.wakeup.clear()
+        return devices, logs, dropped
+
+
+class StreamHub:
+    def __init__(self):
+        self._subscribers = set()
+
+    def subscribe(self):
+        sub = Subscriber()
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers.discard(sub)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    # --- PUBLISHING (called from state.py on every change; O(subscribers)) ---
+    def publish_device(self, device_id, record):
+        for sub in self._subscribers:
+            if sub.resync:
+                continue
+            sub.devices[device_id] = record
+            if len(sub.devices) > MAX_PENDING_DEVICES:
+                sub.resync = True
+                sub.devices.clear()
+            sub.wakeup.set()
+
+    def publish_log(self, event):
+        for sub in self._subscribers:
+            sub.logs.append(event)
+            if len(sub.logs) > MAX_PENDING_LOGS:
+                del sub.logs[0]
+                sub.dropped_logs += 1
+            sub.wakeup.set()
+
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+
+async def event_stream(hub, snapshot, counters, min_interval=0.5, keepalive=15.0):
+    """SSE generator: snapshot, then coalesced deltas at most every min_interval seconds."""
+    sub = hub.subscribe()  # before the snapshot, so nothing between the two is lost
+    try:
+        yield sse("snapshot", {**snapshot(), **counters()})
+        while True:
+            try:
+                await asyncio.wait_for(sub.wakeup.wait(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            # Let more changes pile up so they go out as one message
+            await asyncio.sleep(min_interval)
+            if sub.resync:
+                sub.resync = False
+                sub.take()
+                yield sse("snapshot", {**snapshot(), **counters()})
+                continue
+            devices, logs, dropped = sub.take()
+            payload = {"devices": {did: dict(rec) for did, rec in devices.items()},
+                       "log": [to_public(e) for e in logs], **counters()}
+            if dropped:
+                payload["dropped_logs"] = dropped
+            yield sse("delta", payload)
+    finally:
+        hub.unsubscribe(sub)
+
+
+hub = StreamHub()
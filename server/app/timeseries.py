@@ -0,0 +1,230 @@
+from array import array
+
+# --- PER-DEVICE TIME-SERIES STORE ---
+# Every device gets fixed-size, array-backed ring buffers per metric at three
+# resolutions: raw samples, 1-minute and 1-hour rollups (min/max/avg). All
+# buffers are preallocated on the first sample, so memory per device is
+# constant and known up front (see bytes_per_device()).
+
+DEFAULT_METRICS = ("cpu", "mem", "temp", "disk_usage")
+RESOLUTIONS = {"raw": 0, "1m": 60, "1h": 3600}
+
+
+class RawRing:
+    """Ring of (timestamp, value) pairs."""
+    __slots__ = ("ts", "vals", "cap", "head", "size")
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.ts = array("I", bytes(4 * cap))
+        self.vals = array("f", bytes(4 * cap))
+        self.head = 0
+        self.size = 0
+
+    def push(self, ts, value):
+        self.ts[self.head] = ts
+        self.vals[self.head] = value
+        self.head = (self.head + 1) % self.cap
+        if self.size < self.cap:
+            self.size += 1
+
+    def last_ts(self):
+        return self.ts[(self.head - 1) % self.cap] if self.size else 0
+
+    def covers(self, start):
+        """True if nothing at or after `start` has been overwritten yet."""
+        return self.size < self.cap or start >= self.ts[self.head]
+
+    def rows(self, start, end):
+        """Yields (ts, min, max, avg, count) in time order within [start, end]."""
+        first = self.head - self.size
+        for i in range(first, self.head):
+            i %= self.cap
+            t = self.ts[i]
+            if start <= t <= end:
+                v = self.vals[i]
+                yield t, v, v, v, 1
+
+    @staticmethod
+    def nbytes(cap):
+        return 8 * cap
+
+
+class RollupRing:
+    """Ring of closed buckets plus one open bucket being accumulated."""
+    __slots__ = ("step", "ts", "mins", "maxs", "avgs", "counts", "cap", "head", "size",
+                 "cur_ts", "cur_min", "cur_max", "cur_sum", "cur_count")
+
+    def __init__(self, cap, step):
+        self.step = step
+        self.cap = cap
+        self.ts = array("I", bytes(4 * cap))
+        self.mins = array("f", bytes(4 * cap))
+        self.maxs = array("f", bytes(4 * cap))
+        self.avgs = array("f", bytes(4 * cap))
+        self.counts = array("H", bytes(2 * cap))
+        self.head = 0
+        self.size = 0
+        self.cur_ts = -1
+        self.cur_min = self.cur_max = self.cur_sum = 0.0
+        self.cur_count = 0
+
+    def add(self, ts, value):
+        bucket = ts - ts % self.step
+        if bucket != self.cur_ts:
+            self._close()
+            self.cur_ts = bucket
+            self.cur_min = self.cur_max = value
+            self.cur_sum = 0.0
+            self.cur_count = 0
+        elif value < self.cur_min:
+            self.cur_min = value
+        elif value > self.cur_max:
+            self.cur_max = value
+        self.cur_sum += value
+        self.cur_count += 1
+
+    def _close(self):
+        if self.cur_count == 0:
+            return
+        h = self.head
+        self.ts[h] = self.cur_ts
+        self.mins[h] = self.cur_min
+        self.maxs[h] = self.cur_max
+        self.avgs[h] = self.cur_sum / self.cur_count
+        self.counts[h] = min(self.cur_count, 0xFFFF)
+        self.head = (h + 1) % self.cap
+        if self.size < self.cap:
+            self.size += 1
+
+    def oldest_ts(self):
+        if self.size:
+            return self.ts[(self.head - self.size) % self.cap]
+        return self.cur_ts if self.cur_count else 0
+
+    def covers(self, start):
+        """True if nothing at or after `start` has been overwritten yet."""
+        return self.size < self.cap or start >= self.oldest_ts()
+
+    def rows(self, start, end):
+        first = self.head - self.size
+        for i in range(first, self.head):
+            i %= self.cap
+            t = self.ts[i]
+            if start <= t <= end:
+                yield t, self.mins[i], self.maxs[i], self.avgs[i], self.counts[i]
+        # Include the still-open bucket so recent data is visible immediately
+        if self.cur_count and start <= self.cur_ts <= end:
+            yield (self.cur_ts, self.cur_min, self.cur_max,
+                   self.cur_sum / self.cur_count, self.cur_count)
+
+    @staticmethod
+    def nbytes(cap):
+        return 18 * cap
+
+
+class MetricSeries:
+    __slots__ = ("raw", "minute", "hour")
+
+    def __init__(self, raw_points, minute_points, hour_points):
+        self.raw = RawRing(raw_points)
+        self.minute = RollupRing(minute_points, 60)
+        self.hour = RollupRing(hour_points, 3600)
+
+    def add(self, ts, value):
+        self.raw.push(ts, value)
+        self.minute.add(ts, value)
+        self.hour.add(ts, value)
+
+
+class TimeSeriesStore:
+    def __init__(self, metrics=DEFAULT_METRICS, raw_points=120, minute_points=120, hour_points=168):
+        self.metrics = tuple(metrics)
+        self.raw_points = raw_points
+        self.minute_points = minute_points
+        self.hour_points = hour_points
+        self.series = {}  # device_id -> {metric: MetricSeries}
+
+    def bytes_per_device(self):
+        """Fixed buffer size allocated for every device (excluding object headers)."""
+        per_metric = (RawRing.nbytes(self.raw_points)
+                      + RollupRing.nbytes(self.minute_points)
+                      + RollupRing.nbytes(self.hour_points))
+        return per_metric * len(self.metrics)
+
+    def record(self, device_id, ts, sample):
+        """Adds one telemetry sample. Out-of-order (older) samples are dropped."""
+        dev = self.series.get(device_id)
+        if dev is None:
+            dev = {m: MetricSeries(self.raw_points, self.minute_points, self.hour_points)
+                   for m in self.metrics}
+            self.series[device_id] = dev
+        elif ts < dev[self.metrics[0]].raw.last_ts():
+            return
+        for m in self.metrics:
+            value = sample.get(m)
+            if value is not None:
+                dev[m].add(ts, float(value))
+
+    def has_device(self, device_id):
+        return device_id in self.series
+
+    def query(self, device_id, metric, start, end, step=None):
+        """Returns (resolution, rows) for [start, end], downsampled to `step` seconds."""
+        ms = self.series[device_id][metric]
+
+        # Pick the finest resolution that still covers the requested window: one
+        # that hasn't wrapped yet holds everything the device ever sent
+        if step is None:
+            if ms.raw.covers(start):
+                name, ring = "raw", ms.raw
+            elif ms.minute.covers(start):
+                name, ring = "1m", ms.minute
+            else:
+                name, ring = "1h", ms.hour
+        elif step < 60:
+            name, ring = "raw", ms.raw
+        elif step < 3600:
+            name, ring = "1m", ms.minute
+        else:
+            name, ring = "1h", ms.hour
+
+        rows = ring.rows(start, end)
+        if step and step > RESOLUTIONS[name]:
+            rows = _downsample(rows, step)
+
+        return name, [
+            {"ts": t, "min": round(lo, 2), "max": round(hi, 2), "avg": round(avg, 2)}
+            for t, lo, hi, avg, _ in rows
+        ]
+
+
+def _downsample(rows, step):
+    cur = None
+    for t, lo, hi, avg, n in rows:
+        bucket = t - t % step
+        if cur is None or bucket != cur[0]:
+            if cur is not None:
+                yield cur[0], cur[1], cur[2], cur[3] / cur[4], cur[4]
+            cur = [bucket, lo, hi, 0.0, 0]
+        cur[1] = min(cur[1], lo)
+        cur[2] = max(cur[2], hi)
+        cur[3] += avg * n
+        cur[4] += n
+    if cur is not None:
+        yield cur[0], cur[1], cur[2], cur[3] / cur[4], cur[4]
+
+
+# Shared instance used by the telemetry routes (sized in configure()).
+store = TimeSeriesStore()
+
+def configure(settings):
+    global store
+    store = TimeSeriesStore(
+        metrics=settings.get("metrics", DEFAULT_METRICS),
+        raw_points=settings.get("raw_points", 120),
+        minute_points=settings.get("minute_points", 120),
+        hour_points=settings.get("hour_points", 168),
+    )
+    print(f"📈 Time-series store: {store.bytes_per_device()} bytes/device "
+          f"({len(store.metrics)} metrics)")
@@ -1,8 +1,9 @@
 import json
+import os
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import rsa, ed25519
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 
@@ -10,6 +11,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 CONFIG_DIR = BASE_DIR / "config"
 FIRMWARE_DIR = BASE_DIR / "firmware"
 
+# Number of server processes sharing state (set by run.py; see app/cluster.py)
+WORKERS = max(1, int(os.environ.get("OTA_WORKERS") or 1))
+
 def setup_directories():
     CONFIG_DIR.mkdir(exist_ok=True)
     FIRMWARE_DIR.mkdir(exist_ok=True)
@@ -40,4 +44,15 @@ def create_ssl_cert():
     key_path.write_text(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode())
     cert_path.write_text(cert.public_bytes(serialization.Encoding.PEM).decode())
     
-    return key_path, cert_path
\ No newline at end of file
+    return key_path, cert_path
+
+def load_signing_key():
+    """Ed25519 key used to sign firmware manifests (created on first use)."""
+    key_path = BASE_DIR / "firmware_signing_key.pem"
+    if key_path.exists():
+        return serialization.load_pem_private_key(key_path.read_bytes(), password=None)
+
+    print("Generating firmware signing key...")
+    key = ed25519.Ed25519PrivateKey.generate()
+    key_path.write_bytes(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return key
\ No newline at end of file
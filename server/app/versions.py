@@ -0,0 +1,161 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+# --- FIRMWARE VERSIONS ---
+# Semantic versions ("2.10.0", "v2.1", "3.0.0-rc.1+build5") parsed once and
+# cached. Ordering follows semver: numeric components compare as numbers and
+# a pre-release sorts before its release; build metadata is ignored.
+
+_SEMVER_RE = re.compile(
+    r"^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$")
+
+
+@dataclass(frozen=True, order=True)
+class Version:
+    key: tuple                  # sort key; compared first
+    major: int = 0
+    minor: int = 0
+    patch: int = 0
+    prerelease: tuple = ()
+
+    def __str__(self):
+        text = f"{self.major}.{self.minor}.{self.patch}"
+        if self.prerelease:
+            text += "-" + ".".join(str(p) for p in self.prerelease)
+        return text
+
+
+@lru_cache(maxsize=4096)
+def parse_version(text):
+    """Returns a Version, or None if `text` is not a recognisable version."""
+    m = _SEMVER_RE.match(str(text).strip()) if text is not None else None
+    if not m:
+        return None
+    major, minor, patch = (int(g) if g else 0 for g in m.group(1, 2, 3))
+    pre = tuple(int(p) if p.isdigit() else p for p in m.group(4).split(".")) if m.group(4) else ()
+    # Release (no pre-release) sorts after any pre-release of the same version;
+    # within a pre-release, numeric identifiers sort before alphanumeric ones.
+    pre_key = (1,) if not pre else (0,) + tuple(
+        (0, p, "") if isinstance(p, int) else (1, 0, p) for p in pre)
+    return Version((major, minor, patch, pre_key), major, minor, patch, pre)
+
+
+def compare_versions(a, b):
+    """-1/0/1 like cmp(); unparseable versions sort below every valid one."""
+    va, vb = parse_version(a), parse_version(b)
+    if va is None or vb is None:
+        return (va is not None) - (vb is not None)
+    return (va > vb) - (va < vb)
+
+
+def parse_pattern(text):
+    """'2.0.x' / '2.*' -> numeric prefix tuple; None if not a wildcard pattern."""
+    parts = str(text).strip().lstrip("v").split(".")
+    wildcards = 0
+    while parts and parts[-1] in ("x", "X", "*"):
+        parts.pop()
+        wildcards += 1
+    if not wildcards or not 1 <= len(parts) <= 2 or not all(p.isdigit() for p in parts):
+        return None
+    return tuple(int(p) for p in parts)
+
+
+# --- VERSION INDEX ---
+# version string -> set of device ids, kept up to date on every telemetry
+# update. Distinct version strings are also bucketed by (major,) and
+# (major, minor) so "2.0.x" is answered from its bucket without scanning.
+
+class VersionIndex:
+    def __init__(self):
+        self._devices = {}     # version string -> set of device ids
+        self._of = {}          # device id -> version string
+        self._prefixes = {}    # (major,) / (major, minor) -> set of version strings
+
+    def update(self, device_id, version):
+        old = self._of.get(device_id)
+        if old == version and device_id in self._of:
+            return
+        if device_id in self._of:
+            ids = self._devices[old]
+            ids.discard(device_id)
+            if not ids:
+                del self._devices[old]
+                self._unbucket(old)
+        self._of[device_id] = version
+        ids = self._devices.get(version)
+        if ids is None:
+            ids = self._devices[version] = set()
+            self._bucket(version)
+        ids.add(device_id)
+
+    def _prefix_keys(self, version):
+        v = parse_version(version)
+        return () if v is None else ((v.major,), (v.major, v.minor))
+
+    def _bucket(self, version):
+        for key in self._prefix_keys(version):
+            self._prefixes.setdefault(key, set()).add(version)
+
+    def _unbucket(self, version):
+        for key in self._prefix_keys(version):
+            bucket = self._prefixes.get(key)
+            if bucket is not None:
+                bucket.discard(version)
+                if not bucket:
+                    del self._prefixes[key]
+
+    def rebuild(self, devices):
+        """Re-indexes from a {device_id: record} mapping (startup only)."""
+        self.__init__()
+        for device_id, record in devices.items():
+            self.update(device_id, record.get("version"))
+
+    # --- QUERIES ---
+    def version_of(self, device_id):
+        return self._of.get(device_id)
+
+    def devices_on(self, version):
+        """Device ids on exactly this version ("2.1" and "2.1.0" are the same)."""
+        v = parse_version(version)
+        if v is None:
+            return set(self._devices.get(version, ()))
+        out = set()
+        for name in self._prefixes.get((v.major, v.minor), ()):
+            if parse_version(name) == v:
+                out |= self._devices[name]
+        return out
+
+    def matching(self, pattern):
+        """Device ids for an exact version or a wildcard such as '2.0.x'."""
+        prefix = parse_pattern(pattern)
+        if prefix is None:
+            return self.devices_on(pattern)
+        out = set()
+        for name in self._prefixes.get(prefix, ()):
+            out |= self._devices[name]
+        return out
+
+    def counts(self):
+        return {name: len(ids) for name, ids in self._devices.items()}
+
+    def relative_to(self, target):
+        """Device counts below / at / above a target (one comparison per distinct version)."""
+        below = at = above = 0
+        for name, ids in self._devices.items():
+            c = compare_versions(name, target)
+            if c < 0:
+                below += len(ids)
+            elif c == 0:
+                at += len(ids)
+            else:
+                above += len(ids)
+        return {"below": below, "at": at, "above": above}
+
+    def below(self, target):
+        """Device ids on a version lower than target (unparseable versions included)."""
+        out = set()
+        for name, ids in self._devices.items():
+            if compare_versions(name, target) < 0:
+                out |= ids
+        return out
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""
+Delta vs. full firmware updates: bytes on the wire and client-side cost.
+
+Run from the server/ folder:
+    python -m benchmarks.bench_delta [image_kib] [edits]
+"""
+import hashlib
+import random
+import sys
+import time
+import zlib
+from app.delta import make_delta, apply_delta
+
+
+def make_images(size, edits, seed=7):
+    rnd = random.Random(seed)
+    # Firmware-like: mostly incompressible code/data with some padding runs
+    old = bytearray(rnd.randbytes(size))
+    for _ in range(size // 65536):
+        at = rnd.randrange(size - 4096)
+        old[at:at + 4096] = b"\xff" * 4096
+
+    new = bytearray(old)
+    for _ in range(edits):  # patched functions / constants
+        at = rnd.randrange(len(new) - 64)
+        new[at:at + 16] = rnd.randbytes(16)
+    at = rnd.randrange(len(new))
+    new[at:at] = rnd.randbytes(4096)  # a new code section shifts everything after it
+    at = rnd.randrange(len(new) - 2048)
+    del new[at:at + 2048]
+    return bytes(old), bytes(new)
+
+
+def timed(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return result, best
+
+
+if __name__ == "__main__":
+    kib = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    edits = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    old, new = make_images(kib * 1024, edits)
+
+    patch, t_make = timed(make_delta, old, new, repeat=1)
+    rebuilt, t_apply = timed(apply_delta, old, patch)
+    assert rebuilt == new
+    full_z = zlib.compress(new, 6)
+    # Full update client cost: verify the downloaded image's hash
+    _, t_full = timed(lambda b: hashlib.sha256(b).digest(), new)
+
+    print(f"Image: {len(new) / 1024:.0f} KiB | edits: {edits} + 1 insertion + 1 deletion\n")
+    print(f"{'':<22}{'bytes':>12}{'client time':>14}")
+    print(f"{'full image':<22}{len(new):>12}{t_full * 1000:>11.1f} ms")
+    print(f"{'full image (zlib)':<22}{len(full_z):>12}{'-':>14}")
+    print(f"{'delta patch':<22}{len(patch):>12}{t_apply * 1000:>11.1f} ms")
+    print(f"\nTransfer saved: {100 * (1 - len(patch) / len(new)):.1f}% "
+          f"({len(new) / len(patch):.0f}x smaller) | server diff time: {t_make:.2f}s (cached per version pair)")
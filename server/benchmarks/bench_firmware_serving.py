@@ -0,0 +1,102 @@
+"""
+Firmware delivery under a mass rollout: N devices downloading at once.
+
+Starts the server on a local port (plain HTTP) unless --url points at a
+running one, uploads a test image and runs N concurrent downloaders.
+
+Run from the server/ folder:
+    python -m benchmarks.bench_firmware_serving [downloaders] [image_kib] [rounds] [--url=URL]
+"""
+import asyncio
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import time
+import httpx
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port):
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{url}/firmware/versions", timeout=1)
+            return proc, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("Server did not start")
+
+
+async def download(client, url, digest):
+    t0 = time.perf_counter()
+    h = hashlib.sha256()
+    size = 0
+    async with client.stream("GET", url) as r:
+        r.raise_for_status()
+        async for chunk in r.aiter_bytes(64 * 1024):
+            h.update(chunk)
+            size += len(chunk)
+    assert h.hexdigest() == digest, "corrupt download"
+    return time.perf_counter() - t0, size
+
+
+async def run(base, version, digest, downloaders, rounds):
+    limits = httpx.Limits(max_connections=downloaders)
+    async with httpx.AsyncClient(verify=False, timeout=120, limits=limits) as client:
+        url = f"{base}/firmware/{version}"
+        await download(client, url, digest)  # warm-up
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(download(client, url, digest)
+                                         for _ in range(downloaders * rounds)))
+        wall = time.perf_counter() - t0
+        stats = (await client.get(f"{base}/api/firmware/stats")).json()
+    return wall, results, stats
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--url")]
+    url_arg = next((a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--url=")), None)
+    downloaders = int(args[0]) if len(args) > 0 else 200
+    kib = int(args[1]) if len(args) > 1 else 4096
+    rounds = int(args[2]) if len(args) > 2 else 1
+
+    proc = None
+    base = url_arg
+    if base is None:
+        proc, base = start_server(free_port())
+    try:
+        image = os.urandom(kib * 1024)
+        digest = hashlib.sha256(image).hexdigest()
+        version = f"bench-{digest[:8]}"
+        r = httpx.post(f"{base}/admin/firmware/{version}", content=image, verify=False, timeout=60)
+        if r.status_code not in (200, 409):
+            raise SystemExit(f"Upload failed: HTTP {r.status_code}")
+
+        wall, results, stats = asyncio.run(run(base, version, digest, downloaders, rounds))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    times = sorted(t for t, _ in results)
+    total = sum(size for _, size in results)
+    pct = lambda p: times[min(len(times) - 1, int(p * len(times)))] * 1000
+
+    print(f"Image: {kib} KiB | downloads: {len(results)} ({downloaders} concurrent x {rounds})\n")
+    print(f"Aggregate throughput: {total / wall / 2**20:,.1f} MiB/s over {wall:.2f}s")
+    print(f"Per download:         p50 {pct(0.5):.0f} ms | p95 {pct(0.95):.0f} ms | max {times[-1] * 1000:.0f} ms")
+    print(f"Server counters:      {stats['bytes_total'] / 2**20:,.1f} MiB served, "
+          f"{stats['bytes_per_sec_10s'] / 2**20:,.1f} MiB/s (10s avg), "
+          f"{stats['cached_images']} hot images ({stats['cached_bytes'] / 2**20:.1f} MiB mapped)")
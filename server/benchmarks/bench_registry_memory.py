@@ -0,0 +1,84 @@
+"""
+Memory benchmark: dict-of-dicts device map vs. the columnar DeviceRegistry.
+
+Run from the server/ folder:
+    python -m benchmarks.bench_registry_memory [num_devices] [updates_per_device]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from app.registry import DeviceRegistry
+
+
+def make_sample(i):
+    return {
+        "device_id": f"iot-{i:06d}",
+        "cpu": round(random.uniform(5, 95), 1),
+        "mem": round(random.uniform(20, 90), 1),
+        "temp": round(random.uniform(35, 75), 1),
+        "version": random.choice(("1.0.0", "2.0.1", "2.1.5")),
+        "timestamp": int(time.time()),
+        "ota_port": 8000 + i % 1000,
+        "disk_usage": 50.0,
+        "net_sent_mb": round(random.uniform(0, 500), 2),
+        "net_recv_mb": round(random.uniform(0, 500), 2),
+        "boot_time": int(time.time()) - 3600,
+        "cpu_cores": 4,
+    }
+
+
+def fill_dicts(n, rounds):
+    devices = {}
+    for _ in range(rounds):
+        for i in range(n):
+            sample = make_sample(i)
+            # Previous telemetry route: a fresh dict per POST
+            devices[sample["device_id"]] = {
+                **sample,
+                "ip": "10.0.%d.%d" % (i // 256 % 256, i % 256),
+                "last_seen": datetime.now().strftime("%H:%M:%S"),
+                "status": "Stable",
+                "is_stable": True,
+            }
+    return devices
+
+
+def fill_registry(n, rounds):
+    registry = DeviceRegistry()
+    for _ in range(rounds):
+        for i in range(n):
+            sample = make_sample(i)
+            sample["ip"] = "10.0.%d.%d" % (i // 256 % 256, i % 256)
+            sample["last_seen"] = datetime.now().strftime("%H:%M:%S")
+            sample["status"] = "Stable"
+            sample["is_stable"] = True
+            registry.upsert(sample["device_id"], sample)
+    return registry
+
+
+def measure(fn, n, rounds):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = fn(n, rounds)
+    elapsed = time.perf_counter() - t0
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del obj
+    return current, peak, elapsed
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    print(f"Devices: {n} | updates/device: {rounds}\n")
+    results = {}
+    for name, fn in (("dict-of-dicts", fill_dicts), ("DeviceRegistry", fill_registry)):
+        random.seed(42)
+        current, peak, elapsed = measure(fn, n, rounds)
+        results[name] = current
+        print(f"{name:<15} resident: {current / n:7.0f} B/device | peak: {peak / 1e6:7.1f} MB | {elapsed:.2f}s")
+
+    print(f"\nReduction: {results['dict-of-dicts'] / results['DeviceRegistry']:.1f}x")
@@ -0,0 +1,133 @@
+"""
+Telemetry throughput vs. number of server workers (config/server.json).
+
+For each worker count, starts the server on a local port (plain HTTP) from
+a scratch copy of server/ using the shared SQLite backend, then drives it
+from several client processes, each holding keep-alive connections that
+POST /telemetry for their own devices as fast as the server answers.
+
+Throughput should grow roughly linearly with workers until the machine's
+cores are used up (the clients need CPU too: on a 4-core box, expect the
+curve to flatten past 2-3 workers).
+
+Run from the server/ folder:
+    python -m benchmarks.bench_workers [seconds] [client_procs] [conns_per_proc] [workers,...]
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from benchmarks.common import scratch_copy
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def prepare_tree():
+    root, work = scratch_copy({"backend": "sqlite", "sqlite_path": "data_store.db"})
+    # What run.py does once before forking workers: configs, signing key, firmware import
+    subprocess.run([sys.executable, "-c", "from app.main import prepare; from app.firmware import "
+                    "repository; prepare(); repository.load()"], cwd=work, check=True,
+                   stdout=subprocess.DEVNULL)
+    return root, work
+
+
+def start_server(work, workers):
+    port = free_port()
+    env = {**os.environ, "OTA_WORKERS": str(workers)}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=work, env=env, stdout=subprocess.DEVNULL)
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc, port
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("Server did not start")
+
+
+# --- LOAD GENERATOR (runs in client processes) ---
+async def _connection(port, device_id, deadline, counts):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    n = 0
+    try:
+        while time.perf_counter() < deadline:
+            body = json.dumps({"device_id": device_id, "cpu": 20.0 + n % 7, "mem": 40.0,
+                               "temp": 45.0, "version": "2.0.0", "timestamp": int(time.time())}).encode()
+            writer.write(b"POST /telemetry HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            if b" 200 " not in status:
+                counts["errors"] += 1
+            n += 1
+    finally:
+        writer.close()
+    counts["ok"] += n
+
+
+def _client(args):
+    port, proc_no, conns, seconds = args
+    counts = {"ok": 0, "errors": 0}
+    deadline = time.perf_counter() + seconds
+
+    async def main():
+        await asyncio.gather(*(_connection(port, f"bench-{proc_no}-{c}", deadline, counts)
+                               for c in range(conns)))
+    asyncio.run(main())
+    return counts
+
+
+def measure(port, seconds, procs, conns):
+    with multiprocessing.Pool(procs) as pool:
+        t0 = time.perf_counter()
+        results = pool.map(_client, [(port, p, conns, seconds) for p in range(procs)])
+        wall = time.perf_counter() - t0
+    ok = sum(r["ok"] for r in results)
+    return ok / wall, sum(r["errors"] for r in results)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    procs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    conns = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    counts = [int(w) for w in sys.argv[4].split(",")] if len(sys.argv) > 4 else [1, 2, 4]
+
+    print(f"CPU cores: {os.cpu_count()} | clients: {procs} processes x {conns} keep-alive connections | "
+          f"{seconds:.0f}s per run\n")
+    root, work = prepare_tree()
+    baseline = None
+    try:
+        print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'errors':>7}")
+        for workers in counts:
+            for stale in work.glob("data_store.db*"):
+                stale.unlink()
+            proc, port = start_server(work, workers)
+            try:
+                measure(port, 1, procs, 2)  # warm-up: imports, first connections
+                rate, errors = measure(port, seconds, procs, conns)
+            finally:
+                proc.terminate()
+                proc.wait()
+            baseline = baseline or rate
+            print(f"{workers:>8} {rate:>10,.0f} {rate / baseline:>7.2f}x {errors:>7}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,30 @@
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+# Helpers shared by the benchmarks that need a server tree of their own
+# (so they never touch the real data store, firmware store or configs).
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+
+
+def scratch_copy(storage=None):
+    """Copy of server/ without its data, with an empty whitelist; returns (temp root, server dir)."""
+    root = Path(tempfile.mkdtemp(prefix="ota-bench-"))
+    work = root / "server"
+    shutil.copytree(SERVER_DIR, work, ignore=shutil.ignore_patterns(
+        "data_store*", "leader.lock", "__pycache__", "*.pem", "store", "deltas"))
+    (work / "config").mkdir(exist_ok=True)
+    (work / "config" / "devices.json").write_text(json.dumps({"allowed_devices": []}))
+    # Profiling and the stall detector stay off, whatever the local settings
+    (work / "config" / "profiling.json").unlink(missing_ok=True)
+    if storage is not None:
+        (work / "config" / "storage.json").write_text(json.dumps(storage))
+    return root, work
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
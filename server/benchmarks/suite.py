@@ -0,0 +1,372 @@
+"""
+Reproducible benchmark suite for the ingestion, persistence and OTA paths.
+
+Drives the FastAPI app in-process (httpx ASGI transport, no network) in a
+scratch copy of server/, so the real data store and configs are never
+touched. Measures:
+
+  telemetry   POST /telemetry req/s and p50/p99 latency vs fleet size
+  devices     GET /api/fleet/devices: one 1000-device page, and the whole fleet
+  anomaly     check_telemetry_health() cost per sample
+  persistence save_state / close / load_state vs device count and log length
+              (json and sqlite backends)
+  firmware    concurrent firmware download throughput
+  workers     POST /telemetry req/s of a real server (uvicorn, shared SQLite)
+              vs worker count, driven from separate client processes
+
+Results are printed and can be saved as JSON (--out). Given an earlier
+result file (--baseline), every metric is compared and the run fails
+(exit code 1) if one got worse by more than --threshold. Metrics ending in
+_per_s are better when higher, all others (times) when lower.
+
+Run from the server/ folder:
+    python -m benchmarks.suite [--quick] [--only telemetry,anomaly] [--out now.json]
+                               [--baseline before.json] [--threshold 0.15]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from benchmarks.common import scratch_copy, percentile
+
+CASES = ("anomaly", "persistence", "telemetry", "devices", "firmware", "workers")
+SCRATCH_ENV = "OTA_BENCH_SCRATCH"
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="OTA server benchmark suite")
+    p.add_argument("--quick", action="store_true", help="smaller sizes (CI smoke run)")
+    p.add_argument("--only", help=f"comma-separated subset of: {', '.join(CASES)}")
+    p.add_argument("--repeat", type=int, default=3, help="runs per measurement (median is kept)")
+    p.add_argument("--out", help="write results as JSON")
+    p.add_argument("--baseline", help="earlier results JSON to compare against")
+    p.add_argument("--threshold", type=float, default=0.15,
+                   help="allowed relative slowdown per metric before failing (0.15 = 15%%)")
+    return p.parse_args()
+
+
+@contextlib.contextmanager
+def quiet():
+    """The server prints on startup/load; keep the report readable."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def median_of(runs):
+    """Per-metric median over repeated runs (a list of {metric: value})."""
+    keys = runs[0].keys()
+    return {k: round(statistics.median(r[k] for r in runs), 3) for k in keys}
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return (time.perf_counter() - t0) * 1000
+
+
+# --- CASES ---
+def bench_anomaly(cfg):
+    from app.routes.telemetry import TelemetryModel
+    from app.services import check_telemetry_health
+    from app import anomaly, services
+    from benchmarks.bench_anomaly import make_samples
+
+    devices, per_device = cfg["anomaly"]
+    samples = [TelemetryModel(device_id=did, cpu=v[0], mem=v[1], temp=v[2], version="2.0.0",
+                              timestamp=ts, disk_usage=v[3], net_sent_mb=v[4], net_recv_mb=v[5])
+               for did, ts, v in make_samples(devices, per_device)]
+
+    def run():
+        services.detector = anomaly.AnomalyDetector()
+        for s in samples[:devices]:  # warm: per-device state and thresholds
+            check_telemetry_health(s)
+        t0 = time.perf_counter()
+        for s in samples[devices:]:
+            check_telemetry_health(s)
+        elapsed = time.perf_counter() - t0
+        n = len(samples) - devices
+        return {"per_sample_us": elapsed / n * 1e6, "samples_per_s": n / elapsed}
+
+    return {f"anomaly.devices={devices}": median_of([run() for _ in range(cfg["repeat"])])}
+
+
+def _reset_data():
+    from app.utils import BASE_DIR
+    for f in BASE_DIR.glob("data_store*"):
+        f.unlink()
+
+
+def bench_persistence(cfg):
+    from app import state, events
+    from app.utils import CONFIG_DIR
+
+    def run(backend, devices, log_len):
+        (CONFIG_DIR / "storage.json").write_text(json.dumps(
+            {"backend": backend, "sqlite_path": "data_store.db", "log_memory": 1000}))
+        _reset_data()
+        with quiet():
+            state.load_state()
+        for i in range(devices):
+            state.update_device(f"bench-{i:06d}", {
+                "device_id": f"bench-{i:06d}", "cpu": 30.0, "mem": 40.0, "temp": 45.0,
+                "version": "2.0.0", "timestamp": 1_700_000_000 + i, "ip": "10.0.0.1",
+                "status": "Stable", "is_stable": True})
+        for i in range(log_len):
+            state.log_event(events.ANOMALY, device=f"bench-{i % devices:06d}", metrics={"cpu": 99.0},
+                            reason="cpu above threshold")
+        with quiet():
+            save_ms = timed(state.save_state)
+            close_ms = timed(state.close_state)
+            load_ms = timed(state.load_state)
+            state.close_state()
+        return {"save_ms": save_ms, "close_ms": close_ms, "load_ms": load_ms}
+
+    out = {}
+    for backend in ("json", "sqlite"):
+        for devices in cfg["persist_devices"]:
+            for log_len in cfg["persist_log"]:
+                out[f"persistence.{backend}.devices={devices}.log={log_len}"] = median_of(
+                    [run(backend, devices, log_len) for _ in range(cfg["repeat"])])
+    _reset_data()
+    (CONFIG_DIR / "storage.json").write_text(json.dumps({"backend": "json", "log_memory": 1000}))
+    return out
+
+
+async def _telemetry(client, fleet, requests, concurrency):
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            body = {"device_id": f"bench-{i % fleet:06d}", "cpu": 20.0 + i % 30, "mem": 40.0, "temp": 45.0,
+                    "version": "2.0.0", "timestamp": 1_700_000_000 + i // fleet * 5}
+            t0 = time.perf_counter()
+            r = await client.post("/telemetry", json=body)
+            latencies.append(time.perf_counter() - t0)
+            if r.status_code != 200:
+                raise SystemExit(f"/telemetry returned HTTP {r.status_code}")
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+    latencies.sort()
+    return {"req_per_s": requests / wall, "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000}
+
+
+async def _devices(client):
+    async def page():
+        r = await client.get("/api/fleet/devices", params={"limit": 1000})
+        r.raise_for_status()
+
+    async def all_pages():
+        cursor = None
+        while True:
+            params = {"limit": 1000, **({"cursor": cursor} if cursor else {})}
+            cursor = (await client.get("/api/fleet/devices", params=params)).json()["next_cursor"]
+            if not cursor:
+                return
+
+    t0 = time.perf_counter()
+    await page()
+    page_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    await all_pages()
+    return {"page_1000_ms": page_ms, "full_fleet_ms": (time.perf_counter() - t0) * 1000}
+
+
+async def _firmware(client, size, downloads, concurrency):
+    image = os.urandom(size)
+    version = f"bench-{time.time_ns()}"
+    with quiet():
+        r = await client.post(f"/admin/firmware/{version}", content=image)
+    r.raise_for_status()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def download():
+        async with sem:
+            r = await client.get(f"/firmware/{version}")
+            assert len(r.content) == size, "short download"
+
+    await download()  # warm: maps the image
+    t0 = time.perf_counter()
+    await asyncio.gather(*(download() for _ in range(downloads)))
+    wall = time.perf_counter() - t0
+    return {"mib_per_s": size * downloads / wall / 2**20,
+            "per_download_ms": wall / downloads * concurrency * 1000}
+
+
+async def bench_app(cfg, which):
+    import httpx
+    from app.main import app
+
+    _reset_data()
+    out = {}
+    with quiet():
+        await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            for fleet in cfg["fleets"]:
+                if "telemetry" in which:
+                    requests = max(cfg["requests"], fleet)
+                    runs = [await _telemetry(client, fleet, requests, cfg["concurrency"])
+                            for _ in range(cfg["repeat"])]
+                    out[f"telemetry.fleet={fleet}"] = median_of(runs)
+                elif "devices" in which:
+                    await _telemetry(client, fleet, fleet, cfg["concurrency"])  # just populate
+                if "devices" in which:
+                    out[f"devices.fleet={fleet}"] = median_of(
+                        [await _devices(client) for _ in range(cfg["repeat"])])
+            if "firmware" in which:
+                size, downloads, concurrency = cfg["firmware"]
+                out[f"firmware.size={size // 1024}k.concurrency={concurrency}"] = median_of(
+                    [await _firmware(client, size, downloads, concurrency) for _ in range(cfg["repeat"])])
+    finally:
+        with quiet():
+            await app.router.shutdown()
+    return out
+
+
+def bench_workers(cfg):
+    # Real processes and sockets (see benchmarks/bench_workers.py), one fresh server per run
+    from benchmarks.bench_workers import prepare_tree, start_server, measure
+
+    seconds, procs, conns = cfg["workers_load"]
+    root, work = prepare_tree()
+    out = {}
+    try:
+        for workers in cfg["workers"]:
+            runs = []
+            for _ in range(cfg["repeat"]):
+                for stale in work.glob("data_store.db*"):
+                    stale.unlink()
+                proc, port = start_server(work, workers)
+                try:
+                    measure(port, 1, procs, 2)  # warm-up: imports, first connections
+                    rate, errors = measure(port, seconds, procs, conns)
+                finally:
+                    proc.terminate()
+                    proc.wait()
+                if errors:
+                    raise SystemExit(f"workers={workers}: {errors} failed requests")
+                runs.append({"req_per_s": rate})
+            out[f"workers.workers={workers}"] = median_of(runs)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return out
+
+
+def run_suite(args):
+    which = set(args.only.split(",")) if args.only else set(CASES)
+    unknown = which - set(CASES)
+    if unknown:
+        raise SystemExit(f"Unknown case(s): {', '.join(sorted(unknown))}")
+    cfg = {
+        "repeat": max(1, args.repeat),
+        "anomaly": (200, 50) if args.quick else (1000, 100),
+        "persist_devices": [1000] if args.quick else [1000, 10000],
+        "persist_log": [1000, 10000] if args.quick else [1000, 50000],
+        "fleets": [100, 1000] if args.quick else [100, 1000, 10000],
+        "requests": 1000 if args.quick else 3000,
+        "concurrency": 32,
+        "firmware": (1024 * 1024, 16, 8) if args.quick else (4 * 1024 * 1024, 64, 16),
+        "workers": [1, 2] if args.quick else [1, 2, 4],
+        "workers_load": (3, 2, 8) if args.quick else (8, min(4, os.cpu_count() or 1), 16),
+    }
+    results = {}
+    if "anomaly" in which:
+        results.update(bench_anomaly(cfg))
+    if "persistence" in which:
+        results.update(bench_persistence(cfg))
+    if which & {"telemetry", "devices", "firmware"}:
+        results.update(asyncio.run(bench_app(cfg, which)))
+    if "workers" in which:
+        results.update(bench_workers(cfg))
+    return results
+
+
+# --- REPORTING / COMPARISON ---
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.environ.get(SCRATCH_ENV) or ".").stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "quick": args.quick, "repeat": args.repeat,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def compare(results, baseline, threshold):
+    """Prints a per-metric comparison; returns the list of regressions."""
+    regressions = []
+    print(f"\n{'benchmark':<52} {'metric':<14} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(name, {}).get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            worse = -change if higher_is_better(metric) else change
+            flag = "  ❌ REGRESSION" if worse > threshold else ""
+            if flag:
+                regressions.append((name, metric, before, value))
+            print(f"{name:<52} {metric:<14} {before:>12,.3f} {value:>12,.3f} {change:>+7.0%}{flag}")
+    return regressions
+
+
+def main(args):
+    results = run_suite(args)
+    print(f"{'benchmark':<52} metrics")
+    for name, metrics in results.items():
+        print(f"{name:<52} " + "  ".join(f"{k}={v:,.3f}" for k, v in metrics.items()))
+
+    report = {"meta": metadata(args), "results": results}
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+        print(f"\n💾 Results written to {args.out}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+            return 1
+        print(f"\n✅ No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if os.environ.get(SCRATCH_ENV):
+        sys.exit(main(args))
+
+    # Re-run this module inside a scratch copy of server/ (its own configs and data)
+    argv = ["--repeat", str(args.repeat), "--threshold", str(args.threshold)]
+    if args.quick:
+        argv.append("--quick")
+    if args.only:
+        argv += ["--only", args.only]
+    for attr in ("out", "baseline"):  # paths are relative to where the suite was started
+        if getattr(args, attr):
+            argv += [f"--{attr}", str(Path(getattr(args, attr)).resolve())]
+    root, work = scratch_copy({"backend": "json", "log_memory": 1000})
+    try:
+        env = {**os.environ, SCRATCH_ENV: str(Path.cwd())}
+        code = subprocess.run([sys.executable, "-m", "benchmarks.suite", *argv], cwd=work, env=env).returncode
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(code)
\ No newline at end of file
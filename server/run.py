@@ -1,25 +1,56 @@
 import uvicorn
 import multiprocessing
-from app.utils import create_ssl_cert
-from app.main import app
+import json
+import os
+from pathlib import Path
+
+
+def configured_workers():
+    # Read before importing the app: workers > 1 switches app.state to shared mode
+    try:
+        cfg = json.loads((Path(__file__).resolve().parent / "config" / "server.json").read_text())
+        return max(1, int(cfg.get("workers", 1)))
+    except (OSError, ValueError):
+        return 1
+
 
 if __name__ == "__main__":
     # 1. Windows Multiprocessing Fix
     multiprocessing.freeze_support()
 
+    workers = configured_workers()
+    if workers > 1:
+        os.environ["OTA_WORKERS"] = str(workers)
+
+    from app.utils import create_ssl_cert
+    from app.main import app, prepare
+    from app.firmware import repository
+    from app.state import load_state, close_state
+
     # 2. Ensure SSL is ready
     key_path, cert_path = create_ssl_cert()
     
     print("\n" + "="*60)
     print("   SECURE OTA SERVER (MODULAR)")
     print("   Running at https://0.0.0.0:8443")
+    if workers > 1:
+        print(f"   Workers: {workers} (shared SQLite state)")
     print("="*60 + "\n")
 
+    if workers > 1:
+        # One-time setup in the parent so workers don't race on it:
+        # configs, signing key, loose firmware imports, database schema
+        prepare()
+        repository.load()
+        load_state()
+        close_state()
+
     # 3. Start Uvicorn
     uvicorn.run(
-        app, 
+        "app.main:app" if workers > 1 else app,
         host="0.0.0.0", 
         port=8443, 
+        workers=workers,
         ssl_keyfile=str(key_path), 
         ssl_certfile=str(cert_path),
         log_level="info"